@@ -19,16 +19,27 @@ Cron for sending exception logs to greplin-exception-catcher.
 Usage: upload.py http://server.com secretKey exceptionDirectory
 """
 
+import hashlib
 import json
+import mmap
 import os
 import time
 import os.path
+import struct
 import sys
 import urllib2, httplib
 import fcntl
 import signal
 import traceback
 
+try:
+  from greplin.gec import spool
+except ImportError:
+  # Running from a checkout without gec-logging-handler installed: use the writer's module from the checkout.
+  import imp
+  spool = imp.load_source('gecspool', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir,
+                                                   'python', 'logging', 'greplin', 'gec', 'spool.py'))
+
 # max field size
 MAX_FIELD_SIZE = 1024 * 10
 
@@ -44,6 +55,126 @@ SETTINGS = {}
 # Documents processed and total. These are global stats.
 DOCUMENTS_PROCESSED, DOCUMENTS_TOTAL = 0, '[unknown]'
 
+# Content type of the compact format, which the server lists in the X-Gec-Formats header of its responses when it
+# accepts it.
+COMPACT_TYPE = 'application/x-gec-reports'
+
+# Exceptions sent per request in the compact format.
+BATCH_SIZE = 100
+
+
+
+####### Compact format encoder, kept in step with server/wireformat.py. #######
+
+# upload.py is deployed on its own, so it can't import the server's encoder.  testCompactRoundTrip in
+# server/upload_test.py checks that the two encode byte for byte the same.
+
+COMPACT_MAGIC = 'GEC\x01'
+
+NULL, TRUE, FALSE, INT, FLOAT, STRING, LIST, MAP, DIGEST = range(9)
+
+DOUBLE = struct.Struct('>d')
+
+
+def backtraceDigest(text):
+  """Returns the hex SHA-1 digest the server stores a backtrace under."""
+  return hashlib.sha1(text.encode('utf-8') if isinstance(text, unicode) else text).hexdigest()
+
+
+def appendVarint(out, value):
+  """Appends an unsigned varint."""
+  while value > 0x7f:
+    out.append((value & 0x7f) | 0x80)
+    value >>= 7
+  out.append(value)
+
+
+
+class CompactEncoder(object):
+  """Encodes values, collecting the string table."""
+
+  def __init__(self):
+    self.out = bytearray()
+    self.strings = {}
+
+
+  def string(self, value):
+    """Appends the table index of a string."""
+    if isinstance(value, str):
+      value = value.decode('utf-8')
+    index = self.strings.get(value)
+    if index is None:
+      index = self.strings[value] = len(self.strings)
+    appendVarint(self.out, index)
+
+
+  def value(self, value):
+    """Appends a value."""
+    out = self.out
+    if value is None:
+      out.append(NULL)
+    elif value is True:
+      out.append(TRUE)
+    elif value is False:
+      out.append(FALSE)
+    elif isinstance(value, basestring):
+      out.append(STRING)
+      self.string(value)
+    elif isinstance(value, float):
+      out.append(FLOAT)
+      out += DOUBLE.pack(value)
+    elif isinstance(value, (int, long)):
+      out.append(INT)
+      appendVarint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, dict):
+      out.append(MAP)
+      appendVarint(out, len(value))
+      for key, item in value.items():
+        self.string(key)
+        self.value(item)
+    elif isinstance(value, (list, tuple)):
+      out.append(LIST)
+      appendVarint(out, len(value))
+      for item in value:
+        self.value(item)
+    else:
+      raise TypeError('Cannot encode %r' % (value,))
+
+
+  def report(self, report, referenced):
+    """Appends a report, sending its backtrace by digest if that digest is referenced."""
+    self.out.append(MAP)
+    appendVarint(self.out, len(report))
+    for key, item in report.items():
+      self.string(key)
+      digest = backtraceDigest(item) if key == 'backtrace' and item and referenced else None
+      if digest in referenced:
+        self.out.append(DIGEST)
+        self.string(digest)
+      else:
+        self.value(item)
+
+
+
+def encodeCompact(reports, referenced):
+  """Encodes a list of exceptions in the compact format.  Backtraces whose digest is in referenced are sent by
+  digest."""
+  encoder = CompactEncoder()
+  for report in reports:
+    encoder.report(report, referenced)
+
+  out = bytearray(COMPACT_MAGIC)
+  appendVarint(out, len(encoder.strings))
+  for value, _ in sorted(encoder.strings.items(), key=lambda item: item[1]):
+    encoded = value.encode('utf-8')
+    appendVarint(out, len(encoded))
+    out += encoded
+  appendVarint(out, len(reports))
+  return str(out + encoder.out)
+
+
+
+####### Uploading. #######
 
 def trimDict(obj):
   """Trim string elements in a dictionnary to MAX_FIELD_SIZE"""
@@ -54,32 +185,43 @@ def trimDict(obj):
       trimDict(v)
 
 
-def sendException(jsonData, filename):
-  """Send an exception to the GEC server
-     Returns True if sending succeeded"""
+def postReports(body, contentType, filename, expected=()):
+  """POST a request body to the GEC server.
+     Returns the response, or the error for a response whose status is in expected, or None if sending failed"""
 
   request = urllib2.Request('%s/report?key=%s' % (SETTINGS["server"], SETTINGS["secretKey"]),
-                            json.dumps(jsonData),
-                            {'Content-Type': 'application/json'})
+                            body,
+                            {'Content-Type': contentType})
   try:
-    response = urllib2.urlopen(request, timeout=HTTP_TIMEOUT)
+    return urllib2.urlopen(request, timeout=HTTP_TIMEOUT)
 
   except urllib2.HTTPError, e:
+    if e.code in expected:
+      return e
     print >> sys.stderr, 'Error from server while uploading %s' % filename
     print >> sys.stderr, e.read()
-    return False
+    return None
 
   except urllib2.URLError, e:    
     if e.reason not in ('timed out', 'The read operation timed out'):
       print >> sys.stderr, 'Error while uploading %s' % filename
       print >> sys.stderr, e
       print >> sys.stderr, 'Reason: %s' % e.reason
-    return False
+    return None
 
   except httplib.BadStatusLine, e:
     print >> sys.stderr, 'Bad status line from server while uploading %s' % filename
     print >> sys.stderr, e
     print >> sys.stderr, 'Status line: %r' % e.line
+    return None
+
+
+def sendException(jsonData, filename):
+  """Send an exception to the GEC server
+     Returns True if sending succeeded"""
+
+  response = postReports(json.dumps(jsonData), 'application/json', filename)
+  if response is None:
     return False
 
   status = response.getcode()
@@ -87,58 +229,257 @@ def sendException(jsonData, filename):
   if status != 200:
     raise Exception('Unexpected status code: %d' % status)
 
+  if COMPACT_TYPE in (response.info().getheader('X-Gec-Formats') or ''):
+    SETTINGS['compact'] = True
+
   global DOCUMENTS_PROCESSED            # pylint: disable=W0603
   DOCUMENTS_PROCESSED += 1
   return True
 
 
-def processFiles(files):
-  """Send each exception file in files to GEC"""
-  endTime = time.time() + MAX_RUN_TIME  
-  
-  for filename in files:
+def sendCompact(reports, filename):
+  """Send a batch of exceptions to the GEC server in the compact format, with backtraces by digest unless the server
+     is missing them.
+     Returns True if sending succeeded"""
+
+  digests = set(backtraceDigest(report['backtrace']) for report in reports if report.get('backtrace'))
+  response = postReports(encodeCompact(reports, digests), COMPACT_TYPE, filename, (409, 415))
+  if response is not None and response.getcode() == 409:
+    # The server hasn't stored some of the backtraces, so send those in full.
+    missing = set(response.read().split())
+    response = postReports(encodeCompact(reports, digests - missing), COMPACT_TYPE, filename, (415,))
+  if response is None:
+    return False
+
+  status = response.getcode()
+
+  if status == 415:
+    print >> sys.stderr, 'Server no longer accepts the compact format, sending JSON'
+    SETTINGS['compact'] = False
+    return False
+
+  if status != 200:
+    raise Exception('Unexpected status code: %d' % status)
+
+  global DOCUMENTS_PROCESSED            # pylint: disable=W0603
+  DOCUMENTS_PROCESSED += len(reports)
+  return True
+
+
+def sendReports(reports, filename):
+  """Send exceptions to the GEC server, in one compact request once the server has said it accepts them and otherwise
+     as JSON, which takes one exception per request.
+     Returns True if sending succeeded"""
+  if SETTINGS.get('compact'):
+    return sendCompact(reports, filename)
+  assert len(reports) == 1
+  return sendException(reports[0], filename)
+
+
+def batchSize():
+  """The number of exceptions to send per request."""
+  return BATCH_SIZE if SETTINGS.get('compact') else 1
+
+
+def processFiles(files, endTime=None):
+  """Send each exception file in files to GEC, in batches once the server accepts the compact format"""
+  endTime = endTime or time.time() + MAX_RUN_TIME
+
+  pending = list(files)
+  while pending:
+    if time.time() > endTime:
+      return
+    size = batchSize()
+    processBatch(pending[:size])
+    pending = pending[size:]
+
+
+def processBatch(filenames):
+  """Process and upload a batch of files, deleting the ones that have been processed as completely as they will ever
+  be.  Each file stays locked until its batch is sent, so no other uploader sends it too."""
+  locked = []
+  reports = []
+  sentFiles = []
+  done = []
+  try:
+    for filename in filenames:
+      try:
+        f = open(filename, 'r+')
+      except IOError:
+        # Sent and deleted by another uploader.
+        continue
+      try:
+        # make sure we're alone on that file
+        fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except IOError:
+        f.close()
+        continue
+      locked.append(f)
+
+      try:
+        result = readFile(filename, f)
+      except Exception, e: #pylint:disable=W0703
+        print >> sys.stderr, e
+        result = None
+      if result is None:
+        done.append(filename) # so this bogus file gets deleted
+      else:
+        reports.append(result)
+        sentFiles.append(filename)
+
+    if reports:
+      description = sentFiles[0] if len(sentFiles) == 1 else '%s and %d more' % (sentFiles[0], len(sentFiles) - 1)
+      try:
+        if sendReports(reports, description):
+          done.extend(sentFiles)
+      except Exception, e: #pylint:disable=W0703
+        print >> sys.stderr, e
+        done.extend(sentFiles)
+
+    for filename in done:
+      os.unlink(filename)
+  finally:
+    for f in locked:
+      fcntl.lockf(f, fcntl.LOCK_UN)
+      f.close()
+
+
+def readFile(filename, f):
+  """Reads the exception in a file.  Returns None if the file is not valid JSON."""
+  try:
+    result = json.load(f)
+  except ValueError, ex:
+    print >> sys.stderr, "Could not read %s:" % filename
+    print >> sys.stderr, '\n"""'
+    f.seek(0)
+    print >> sys.stderr, f.read()
+    print >> sys.stderr, '"""\n'
+    print >> sys.stderr, str(ex)
+    return None
+  st = os.stat(filename)
+  result['timestamp'] = st.st_ctime
+  trimDict(result)
+  return result
+
+
+
+def readOffset(offsetFile):
+  """Reads the committed offset of a segment."""
+  offsetFile.seek(0)
+  value = offsetFile.read().strip()
+  return int(value) if value else 0
+
+
+def commitOffset(offsetFile, offset):
+  """Records that every record before offset has been sent."""
+  offsetFile.seek(0)
+  offsetFile.truncate()
+  offsetFile.write(str(offset))
+  offsetFile.flush()
+
+
+def processSegments(segments, endTime):
+  """Send the records in each segment file to GEC, deleting segments that are complete."""
+  for filename in segments:
     if time.time() > endTime:
       return
     if not os.path.exists(filename):
       continue
     try:
-      if processFile(filename):
-        os.unlink(filename)
+      processSegment(filename, endTime)
     except Exception, e: #pylint:disable=W0703
+      print >> sys.stderr, 'Error processing segment %s' % filename
       print >> sys.stderr, e
-      os.unlink(filename)
 
 
-def processFile(filename):
-  """Process and upload a file.
-  Return True if the file has been processed as completely as it will ever be and can be deleted"""
-
-  with open(filename, 'r+') as f:
+def processSegment(filename, endTime):
+  """Send the unsent records of a segment.  The writer holds a lock on the segment while appending to it, so if we can
+  get that lock the segment is complete and can be deleted once fully sent."""
+  offsetFilename = filename + spool.OFFSET_SUFFIX
+  with open(offsetFilename, 'a+') as offsetFile:
     try:
-      # make sure we're alone on that file
-      fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      # make sure we're the only uploader working on this segment
+      fcntl.lockf(offsetFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
     except IOError:
-      return False
+      return
 
+    with open(filename, 'r+b') as f:
+      try:
+        fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        complete = True
+      except IOError:
+        complete = False
+
+      offset = readOffset(offsetFile)
+      size = os.fstat(f.fileno()).st_size
+      exhausted = True
+      if offset < size:
+        buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+          exhausted = sendRecords(buf, offset, filename, endTime, offsetFile)
+        finally:
+          buf.close()
+
+      if complete and exhausted:
+        # Anything left over is a partial record from a writer that died mid-write.
+        os.unlink(filename)
+        os.unlink(offsetFilename)
+
+
+def sendRecords(buf, offset, filename, endTime, offsetFile):
+  """Send each complete record in buf starting at offset, committing the offset after each batch.  Returns True if
+  every complete record was sent."""
+  timestamp = os.stat(filename).st_mtime
+  batch = []
+  for record, end in spool.iterRecords(buf, offset):
+    if time.time() > endTime:
+      return False
     try:
-      result = json.load(f)
-      st = os.stat(filename)
-      result['timestamp'] = st.st_ctime
-      trimDict(result)
-      return sendException(result, filename)
+      result = json.loads(record)
     except ValueError, ex:
-      print >> sys.stderr, "Could not read %s:" % filename
-      print >> sys.stderr, '\n"""'
-      f.seek(0)
-      print >> sys.stderr, f.read()
-      print >> sys.stderr, '"""\n'
+      print >> sys.stderr, 'Could not read record at offset %d of %s:' % (offset, filename)
       print >> sys.stderr, str(ex)
-      return True # so this bogus file gets deleted
-    finally:
-      fcntl.lockf(f, fcntl.LOCK_UN)
+    else:
+      result.setdefault('timestamp', timestamp)
+      trimDict(result)
+      batch.append(result)
+    offset = end
+    if len(batch) >= batchSize():
+      if not sendReports(batch, filename):
+        return False
+      batch = []
+    if not batch:
+      commitOffset(offsetFile, offset)
+
+  if batch:
+    if not sendReports(batch, filename):
+      return False
+    commitOffset(offsetFile, offset)
+  return True
+
+
+def countUnsent(filename):
+  """Counts the complete records of a segment that have not been sent yet."""
+  try:
+    try:
+      with open(filename + spool.OFFSET_SUFFIX) as offsetFile:
+        offset = readOffset(offsetFile)
+    except IOError:
+      offset = 0
+    with open(filename, 'rb') as f:
+      size = os.fstat(f.fileno()).st_size
+      if offset >= size:
+        return 0
+      buf = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+      try:
+        return sum(1 for _ in spool.iterRecords(buf, offset))
+      finally:
+        buf.close()
+  except (IOError, OSError, ValueError):
+    # Uploaded and deleted while we were looking.
+    return 0
 
 
-        
 def alarmHandler(_, frame):
   """SIGALRM handler"""
   print >> sys.stderr, "Maximum run time reached after processing %s of %s exceptions. Exiting." \
@@ -164,11 +505,15 @@ LOCKNAME defaults to 'upload-lock'"""
   signal.signal(signal.SIGALRM, alarmHandler)
   signal.alarm(int(MAX_RUN_TIME * 1.1))
 
-  files = [os.path.join(path, f) for f in os.listdir(path) if f.endswith(".gec.json")]
+  names = os.listdir(path)
+  files = [os.path.join(path, f) for f in names if f.endswith(".gec.json")]
+  segments = sorted(os.path.join(path, f) for f in names if f.endswith(spool.SEGMENT_SUFFIX))
 
   global DOCUMENTS_TOTAL                # pylint: disable=W0603
-  DOCUMENTS_TOTAL = len(files)
-  processFiles(files)
+  DOCUMENTS_TOTAL = len(files) + sum(countUnsent(segment) for segment in segments)
+  endTime = time.time() + MAX_RUN_TIME
+  processSegments(segments, endTime)
+  processFiles(files, endTime)
 
 
 if __name__ == '__main__':
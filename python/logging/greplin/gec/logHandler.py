@@ -14,31 +14,74 @@
 
 """Classes for logging exceptions to files suitable for sending to gec."""
 
+import atexit
+import collections
+import fcntl
 import json
 import os
 import os.path
+import re
 import uuid
 import logging
+import threading
 import time
+import traceback
 import random
 
+from greplin.gec import spool
+
 
 
 class GecHandler(logging.Handler):
-  """Log observer that writes exceptions to json files to be picked up by upload.py."""
+  """Log observer that writes exceptions to json files to be picked up by upload.py.
+
+  If segmentBytes is given, reports are appended to rotating segment files of about that size instead of being
+  written one file per report.  If suppressor is given, it decides which occurrences of a repeated error are written.
+  """
 
 
-  def __init__(self, path, project, environment, serverName, prepareMessage=None):
+  def __init__(self, path, project, environment, serverName, prepareMessage=None, segmentBytes=None,
+               suppressor=None):
     self.__path = path
     self.__project = project
     self.__environment = environment
     self.__serverName = serverName
     self.__prepareMessage = prepareMessage
+    self.__segments = spool.SegmentWriter(path, segmentBytes) if segmentBytes else None
+    self.__suppressor = suppressor
     logging.Handler.__init__(self)
 
 
   def emit(self, item):
     """Emit an error from the given event, if it was an error event."""
+    suppressed = self.checkSuppression(item)
+    if suppressed is not None:
+      self.writeReport(item, suppressed)
+
+
+  def writeReport(self, item, suppressed=0):
+    """Builds and writes the report for the given event."""
+    self.write(json.dumps(self.buildReport(item, suppressed)))
+
+
+  def flushSuppressed(self):
+    """Writes a report for each error whose latest occurrences were suppressed, so their count isn't lost if the
+    error stops occurring.  Each report is of the last occurrence suppressed, counting the ones before it."""
+    if self.__suppressor:
+      for item, count in self.__suppressor.drain():
+        self.writeReport(item, count - 1)
+
+
+  def checkSuppression(self, item):
+    """Returns None if the given event should not be reported, otherwise the number of occurrences of the same error
+    that were suppressed before it."""
+    if not self.__suppressor:
+      return 0
+    return self.__suppressor.check((item.exc_info and item.exc_info[0], item.pathname, item.lineno), item)
+
+
+  def buildReport(self, item, suppressed=0):
+    """Builds the report dict for the given event."""
     if item.exc_info:
       formatted = self.formatException(item)
     else:
@@ -48,17 +91,40 @@ class GecHandler(logging.Handler):
       'environment': self.__environment,
       'serverName': self.__serverName,
       'errorLevel': item.levelname,
+      'timestamp': item.created,
     }
     result.update(formatted)
-    self.write(json.dumps(result))
+    if suppressed:
+      result['context'] = dict(result.get('context') or {}, suppressed=suppressed)
+    return result
 
 
-  def write(self, output):
-    """Write an exception to disk, possibly overwriting a previous one"""
+  def write(self, output, fsync=False):
+    """Write an exception to disk, possibly overwriting a previous one.  If fsync is set, a report file is forced to
+    disk before it is closed; segments are left for sync."""
+    if self.__segments:
+      self.__segments.append(output)
+      return
     filename = os.path.join(self.__path, str(uuid.uuid4()) + '.gec.json')
     if not os.path.exists(filename):
       with open(filename, 'w') as f:
         f.write(output)
+        if fsync:
+          f.flush()
+          os.fsync(f.fileno())
+
+
+  def sync(self):
+    """Forces the current segment to disk, or in per-file mode the directory, so the names of report files written
+    with fsync survive a crash too."""
+    if self.__segments:
+      self.__segments.sync()
+    else:
+      fd = os.open(self.__path, os.O_RDONLY)
+      try:
+        os.fsync(fd)
+      finally:
+        os.close(fd)
 
 
   def formatLogMessage(self, item):
@@ -92,6 +158,14 @@ class GecHandler(logging.Handler):
     return exception
 
 
+  def close(self):
+    """Reports pending suppressed counts and closes the handler and any open segment."""
+    self.flushSuppressed()
+    if self.__segments:
+      self.__segments.close()
+    logging.Handler.close(self)
+
+
   def stop(self):
     """Stop observing log events."""
     logging.getLogger().removeHandler(self)
@@ -99,24 +173,32 @@ class GecHandler(logging.Handler):
 
 
 class GentleGecHandler(GecHandler):
-  """A GEC Handler that conserves disk space by overwriting errors
+  """A GEC Handler that conserves disk space by overwriting errors.  If segmentBytes is given, reports are appended to
+  rotating segments instead, as GecHandler does.
   """
 
   MAX_BASENAME = 10
   MAX_ERRORS = 10000
 
 
-  def __init__(self, path, project, environment, serverName, prepareException=None):
-    GecHandler.__init__(self, path, project, environment, serverName, prepareException)
+  def __init__(self, path, project, environment, serverName, prepareException=None, segmentBytes=None,
+               suppressor=None):
+    GecHandler.__init__(self, path, project, environment, serverName, prepareException, segmentBytes, suppressor)
     self.baseName = random.randint(0, GentleGecHandler.MAX_BASENAME)
     self.errorId = random.randint(0, GentleGecHandler.MAX_ERRORS)
 
 
-  def write(self, output):
+  def write(self, output, fsync=False):
+    if self._GecHandler__segments:
+      GecHandler.write(self, output, fsync)
+      return
     self.errorId = (self.errorId + 1) % GentleGecHandler.MAX_ERRORS
     filename = os.path.join(self._GecHandler__path, '%d-%d.gec.json' % (self.baseName, self.errorId))
     with open(filename, 'w') as f:
       f.write(output)
+      if fsync:
+        f.flush()
+        os.fsync(f.fileno())
 
 
 
@@ -129,8 +211,9 @@ class SpaceAwareGecHandler(GecHandler):
   NO_LOGGING_PC = 0.1
 
 
-  def __init__(self, path, project, environment, serverName, prepareException=None):
-    GecHandler.__init__(self, path, project, environment, serverName, prepareException)
+  def __init__(self, path, project, environment, serverName, prepareException=None, segmentBytes=None,
+               suppressor=None):
+    GecHandler.__init__(self, path, project, environment, serverName, prepareException, segmentBytes, suppressor)
     self.spaceCheckCounter = 0
     self.lastStatus = True
 
@@ -170,7 +253,7 @@ class SpaceAwareGecHandler(GecHandler):
     """
     self.spaceCheckCounter -= 1
     if self.spaceCheckCounter < 0:
-      self.spaceCheckCounter = GentleGecHandler.SPACE_CHECK_COUNTER_MAX
+      self.spaceCheckCounter = self.SPACE_CHECK_COUNTER_MAX
       self.doCheckSpace()
     return self.lastStatus
 
@@ -182,3 +265,329 @@ class SpaceAwareGecHandler(GecHandler):
       GecHandler.emit(self, item)
 
 
+
+class AsyncGecHandler(GecHandler):
+  """A gec log handler that hands reports to a background thread for serialization and writing.
+
+  At most maxQueueSize reports wait to be written.  When the queue is full, overflowPolicy decides what happens:
+  DROP_OLDEST discards the oldest waiting report, DROP_NEW discards the new one, and COUNT_ONLY discards the new one
+  but writes a single report saying how many were discarded once the writer catches up.  If fsync is set, the
+  writer forces each batch of reports to disk before taking the next one: the segment, or each report file and then
+  the directory holding them.
+  """
+
+  DROP_OLDEST = 'dropOldest'
+  DROP_NEW = 'dropNew'
+  COUNT_ONLY = 'countOnly'
+
+  STOP_TIMEOUT = 5
+
+
+  def __init__(self, path, project, environment, serverName, prepareMessage=None, segmentBytes=None,
+               suppressor=None, maxQueueSize=1000, overflowPolicy=DROP_OLDEST, fsync=False):
+    GecHandler.__init__(self, path, project, environment, serverName, prepareMessage, segmentBytes, suppressor)
+    if overflowPolicy not in (self.DROP_OLDEST, self.DROP_NEW, self.COUNT_ONLY):
+      raise ValueError('Unknown overflow policy: %r' % overflowPolicy)
+    self.__maxQueueSize = maxQueueSize
+    self.__overflowPolicy = overflowPolicy
+    self.__fsync = fsync
+    self.__queue = collections.deque()
+    self.__condition = threading.Condition()
+    self.__writing = False
+    self.__stopping = False
+    self.__unreported = 0
+
+    self.written = 0
+    self.dropped = 0
+    self.failed = 0
+    self.maxQueueDepth = 0
+
+    self.__thread = threading.Thread(target=self.__run, name='GecWriter')
+    self.__thread.daemon = True
+    self.__thread.start()
+    atexit.register(self.stop)
+
+
+  def emit(self, item):
+    """Queues a report for the given event, applying the overflow policy if the queue is full."""
+    suppressed = self.checkSuppression(item)
+    if suppressed is None:
+      return
+
+    report = self.buildReport(item, suppressed)
+
+    # Make room and append under one lock, so concurrent emits can't push the queue past maxQueueSize.
+    with self.__condition:
+      if self.__stopping:
+        return
+      if len(self.__queue) >= self.__maxQueueSize:
+        self.dropped += 1
+        if self.__overflowPolicy != self.DROP_OLDEST:
+          if self.__overflowPolicy == self.COUNT_ONLY:
+            self.__unreported += 1
+          return
+        self.__queue.popleft()
+      self.__queue.append(report)
+      self.maxQueueDepth = max(self.maxQueueDepth, len(self.__queue))
+      self.__condition.notify()
+
+
+  def getStats(self):
+    """Returns counters describing the writer."""
+    with self.__condition:
+      return {
+        'queueDepth': len(self.__queue),
+        'maxQueueDepth': self.maxQueueDepth,
+        'written': self.written,
+        'dropped': self.dropped,
+        'failed': self.failed,
+      }
+
+
+  def overflowReport(self, count):
+    """Builds a report saying how many reports were discarded."""
+    return self.buildReport(logging.makeLogRecord({
+      'module': 'greplin.gec.logging.logHandler',
+      'levelno': logging.ERROR,
+      'levelname': 'ERROR',
+      'lineno': 0,
+      'pathname': __file__,
+      'funcName': 'emit',
+      'msg': 'Discarded %d gec reports because the write queue was full' % count,
+    }))
+
+
+  def __run(self):
+    """Writes queued reports until stopped, then writes whatever is left."""
+    while True:
+      with self.__condition:
+        while not self.__queue and not self.__unreported and not self.__stopping:
+          self.__condition.wait()
+        if not self.__queue and not self.__unreported:
+          return
+        batch = list(self.__queue)
+        self.__queue.clear()
+        unreported, self.__unreported = self.__unreported, 0
+        self.__writing = True
+
+      if unreported:
+        batch.append(self.overflowReport(unreported))
+      for report in batch:
+        try:
+          self.write(json.dumps(report), self.__fsync)
+          self.written += 1
+        except Exception: # pylint: disable=W0703
+          self.failed += 1
+          if logging.raiseExceptions:
+            traceback.print_exc()
+      if self.__fsync:
+        try:
+          self.sync()
+        except (IOError, OSError):
+          self.failed += 1
+
+      with self.__condition:
+        self.__writing = False
+        self.__condition.notify_all()
+
+
+  def flush(self):
+    """Waits for every queued report to be written."""
+    with self.__condition:
+      while (self.__queue or self.__unreported or self.__writing) and self.__thread.is_alive():
+        self.__condition.wait(0.1)
+
+
+  def stop(self, timeout=STOP_TIMEOUT):
+    """Stop observing log events and wait for queued reports to be written."""
+    GecHandler.stop(self)
+    with self.__condition:
+      self.__stopping = True
+      self.__condition.notify_all()
+    self.__thread.join(timeout)
+
+
+  def close(self):
+    """Stops the writer and closes the handler."""
+    self.stop()
+    if not self.__thread.is_alive():
+      GecHandler.close(self)
+    else:
+      logging.Handler.close(self)
+
+
+
+class BudgetedGecHandler(GecHandler):
+  """A gec log handler that keeps its spool directory under maxBytes and maxFiles.
+
+  Usage is tracked in memory as reports are written, so emitting never touches the filesystem beyond writing the
+  report itself.  A background thread rescans the directory every scanInterval seconds - or as soon as the budget
+  is exceeded - to account for reports that upload.py has sent, and evicts the lowest priority, oldest reports until
+  the directory is back under budget.  While over budget, reports no more important than the least important one on
+  disk are dropped.
+
+  Reports are always written one file per report, named with a '.level<N>' marker so that the scan can tell their
+  priority, so this handler takes no segmentBytes.  Files from other handlers, and segments, are treated as errors.
+  A segment is only evicted once no writer or uploader holds its lock, and segments written by this process are never
+  evicted, since its own locks would not keep them safe.
+  """
+
+  SCAN_INTERVAL = 60
+
+  REPORT_NAME = re.compile(r'\.level(\d+)\.gec\.json$')
+
+
+  def __init__(self, path, project, environment, serverName, prepareMessage=None, suppressor=None,
+               maxBytes=None, maxFiles=None, scanInterval=SCAN_INTERVAL):
+    GecHandler.__init__(self, path, project, environment, serverName, prepareMessage, suppressor=suppressor)
+    self.__path = path
+    self.__maxBytes = maxBytes
+    self.__maxFiles = maxFiles
+    self.__scanInterval = scanInterval
+    self.__lock = threading.Lock()
+    self.__bytes = 0
+    self.__files = 0
+    self.__writtenBytes = 0
+    self.__writtenFiles = 0
+    self.__minPriority = None
+    self.__scanNow = threading.Event()
+    self.__stopping = False
+
+    self.dropped = 0
+    self.evicted = 0
+
+    self.__scan()
+    self.__thread = threading.Thread(target=self.__run, name='GecSpoolScanner')
+    self.__thread.daemon = True
+    self.__thread.start()
+
+
+  def __overBudget(self, size):
+    """Returns whether writing size more bytes would put the spool over budget."""
+    return ((self.__maxBytes is not None and self.__bytes + size > self.__maxBytes) or
+            (self.__maxFiles is not None and self.__files + 1 > self.__maxFiles))
+
+
+  def writeReport(self, item, suppressed=0):
+    """Writes the report for the given event if the spool has room for it, or if it outranks something on disk."""
+    output = json.dumps(self.buildReport(item, suppressed))
+
+    with self.__lock:
+      if self.__overBudget(len(output)):
+        self.__scanNow.set()
+        if self.__minPriority is None or item.levelno <= self.__minPriority:
+          self.dropped += 1
+          return
+      self.__bytes += len(output)
+      self.__files += 1
+      self.__writtenBytes += len(output)
+      self.__writtenFiles += 1
+      if self.__minPriority is None or item.levelno < self.__minPriority:
+        self.__minPriority = item.levelno
+
+    filename = os.path.join(self.__path, '%s.level%d.gec.json' % (uuid.uuid4(), item.levelno))
+    with open(filename, 'w') as f:
+      f.write(output)
+
+
+  def getStats(self):
+    """Returns counters describing the spool."""
+    with self.__lock:
+      return {
+        'bytes': self.__bytes,
+        'files': self.__files,
+        'dropped': self.dropped,
+        'evicted': self.evicted,
+      }
+
+
+  def __scan(self):
+    """Measures the spool directory and evicts reports until it is under budget."""
+    with self.__lock:
+      writtenBytes, writtenFiles = self.__writtenBytes, self.__writtenFiles
+
+    ownSegment = '-%d-' % os.getpid()
+    reports = []
+    totalBytes = 0
+    totalFiles = 0
+    for name in os.listdir(self.__path):
+      if not (name.endswith('.gec.json') or name.endswith(spool.SEGMENT_SUFFIX)):
+        continue
+      filename = os.path.join(self.__path, name)
+      try:
+        stat = os.stat(filename)
+      except OSError:
+        continue # Uploaded while we were looking.
+      totalBytes += stat.st_size
+      totalFiles += 1
+      if name.endswith('.gec.json'):
+        match = self.REPORT_NAME.search(name)
+        priority = int(match.group(1)) if match else logging.ERROR
+        reports.append((priority, stat.st_mtime, filename, stat.st_size))
+      elif ownSegment not in name:
+        reports.append((logging.ERROR, stat.st_mtime, filename, stat.st_size))
+
+    reports.sort(reverse=True)
+    evicted = 0
+    while reports and ((self.__maxBytes is not None and totalBytes > self.__maxBytes) or
+                       (self.__maxFiles is not None and totalFiles > self.__maxFiles)):
+      _, _, filename, size = reports.pop()
+      if self.__evict(filename):
+        evicted += 1
+        totalBytes -= size
+        totalFiles -= 1
+
+    with self.__lock:
+      # Reports written while we were scanning may or may not have been seen, so count them to be safe.
+      self.__bytes = totalBytes + self.__writtenBytes - writtenBytes
+      self.__files = totalFiles + self.__writtenFiles - writtenFiles
+      self.__minPriority = reports[-1][0] if reports else None
+      self.evicted += evicted
+
+
+  @staticmethod
+  def __evict(filename):
+    """Deletes a report or segment.  Returns False if it is a segment still being written or uploaded."""
+    try:
+      if not filename.endswith(spool.SEGMENT_SUFFIX):
+        try:
+          os.unlink(filename)
+        except OSError:
+          pass # Uploaded while we were looking.
+        return True
+
+      # Take the same locks as upload.py, so a segment is never deleted under its writer or uploader.
+      with open(filename + spool.OFFSET_SUFFIX, 'a+') as offsetFile:
+        fcntl.lockf(offsetFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        if not os.path.exists(filename):
+          # Uploaded while we were looking; don't leave behind the offset file we just opened.
+          os.unlink(filename + spool.OFFSET_SUFFIX)
+          return True
+        with open(filename, 'r+b') as f:
+          fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+          os.unlink(filename)
+          os.unlink(filename + spool.OFFSET_SUFFIX)
+      return True
+    except (IOError, OSError):
+      return False
+
+
+  def __run(self):
+    """Rescans the spool until stopped."""
+    while not self.__stopping:
+      self.__scanNow.wait(self.__scanInterval)
+      self.__scanNow.clear()
+      if self.__stopping:
+        return
+      try:
+        self.__scan()
+      except (IOError, OSError):
+        if logging.raiseExceptions:
+          traceback.print_exc()
+
+
+  def close(self):
+    """Stops the scanner and closes the handler."""
+    self.__stopping = True
+    self.__scanNow.set()
+    GecHandler.close(self)
@@ -0,0 +1,124 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Append-only segment files for gec reports.
+
+A segment is a sequence of records, each a 4 byte big endian length followed by that many bytes of JSON.  The
+process writing a segment holds an exclusive lock on it for as long as it is appending, so upload.py treats an
+unlocked segment as complete and deletes it once every record has been sent.
+
+Each record is appended with a single write of its header and body, and a short write is cut off rather than retried,
+so a segment never holds a torn or repeated record.  upload.py reads segments with the constants and iterRecords here.
+"""
+
+import errno
+import fcntl
+import os
+import os.path
+import struct
+import uuid
+
+
+SEGMENT_SUFFIX = '.gec.seg'
+
+OFFSET_SUFFIX = '.offset'
+
+RECORD_HEADER = struct.Struct('>I')
+
+
+def iterRecords(buf, offset=0):
+  """Yields (record, end) for each complete record in buf starting at offset, where end is the offset just past the
+  record.  Stops at the first incomplete record."""
+  while offset + RECORD_HEADER.size <= len(buf):
+    length, = RECORD_HEADER.unpack(buf[offset:offset + RECORD_HEADER.size])
+    end = offset + RECORD_HEADER.size + length
+    if end > len(buf):
+      return
+    yield buf[offset + RECORD_HEADER.size:end], end
+    offset = end
+
+
+
+class SegmentWriter(object):
+  """Appends length prefixed records to rotating segment files in a directory."""
+
+  DEFAULT_SEGMENT_BYTES = 4 * 1024 * 1024
+
+
+  def __init__(self, path, maxSegmentBytes=None):
+    self.__path = path
+    self.__maxSegmentBytes = maxSegmentBytes or SegmentWriter.DEFAULT_SEGMENT_BYTES
+    self.__fd = None
+    self.__size = 0
+    self.__pid = None
+    self.__sequence = 0
+    self.__prefix = uuid.uuid4().hex[:12]
+
+
+  def __open(self):
+    """Opens a new, locked segment.  The file is locked before it gets its final name so upload.py never sees it
+    unlocked and empty."""
+    self.__sequence += 1
+    self.__pid = os.getpid()
+    filename = os.path.join(self.__path, '%s-%d-%d%s' % (self.__prefix, self.__pid, self.__sequence, SEGMENT_SUFFIX))
+    fd = os.open(filename + '.tmp', os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    fcntl.lockf(fd, fcntl.LOCK_EX)
+    os.rename(filename + '.tmp', filename)
+    self.__fd = fd
+    self.__size = 0
+
+
+  def append(self, data):
+    """Appends a single record, rotating to a new segment when the current one is full.  Raises IOError if the record
+    could not be written whole, in which case none of it is kept."""
+    if not isinstance(data, bytes):
+      data = data.encode('utf-8')
+    if self.__fd is not None and self.__pid != os.getpid():
+      # We were forked - the lock stayed with our parent, so leave its segment alone.
+      self.__fd = None
+    if self.__fd is None or self.__size >= self.__maxSegmentBytes:
+      self.close()
+      self.__open()
+
+    record = RECORD_HEADER.pack(len(data)) + data
+    while True:
+      try:
+        written = os.write(self.__fd, record)
+        break
+      except OSError as e:
+        # Interrupted before anything was written, so writing again can't repeat any of the record.
+        if e.errno != errno.EINTR:
+          raise
+    if written != len(record):
+      # A partial record would be read as garbage along with every record after it.
+      os.ftruncate(self.__fd, self.__size)
+      raise IOError('Wrote %d of %d bytes of a gec record' % (written, len(record)))
+    self.__size += len(record)
+    return len(record)
+
+
+  def sync(self):
+    """Forces the current segment to disk."""
+    if self.__fd is not None:
+      os.fsync(self.__fd)
+
+
+  def close(self):
+    """Closes the current segment, which makes it eligible for deletion once uploaded."""
+    if self.__fd is not None:
+      try:
+        fcntl.lockf(self.__fd, fcntl.LOCK_UN)
+      finally:
+        os.close(self.__fd)
+        self.__fd = None
@@ -0,0 +1,82 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Rate limiting and duplicate suppression for gec reports."""
+
+import collections
+import threading
+import time
+
+
+
+class Suppressor(object):
+  """Limits how often reports with the same fingerprint are written.
+
+  Each fingerprint gets a token bucket holding up to burst reports and refilling at one report per window seconds.
+  Occurrences that find the bucket empty are suppressed and counted, and the next occurrence let through carries that
+  count, so a hot loop produces one report per window saying how many times it happened in between.
+
+  Only the maxFingerprints most recently seen fingerprints are tracked; the suppressed count of a fingerprint that
+  falls out is lost.  When a storm simply stops, no occurrence comes along to carry its count, so handlers call drain
+  as they close to report what is still pending.
+  """
+
+  MAX_FINGERPRINTS = 1000
+
+
+  def __init__(self, window=60, burst=5, maxFingerprints=MAX_FINGERPRINTS, clock=time.time):
+    self.__rate = 1.0 / window
+    self.__burst = burst
+    self.__maxFingerprints = maxFingerprints
+    self.__clock = clock
+    self.__buckets = collections.OrderedDict()
+    self.__lock = threading.Lock()
+
+
+  def check(self, fingerprint, occurrence=None):
+    """Records an occurrence of fingerprint.  Returns None if it should be suppressed, otherwise the number of
+    occurrences suppressed since the last one that was let through.  The last suppressed occurrence is kept for
+    drain."""
+    now = self.__clock()
+    with self.__lock:
+      bucket = self.__buckets.pop(fingerprint, None)
+      if bucket is None:
+        bucket = [self.__burst, now, 0, None]
+        if len(self.__buckets) >= self.__maxFingerprints:
+          self.__buckets.popitem(last=False)
+      self.__buckets[fingerprint] = bucket
+
+      tokens = min(self.__burst, bucket[0] + (now - bucket[1]) * self.__rate)
+      bucket[1] = now
+      if tokens < 1:
+        bucket[0] = tokens
+        bucket[2] += 1
+        bucket[3] = occurrence
+        return None
+
+      bucket[0] = tokens - 1
+      suppressed, bucket[2], bucket[3] = bucket[2], 0, None
+      return suppressed
+
+
+  def drain(self):
+    """Returns (occurrence, count) for each fingerprint with suppressed occurrences, where occurrence is the last one
+    suppressed, and forgets those counts."""
+    with self.__lock:
+      result = []
+      for bucket in self.__buckets.values():
+        if bucket[2] and bucket[3] is not None:
+          result.append((bucket[3], bucket[2]))
+          bucket[2], bucket[3] = 0, None
+      return result
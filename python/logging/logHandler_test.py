@@ -0,0 +1,261 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the logging handlers."""
+
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from greplin.gec import logHandler, suppression
+
+
+def makeRecord(message, level=logging.ERROR, lineno=1):
+  """Creates a log record without an exception."""
+  return logging.makeLogRecord({
+    'msg': message,
+    'levelname': logging.getLevelName(level),
+    'levelno': level,
+    'module': 'logHandler_test',
+    'lineno': lineno,
+    'pathname': __file__,
+  })
+
+
+
+def readReports(directory):
+  """Returns the reports written to files in the directory, by message."""
+  reports = []
+  for name in os.listdir(directory):
+    with open(os.path.join(directory, name)) as f:
+      reports.append(json.load(f))
+  return sorted(reports, key=lambda report: report['message'])
+
+
+
+class GecHandlerTestCase(unittest.TestCase):
+  """Tests for the handler that writes a file per report."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.now = 1000.0
+
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+
+  def testSuppressedCounts(self):
+    """Test that a suppressed count is carried on the next report let through, and what is pending when the handler
+    closes is written as a report of the last occurrence suppressed."""
+    suppressor = suppression.Suppressor(window=10, burst=1, clock=lambda: self.now)
+    handler = logHandler.GecHandler(self.directory, 'project', 'env', 'server', suppressor=suppressor)
+    for i in range(4):
+      handler.emit(makeRecord('m%d' % i))
+    self.assertEqual(['m0'], [report['message'] for report in readReports(self.directory)])
+
+    self.now += 10
+    for i in range(4, 7):
+      handler.emit(makeRecord('m%d' % i))
+    handler.emit(makeRecord('elsewhere', lineno=2))
+    handler.close()
+    self.assertEqual([('elsewhere', None), ('m0', None), ('m4', {'suppressed': 3}), ('m6', {'suppressed': 1})],
+                     [(report['message'], report.get('context')) for report in readReports(self.directory)])
+
+
+
+class BlockingAsyncGecHandler(logHandler.AsyncGecHandler):
+  """An async handler whose writer keeps reports in memory, and waits to be unblocked before writing each one."""
+
+  def __init__(self, *args, **kwargs):
+    self.unblock = threading.Event()
+    self.reports = []
+    logHandler.AsyncGecHandler.__init__(self, *args, **kwargs)
+
+
+  def write(self, output, fsync=False):
+    self.unblock.wait()
+    self.reports.append(json.loads(output))
+
+
+
+class AsyncGecHandlerTestCase(unittest.TestCase):
+  """Tests for the handler that writes from a background thread."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.handlers = []
+
+
+  def tearDown(self):
+    for handler in self.handlers:
+      handler.unblock.set()
+      handler.stop()
+    shutil.rmtree(self.directory)
+
+
+  def blockedHandler(self, **kwargs):
+    """Returns a handler whose writer is blocked writing a first report, so later reports wait in the queue."""
+    handler = BlockingAsyncGecHandler(self.directory, 'project', 'env', 'server', **kwargs)
+    self.handlers.append(handler)
+    handler.emit(makeRecord('blocker'))
+    deadline = time.time() + 5
+    while handler.getStats()['queueDepth'] and time.time() < deadline:
+      time.sleep(0.001)
+    self.assertEqual(0, handler.getStats()['queueDepth'])
+    return handler
+
+
+  def written(self, handler):
+    """Releases the writer, waits for every report and returns their messages."""
+    handler.unblock.set()
+    handler.stop()
+    return [report['message'] for report in handler.reports]
+
+
+  def testDropOldest(self):
+    """Test that a full queue discards its oldest report for a new one."""
+    handler = self.blockedHandler(maxQueueSize=3, overflowPolicy=logHandler.AsyncGecHandler.DROP_OLDEST)
+    for i in range(5):
+      handler.emit(makeRecord('m%d' % i))
+    self.assertEqual({'queueDepth': 3, 'maxQueueDepth': 3, 'written': 0, 'dropped': 2, 'failed': 0},
+                     handler.getStats())
+    self.assertEqual(['blocker', 'm2', 'm3', 'm4'], self.written(handler))
+    self.assertEqual(4, handler.getStats()['written'])
+
+
+  def testDropNew(self):
+    """Test that a full queue discards new reports."""
+    handler = self.blockedHandler(maxQueueSize=3, overflowPolicy=logHandler.AsyncGecHandler.DROP_NEW)
+    for i in range(5):
+      handler.emit(makeRecord('m%d' % i))
+    self.assertEqual(2, handler.getStats()['dropped'])
+    self.assertEqual(['blocker', 'm0', 'm1', 'm2'], self.written(handler))
+
+
+  def testCountOnly(self):
+    """Test that a full queue discards new reports and writes one report counting them."""
+    handler = self.blockedHandler(maxQueueSize=3, overflowPolicy=logHandler.AsyncGecHandler.COUNT_ONLY)
+    for i in range(5):
+      handler.emit(makeRecord('m%d' % i))
+    self.assertEqual(['blocker', 'm0', 'm1', 'm2', 'Discarded 2 gec reports because the write queue was full'],
+                     self.written(handler))
+    self.assertEqual(2, handler.getStats()['dropped'])
+
+
+  def testQueueBoundWithConcurrentEmits(self):
+    """Test that the queue never holds more than maxQueueSize reports however many threads emit at once."""
+    handler = self.blockedHandler(maxQueueSize=5)
+    threads = [threading.Thread(target=lambda: [handler.emit(makeRecord('m')) for _ in range(200)])
+               for _ in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    stats = handler.getStats()
+    self.assertEqual(5, stats['maxQueueDepth'])
+    self.assertEqual(5, stats['queueDepth'])
+    self.assertEqual(8 * 200 - 5, stats['dropped'])
+
+
+  def testStopDrainsQueue(self):
+    """Test that stopping writes every queued report, and reports emitted afterwards are ignored."""
+    handler = self.blockedHandler(maxQueueSize=100)
+    for i in range(50):
+      handler.emit(makeRecord('m%d' % i))
+    self.assertEqual(['blocker'] + ['m%d' % i for i in range(50)], self.written(handler))
+    handler.emit(makeRecord('late'))
+    self.assertEqual(51, len(handler.reports))
+    self.assertEqual(0, handler.getStats()['queueDepth'])
+    self.assertEqual(51, handler.getStats()['written'])
+
+
+  def testUnknownPolicy(self):
+    """Test that an unknown overflow policy is rejected."""
+    self.assertRaises(ValueError, logHandler.AsyncGecHandler, self.directory, 'project', 'env', 'server',
+                      overflowPolicy='dropSome')
+
+
+
+class BudgetedGecHandlerTestCase(unittest.TestCase):
+  """Tests for the handler that keeps its spool directory under budget."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.handlers = []
+
+
+  def tearDown(self):
+    for handler in self.handlers:
+      handler.close()
+    shutil.rmtree(self.directory)
+
+
+  def handler(self, **kwargs):
+    """Returns a handler on the directory that only rescans when over budget."""
+    handler = logHandler.BudgetedGecHandler(self.directory, 'project', 'env', 'server', scanInterval=3600, **kwargs)
+    self.handlers.append(handler)
+    return handler
+
+
+  def spool(self, name, size, age):
+    """Writes a report file of the given size, last modified age seconds ago."""
+    filename = os.path.join(self.directory, name)
+    with open(filename, 'w') as f:
+      f.write('x' * size)
+    modified = time.time() - age
+    os.utime(filename, (modified, modified))
+
+
+  def testEvictsLowestLevelOldest(self):
+    """Test that the scan evicts the lowest level reports first, oldest first within a level, counting reports
+    without a level as errors."""
+    self.spool('a.level30.gec.json', 10, 100)
+    self.spool('b.level30.gec.json', 10, 200)
+    self.spool('c.level40.gec.json', 10, 300)
+    self.spool('d.gec.json', 10, 400)
+    self.spool('e.level50.gec.json', 10, 500)
+    self.spool('unrelated.txt', 10, 600)
+    handler = self.handler(maxFiles=2)
+    self.assertEqual(['c.level40.gec.json', 'e.level50.gec.json', 'unrelated.txt'], sorted(os.listdir(self.directory)))
+    self.assertEqual({'bytes': 20, 'files': 2, 'dropped': 0, 'evicted': 3}, handler.getStats())
+
+
+  def testByteBudget(self):
+    """Test that the scan evicts until the spool is under maxBytes, and a report that doesn't fit is dropped unless it
+    outranks something on disk."""
+    self.spool('a.level40.gec.json', 1000, 200)
+    self.spool('b.level40.gec.json', 1000, 100)
+    self.spool('c.level40.gec.json', 1000, 0)
+    handler = self.handler(maxBytes=2100)
+    self.assertEqual(['b.level40.gec.json', 'c.level40.gec.json'], sorted(os.listdir(self.directory)))
+
+    handler.emit(makeRecord('error'))
+    handler.emit(makeRecord('warning', logging.WARNING))
+    self.assertEqual({'bytes': 2000, 'files': 2, 'dropped': 2, 'evicted': 1}, handler.getStats())
+
+    # A critical report is written, and makes room for itself by evicting the oldest error.
+    handler.emit(makeRecord('critical', logging.CRITICAL))
+    deadline = time.time() + 5
+    while handler.getStats()['evicted'] < 2 and time.time() < deadline:
+      time.sleep(0.001)
+    self.assertEqual(['c.level40.gec.json', 'critical'],
+                     sorted('critical' if name.endswith('.level50.gec.json') else name
+                            for name in os.listdir(self.directory)))
+    self.assertEqual(2, handler.getStats()['evicted'])
@@ -30,7 +30,9 @@ setup(name='gec-logging-handler',
       packages = [ 'greplin' ],
       namespace_packages = [ 'greplin' ],
       py_modules = [
-        'greplin.gec.logHandler'
+        'greplin.gec.logHandler',
+        'greplin.gec.spool',
+        'greplin.gec.suppression'
       ],
       zip_safe = True
 )
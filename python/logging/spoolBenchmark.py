@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares report writes per second for one-file-per-report and segment spooling.
+
+Usage: spoolBenchmark.py [COUNT] [DIRECTORY]
+"""
+
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+from greplin.gec import logHandler
+
+
+def makeRecord():
+  """Creates a log record carrying an exception."""
+  try:
+    raise ValueError('Something went wrong for user #12345')
+  except ValueError:
+    record = logging.makeLogRecord({
+      'msg': 'Failed to handle request',
+      'levelname': 'ERROR',
+      'levelno': logging.ERROR,
+      'module': 'spoolBenchmark',
+      'lineno': 42,
+      'pathname': __file__,
+      'exc_info': sys.exc_info(),
+    })
+    record.exc_text = logging.Formatter().formatException(record.exc_info)
+    return record
+
+
+def run(name, handler, count):
+  """Emits count records through handler and prints the rate."""
+  record = makeRecord()
+  start = time.time()
+  for _ in range(count):
+    handler.emit(record)
+  handler.close()
+  elapsed = time.time() - start
+  print '%-10s %8d reports in %6.2fs: %10.0f writes/second' % (name, count, elapsed, count / elapsed)
+
+
+def main():
+  """Runs the benchmark."""
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+  parent = sys.argv[2] if len(sys.argv) > 2 else None
+
+  for name, segmentBytes in (('per-file', None), ('segments', 4 * 1024 * 1024)):
+    path = tempfile.mkdtemp(dir=parent)
+    try:
+      run(name, logHandler.GecHandler(path, 'benchmark', 'test', 'localhost', segmentBytes=segmentBytes), count)
+    finally:
+      shutil.rmtree(path)
+
+
+if __name__ == '__main__':
+  main()
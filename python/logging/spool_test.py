@@ -0,0 +1,188 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the segment spool."""
+
+import errno
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from greplin.gec import logHandler, spool
+
+
+# Exits 1 if the segment named by its argument is locked, as upload.py would find it.
+LOCK_CHECK = '''
+import fcntl, sys
+with open(sys.argv[1], 'r+b') as f:
+  try:
+    fcntl.lockf(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except (IOError, OSError):
+    sys.exit(1)
+'''
+
+
+def isLocked(filename):
+  """Returns whether another process holds the lock on a segment."""
+  return subprocess.call([sys.executable, '-c', LOCK_CHECK, filename]) == 1
+
+
+
+class ShortWrite(object):
+  """Stands in for os.write, writing only part of the records given, or failing as interrupted, when told to."""
+
+  def __init__(self):
+    self.write = os.write
+    self.short = 0
+    self.interrupted = 0
+
+
+  def __call__(self, fd, data):
+    if self.interrupted:
+      self.interrupted -= 1
+      raise OSError(errno.EINTR, 'Interrupted system call')
+    if self.short:
+      self.short -= 1
+      return self.write(fd, data[:len(data) // 2])
+    return self.write(fd, data)
+
+
+
+class SpoolTestCase(unittest.TestCase):
+  """Tests for writing and reading segments."""
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.write = ShortWrite()
+    os.write = self.write
+
+
+  def tearDown(self):
+    os.write = self.write.write
+    shutil.rmtree(self.directory)
+
+
+  def segments(self):
+    """Returns the segment files in the directory, oldest first."""
+    names = [name for name in os.listdir(self.directory) if name.endswith(spool.SEGMENT_SUFFIX)]
+    return [os.path.join(self.directory, name)
+            for name in sorted(names, key=lambda name: int(name[:-len(spool.SEGMENT_SUFFIX)].rsplit('-', 1)[1]))]
+
+
+  def records(self, filename):
+    """Returns the records of a segment."""
+    with open(filename, 'rb') as f:
+      return [record.decode('utf-8') for record, _ in spool.iterRecords(f.read())]
+
+
+  def testRoundTrip(self):
+    """Test that records read back as they were appended, across segments."""
+    writer = spool.SegmentWriter(self.directory, 30)
+    records = [u'first', b'second', u'caf\xe9', u'x' * 40, u'last']
+    for record in records:
+      writer.append(record)
+    writer.close()
+    # A segment rotates once it holds at least maxSegmentBytes.
+    self.assertEqual([[u'first', u'second', u'caf\xe9', u'x' * 40], [u'last']],
+                     [self.records(filename) for filename in self.segments()])
+
+
+  def testIterRecordsStopsAtIncompleteRecord(self):
+    """Test that reading stops before a record cut off in its header or body, and can resume from an offset."""
+    records = [b'one', b'', b'three']
+    buf = b''.join(spool.RECORD_HEADER.pack(len(record)) + record for record in records)
+    ends = [7, 11, 20]
+    self.assertEqual(list(zip(records, ends)), list(spool.iterRecords(buf)))
+    self.assertEqual(list(zip(records[1:], ends[1:])), list(spool.iterRecords(buf, ends[0])))
+
+    torn = buf + spool.RECORD_HEADER.pack(10) + b'abc'
+    self.assertEqual(list(zip(records, ends)), list(spool.iterRecords(torn)))
+    self.assertEqual(list(zip(records, ends)), list(spool.iterRecords(buf + b'\x00\x00')))
+    self.assertEqual([], list(spool.iterRecords(torn, len(buf))))
+
+
+  def testShortWriteTruncated(self):
+    """Test that a record written short is cut off, so the records after it still read back."""
+    writer = spool.SegmentWriter(self.directory)
+    writer.append(u'before')
+    self.write.short = 1
+    self.assertRaises(IOError, writer.append, u'torn record')
+    writer.append(u'after')
+    writer.close()
+    self.assertEqual([[u'before', u'after']], [self.records(filename) for filename in self.segments()])
+
+
+  def testInterruptedWriteRetried(self):
+    """Test that a write interrupted before writing anything is tried again, writing the record once."""
+    writer = spool.SegmentWriter(self.directory)
+    self.write.interrupted = 2
+    writer.append(u'record')
+    writer.close()
+    self.assertEqual([[u'record']], [self.records(filename) for filename in self.segments()])
+
+
+  def testLockedWhileOpen(self):
+    """Test that a segment is locked while it is being appended to, and unlocked once closed or rotated."""
+    writer = spool.SegmentWriter(self.directory, 10)
+    writer.append(u'first record')
+    first, = self.segments()
+    self.assertTrue(isLocked(first))
+
+    writer.append(u'second record')
+    self.assertEqual(first, self.segments()[0])
+    self.assertFalse(isLocked(first))
+    self.assertTrue(isLocked(self.segments()[1]))
+
+    writer.close()
+    self.assertFalse(isLocked(self.segments()[1]))
+
+
+  def testForkedWriterOpensOwnSegment(self):
+    """Test that a forked process appends to a segment of its own, leaving its parent's locked segment alone."""
+    writer = spool.SegmentWriter(self.directory)
+    writer.append(u'parent')
+    pid = os.fork()
+    if not pid:
+      try:
+        writer.append(u'child')
+        writer.close()
+      finally:
+        os._exit(0) # pylint: disable=W0212
+    os.waitpid(pid, 0)
+    writer.append(u'parent again')
+
+    parentSegment = [filename for filename in self.segments() if '-%d-' % os.getpid() in filename]
+    childSegment = [filename for filename in self.segments() if '-%d-' % pid in filename]
+    # Check the locks before reading, since closing any file of a segment releases the locks this process holds on it.
+    self.assertTrue(isLocked(parentSegment[0]))
+    self.assertFalse(isLocked(childSegment[0]))
+    writer.close()
+    self.assertEqual([[u'parent', u'parent again']], [self.records(filename) for filename in parentSegment])
+    self.assertEqual([[u'child']], [self.records(filename) for filename in childSegment])
+
+
+  def testGentleHandlerSegments(self):
+    """Test that the gentle handler appends to segments when given segmentBytes."""
+    handler = logHandler.GentleGecHandler(self.directory, 'project', 'env', 'server', segmentBytes=1024)
+    handler.emit(logging.makeLogRecord({'msg': 'segmented', 'levelname': 'ERROR', 'levelno': logging.ERROR,
+                                        'pathname': __file__, 'lineno': 1, 'module': 'spool_test'}))
+    handler.close()
+    self.assertEqual([[u'segmented']], [[json.loads(record)['message'] for record in self.records(filename)]
+                                        for filename in self.segments()])
+    self.assertEqual(1, len(os.listdir(self.directory)))
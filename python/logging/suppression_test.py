@@ -0,0 +1,105 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for rate limiting and duplicate suppression."""
+
+import unittest
+
+from greplin.gec import suppression
+
+
+
+class FakeClock(object):
+  """A clock that only moves when told to."""
+
+  def __init__(self):
+    self.now = 1000.0
+
+
+  def __call__(self):
+    return self.now
+
+
+
+class SuppressorTestCase(unittest.TestCase):
+  """Tests for the token bucket suppressor."""
+
+  def setUp(self):
+    self.clock = FakeClock()
+
+
+  def suppressor(self, **kwargs):
+    """Returns a suppressor on the fake clock."""
+    return suppression.Suppressor(clock=self.clock, **kwargs)
+
+
+  def testBurst(self):
+    """Test that burst occurrences are let through before any are suppressed."""
+    suppressor = self.suppressor(window=10, burst=3)
+    self.assertEqual([0, 0, 0, None, None], [suppressor.check('a') for _ in range(5)])
+    self.assertEqual(0, suppressor.check('b'))
+
+
+  def testRefillCarriesSuppressedCount(self):
+    """Test that the bucket refills at one occurrence per window, and the next occurrence let through carries the
+    number suppressed before it."""
+    suppressor = self.suppressor(window=10, burst=1)
+    self.assertEqual(0, suppressor.check('a'))
+    self.assertEqual(None, suppressor.check('a'))
+    self.assertEqual(None, suppressor.check('a'))
+
+    self.clock.now += 10
+    self.assertEqual(2, suppressor.check('a'))
+    self.assertEqual(None, suppressor.check('a'))
+    self.clock.now += 5
+    self.assertEqual(None, suppressor.check('a'))
+    self.clock.now += 5
+    self.assertEqual(2, suppressor.check('a'))
+
+
+  def testRefillCappedAtBurst(self):
+    """Test that a long quiet spell refills no more than burst occurrences."""
+    suppressor = self.suppressor(window=10, burst=2)
+    suppressor.check('a')
+    suppressor.check('a')
+    self.clock.now += 1000
+    self.assertEqual([0, 0, None], [suppressor.check('a') for _ in range(3)])
+
+
+  def testEvictsLeastRecentlySeen(self):
+    """Test that only maxFingerprints are tracked, forgetting the least recently seen and its suppressed count."""
+    suppressor = self.suppressor(window=10, burst=1, maxFingerprints=2)
+    for fingerprint in ('a', 'a', 'b', 'b', 'a'):
+      suppressor.check(fingerprint)
+    # 'b' is now the least recently seen, so 'c' pushes it out.
+    self.assertEqual(0, suppressor.check('c'))
+    self.assertEqual(0, suppressor.check('b'))
+    # 'b' pushed out 'a', so it starts over with a full bucket and no count.
+    self.assertEqual(0, suppressor.check('a'))
+    self.assertEqual([], [count for _, count in suppressor.drain()])
+
+
+  def testDrain(self):
+    """Test that drain returns the last suppressed occurrence and count of each fingerprint, and forgets them."""
+    suppressor = self.suppressor(window=10, burst=1)
+    for i in range(4):
+      suppressor.check('a', 'a%d' % i)
+    suppressor.check('b', 'b0')
+    suppressor.check('b', 'b1')
+    suppressor.check('c', 'c0')
+    self.assertEqual([('a3', 3), ('b1', 1)], sorted(suppressor.drain()))
+    self.assertEqual([], suppressor.drain())
+
+    self.clock.now += 10
+    self.assertEqual(0, suppressor.check('a'))
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Measures how much reactor time each logged failure costs, and how long until its report is written.
+
+The observers run on a running reactor, so the threaded observers buffer on the reactor thread and flush through their
+writer thread as they would in a server.  The reactor column is the time spent emitting; the written column is the time
+from the first emit until every report is on disk.
+
+Usage: captureBenchmark.py [COUNT] [STACK_DEPTH]
+"""
+
+import shutil
+import sys
+import tempfile
+import time
+
+from twisted.internet import defer, reactor, task
+from twisted.python import failure
+
+from greplin.gec import twistedLog
+
+
+def makeEvent(index):
+  """Creates a log event carrying a failure with a short traceback."""
+  try:
+    raise ValueError('Something went wrong for user #%d' % index)
+  except ValueError:
+    return {'failure': failure.Failure(), 'why': 'Failed to handle request', 'time': time.time(), 'isError': 1}
+
+
+def emitAtDepth(observer, events, depth):
+  """Emits every event from depth frames down, since loggedFrom captures the caller's whole stack."""
+  if depth:
+    return emitAtDepth(observer, events, depth - 1)
+  start = time.time()
+  for event in events:
+    observer.emit(event)
+  return time.time() - start
+
+
+@defer.inlineCallbacks
+def run(name, observerClass, count, depth, **kwargs):
+  """Emits count failures through a new observer, waits until their reports are written and prints the cost of each."""
+  path = tempfile.mkdtemp()
+  observer = observerClass(path, 'benchmark', 'test', 'localhost', **kwargs)
+  observer.start()
+  try:
+    events = [makeEvent(i) for i in range(count)]
+    start = time.time()
+    elapsed = emitAtDepth(observer, events, depth)
+    # Observers without a writer thread have written every report by the time emit returns.
+    while getattr(observer, 'written', count) < count:
+      yield task.deferLater(reactor, 0.001, lambda: None)
+    total = time.time() - start
+    print '%-40s %10.1f %10.1f' % (name, elapsed * 1000000 / count, total * 1000000 / count)
+  finally:
+    observer.stop()
+    shutil.rmtree(path)
+
+
+@defer.inlineCallbacks
+def runAll(count, depth):
+  """Runs each observer in turn, then stops the reactor."""
+  try:
+    print '%-40s %10s %10s' % ('microseconds/failure', 'reactor', 'written')
+    yield run('GecLogObserver', twistedLog.GecLogObserver, count, depth)
+    # Flush straight away, so the written column measures writing rather than waiting for the flush delay.
+    yield run('ThreadedGecLogObserver', twistedLog.ThreadedGecLogObserver, count, depth,
+              maxPending=count, flushDelay=0)
+    yield run('ThreadedGecLogObserver, no loggedFrom', twistedLog.ThreadedGecLogObserver, count, depth,
+              maxPending=count, flushDelay=0, captureLoggedFrom=False)
+    yield run('ThreadedGecLogObserver, 10 frames', twistedLog.ThreadedGecLogObserver, count, depth,
+              maxPending=count, flushDelay=0, maxFrames=10)
+  finally:
+    reactor.stop()
+
+
+def main():
+  """Runs the benchmark."""
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  depth = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+
+  reactor.callWhenRunning(runAll, count, depth)
+  reactor.run()
+
+
+if __name__ == '__main__':
+  main()
@@ -14,13 +14,18 @@
 
 """Classes for logging exceptions to files suitable for sending to gec."""
 
+import collections
 import json
 import os.path
-import traceback
+import sys
+import time
 import uuid
 import random
 
-from twisted.python import log, util
+from greplin.gec import spool
+from twisted.internet import threads
+from twisted.python import log, threadable, util
+from twisted.python.threadpool import ThreadPool
 
 try:
   from greplin.defer import context
@@ -30,71 +35,152 @@ except ImportError:
 
 
 
+def _captureStack(maxFrames):
+  """Returns (functionName, filename, lineNumber) for the frames of the current stack, outermost first, without
+  reading any source."""
+  frame = sys._getframe(1) # pylint: disable=W0212
+  frames = []
+  while frame is not None and len(frames) != maxFrames:
+    code = frame.f_code
+    frames.append((code.co_name, code.co_filename, frame.f_lineno))
+    frame = frame.f_back
+  frames.reverse()
+  return frames
+
+
+def _formatFrames(frames):
+  """Formats (functionName, filename, lineNumber) tuples as backtrace lines."""
+  return ['File "%s", line %s, in %s' % (filename, lineNumber, functionName)
+          for functionName, filename, lineNumber in frames]
+
+
+
 class GecLogObserver(object):
-  """Log observer that writes exceptions to json files to be picked up by upload.py."""
+  """Log observer that writes exceptions to json files to be picked up by upload.py.
+
+  If segmentBytes is given, reports are appended to rotating segment files of about that size instead of being
+  written one file per report.  If suppressor is given, it decides which occurrences of a repeated failure are
+  written.  maxFrames limits backtraces to the innermost frames, and captureLoggedFrom=False skips recording the
+  stack the failure was logged from.
+  """
 
   BUILT_IN_KEYS = frozenset(['failure', 'message', 'time', 'why', 'isError', 'system'])
 
 
-  def __init__(self, path, project, environment, serverName):
+  def __init__(self, path, project, environment, serverName, segmentBytes=None, suppressor=None, maxFrames=None,
+               captureLoggedFrom=True):
     self.__path = path
     self.__project = project
     self.__environment = environment
     self.__serverName = serverName
+    self.__segments = spool.SegmentWriter(path, segmentBytes) if segmentBytes else None
+    self.__suppressor = suppressor
+    self.__maxFrames = maxFrames
+    self.__captureLoggedFrom = captureLoggedFrom
+
+
+  def capture(self, eventDict, suppressed=None):
+    """Cheaply captures what is needed to report the given event, or returns None if it was not an error event or
+    was suppressed.  Frames are kept as (functionName, filename, lineNumber) tuples and rendered by renderReport.
+
+    If suppressed is given, the event is one the suppressor held back earlier and is captured carrying that count,
+    without consulting the suppressor or the stack it was logged from, which is gone."""
+    if 'failure' not in eventDict:
+      return None
+
+    failure = eventDict['failure']
+    captureLoggedFrom = self.__captureLoggedFrom and suppressed is None
+    if suppressed is None:
+      suppressed = 0
+      if self.__suppressor:
+        fingerprint = (failure.type, failure.frames and failure.frames[-1][1:3])
+        suppressed = self.__suppressor.check(fingerprint, eventDict)
+        if suppressed is None:
+          return None
+
+    extras = {}
+    for key, value in eventDict.items():
+      if key not in self.BUILT_IN_KEYS:
+        extras[key] = value
+
+    contextValues = context and context.all()
+
+    stack = None
+    if not failure.frames or captureLoggedFrom:
+      stack = _captureStack(self.__maxFrames)
+    if failure.frames:
+      frames = failure.frames[-self.__maxFrames:] if self.__maxFrames else failure.frames
+      frames = [frame[:3] for frame in frames]
+    else:
+      frames = stack
 
+    return {
+      'type': failure.type,
+      'message': str(failure.value),
+      'logMessage': eventDict.get('why'),
+      'frames': frames,
+      'loggedFrom': stack if captureLoggedFrom else None,
+      'extras': extras,
+      'context': contextValues and contextValues.copy(),
+      'timestamp': eventDict.get('time') or time.time(),
+      'suppressed': suppressed
+    }
 
-  def __formatFailure(self, failure, logMessage, extras):
-    """Generates a dict from the given Failure object."""
-
-    parts = ['Traceback (most recent call last):']
-    if not failure.frames:
-      parts += traceback.format_stack()
-    else:
-      for functionName, filename, lineNumber, _, _ in failure.frames:
-        parts.append('File "%s", line %s, in %s' % (filename, lineNumber, functionName))
-    backtrace = '\n'.join(parts)
 
+  def renderReport(self, captured):
+    """Generates a report dict from a capture."""
+    failureType = captured['type']
     result = {
       'project': self.__project,
-      'type': failure.type.__module__ + '.' + failure.type.__name__,
-      'message': str(failure.value),
+      'type': failureType.__module__ + '.' + failureType.__name__,
+      'message': captured['message'],
       'environment': self.__environment,
       'serverName': self.__serverName,
-      'logMessage': logMessage,
-      'backtrace': backtrace,
-      'loggedFrom': '\n'.join(traceback.format_stack())
+      'logMessage': captured['logMessage'],
+      'backtrace': '\n'.join(['Traceback (most recent call last):'] + _formatFrames(captured['frames'])),
+      'timestamp': captured['timestamp']
     }
+    if captured['loggedFrom'] is not None:
+      result['loggedFrom'] = '\n'.join(_formatFrames(captured['loggedFrom']))
 
+    extras = captured['extras']
     if extras and 'level' in extras:
       result['errorLevel'] = extras['level']
       del extras['level']
 
-    if context and context.all():
-      result['context'] = context.all()
+    if captured['context']:
+      result['context'] = captured['context']
       if extras:
-        result['context'] = result['context'].copy()
         result['context'].update(extras)
     elif extras:
       result['context'] = extras
 
+    if captured['suppressed']:
+      result['context'] = dict(result.get('context') or {}, suppressed=captured['suppressed'])
+
     return result
 
 
   def emit(self, eventDict):
     """Emit an error from the given event, if it was an error event."""
-    if 'failure' in eventDict:
-      extras = {}
-      for key, value in eventDict.items():
-        if key not in self.BUILT_IN_KEYS:
-          extras[key] = value
+    result = self.buildReport(eventDict)
+    if result:
+      self.write(json.dumps(result))
 
-      output = json.dumps(self.__formatFailure(eventDict['failure'], eventDict.get('why'), extras))
-      self.write(output)
+
+  def buildReport(self, eventDict):
+    """Builds the report dict for the given event, or returns None if it was not an error event or was suppressed."""
+    captured = self.capture(eventDict)
+    if captured:
+      return self.renderReport(captured)
 
 
   def write(self, output):
     """Write a GEC error report, making sure we do not overwrite an existing one
     """
+    if self.__segments:
+      self.__segments.append(output)
+      return
     while True:
       filename = os.path.join(self.__path, str(uuid.uuid4()) + '.gec.json')
       if not os.path.exists(filename):
@@ -109,30 +195,186 @@ class GecLogObserver(object):
     log.addObserver(self.emit)
 
 
+  def flushSuppressed(self):
+    """Writes a report for each failure whose latest occurrences were suppressed, so their count isn't lost if the
+    failure stops occurring.  Each report is of the last occurrence suppressed, counting the ones before it."""
+    if self.__suppressor:
+      for eventDict, count in self.__suppressor.drain():
+        self.write(json.dumps(self.renderReport(self.capture(eventDict, count - 1))))
+
+
   def stop(self):
-    """Stop observing log events."""
+    """Stop observing log events, reporting pending suppressed counts."""
     log.removeObserver(self.emit)
+    self.flushSuppressed()
+    self.close()
+
+
+  def close(self):
+    """Closes any open segment."""
+    if self.__segments:
+      self.__segments.close()
 
 
 
 class GentleGecLogObserver(GecLogObserver):
-  """A GEC Handler that conserves disk space by overwriting errors."""
+  """A GEC Handler that conserves disk space by overwriting errors.  If segmentBytes is given, reports are appended to
+  rotating segments instead, as GecLogObserver does."""
 
   MAX_BASENAME = 10
   MAX_ERRORS = 10000
 
 
-  def __init__(self, path, project, environment, serverName):
-    GecLogObserver.__init__(self, path, project, environment, serverName)
+  def __init__(self, path, project, environment, serverName, segmentBytes=None, suppressor=None):
+    GecLogObserver.__init__(self, path, project, environment, serverName, segmentBytes, suppressor)
     self.baseName = random.randint(0, GentleGecLogObserver.MAX_BASENAME)
     self.errorId = random.randint(0, GentleGecLogObserver.MAX_ERRORS)
 
 
   def write(self, output):
     """Write a gec error report, possibly overwriting a previous one."""
+    if self._GecLogObserver__segments:
+      GecLogObserver.write(self, output)
+      return
     self.errorId = (self.errorId + 1) % GentleGecLogObserver.MAX_ERRORS
-    filename = os.path.join(self._GecHandler__path, '%d-%d.gec.json' % (self.baseName, self.errorId))
+    filename = os.path.join(self._GecLogObserver__path, '%d-%d.gec.json' % (self.baseName, self.errorId))
     with open(filename, 'w') as f:
       util.untilConcludes(f.write, output)
       util.untilConcludes(f.flush)
 
+
+
+class ThreadedGecLogObserver(GecLogObserver):
+  """A GEC observer that keeps serialization and file I/O off the reactor thread.
+
+  Failures are captured on the reactor and held in a buffer of at most maxPending distinct failures, where identical
+  failures are coalesced into a single report carrying the number of occurrences, and the number the suppressor held
+  back before them, in its context.  Every flushDelay
+  seconds the buffer is handed to a single writer thread; while a batch is being written, new failures keep
+  accumulating in the buffer, and failures that would not fit are dropped and counted.  Failures logged from other
+  threads are buffered by the reactor thread.
+  """
+
+  MAX_PENDING = 1000
+
+  FLUSH_DELAY = 0.5
+
+
+  def __init__(self, path, project, environment, serverName, segmentBytes=None, suppressor=None, maxFrames=None,
+               captureLoggedFrom=True, maxPending=MAX_PENDING, flushDelay=FLUSH_DELAY, reactor=None):
+    GecLogObserver.__init__(self, path, project, environment, serverName, segmentBytes, suppressor, maxFrames,
+                            captureLoggedFrom)
+    if reactor is None:
+      from twisted.internet import reactor
+    self.__reactor = reactor
+    self.__maxPending = maxPending
+    self.__flushDelay = flushDelay
+    self.__pending = collections.OrderedDict()
+    self.__flushCall = None
+    self.__writing = False
+    self.__pool = ThreadPool(1, 1, 'GecWriter')
+
+    self.written = 0
+    self.coalesced = 0
+    self.dropped = 0
+    self.failed = 0
+
+
+  def emit(self, eventDict):
+    """Buffers the given event, coalescing it with any identical pending failure.  The event is captured on the
+    thread that logged it, but only the reactor thread touches the buffer, so events from other threads are handed
+    over with callFromThread."""
+    captured = self.capture(eventDict)
+    if not captured:
+      return
+    if threadable.isInIOThread():
+      self.__buffer(captured)
+    else:
+      self.__reactor.callFromThread(self.__buffer, captured)
+
+
+  def __buffer(self, captured):
+    """Adds a capture to the buffer.  Runs on the reactor thread."""
+    key = (captured['type'], captured['message'], tuple(captured['frames']))
+    pending = self.__pending.get(key)
+    if pending:
+      pending[1] += 1
+      pending[0]['suppressed'] += captured['suppressed']
+      self.coalesced += 1
+    elif len(self.__pending) >= self.__maxPending:
+      self.dropped += 1
+    else:
+      self.__pending[key] = [captured, 1]
+    self.__scheduleFlush()
+
+
+  def getStats(self):
+    """Returns counters describing the writer."""
+    return {
+      'pending': len(self.__pending),
+      'written': self.written,
+      'coalesced': self.coalesced,
+      'dropped': self.dropped,
+      'failed': self.failed,
+    }
+
+
+  def __scheduleFlush(self):
+    """Makes sure a flush is coming."""
+    if self.__flushCall is None and not self.__writing:
+      self.__flushCall = self.__reactor.callLater(self.__flushDelay, self.__flush)
+
+
+  def __takePending(self):
+    """Removes and returns the buffered captures and their occurrence counts."""
+    batch = list(self.__pending.values())
+    self.__pending.clear()
+    return batch
+
+
+  def __flush(self):
+    """Hands the buffered reports to the writer thread."""
+    self.__flushCall = None
+    batch = self.__takePending()
+    if batch:
+      self.__writing = True
+      threads.deferToThreadPool(self.__reactor, self.__pool, self.__writeBatch, batch).addBoth(self.__written)
+
+
+  def __written(self, _):
+    """Called on the reactor once a batch has been written."""
+    self.__writing = False
+    if self.__pending:
+      self.__scheduleFlush()
+
+
+  def __writeBatch(self, batch):
+    """Renders, serializes and writes a batch of captures.  Errors are counted rather than logged, since logging them
+    would bring us right back here."""
+    for captured, count in batch:
+      try:
+        result = self.renderReport(captured)
+        if count > 1:
+          result['context'] = dict(result.get('context') or {}, occurrences=count)
+        self.write(json.dumps(result))
+        self.written += 1
+      except Exception: # pylint: disable=W0703
+        self.failed += 1
+
+
+  def start(self):
+    """Start the writer thread and observe log events."""
+    self.__pool.start()
+    GecLogObserver.start(self)
+
+
+  def stop(self):
+    """Stop observing log events, writing any buffered reports before returning."""
+    log.removeObserver(self.emit)
+    if self.__flushCall is not None and self.__flushCall.active():
+      self.__flushCall.cancel()
+    self.__flushCall = None
+    self.__pool.stop()
+    self.__writeBatch(self.__takePending())
+    self.flushSuppressed()
+    self.close()
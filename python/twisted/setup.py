@@ -32,5 +32,8 @@ setup(name='gec-twisted-logger',
       py_modules = [
         'greplin.gec.twistedLog'
       ],
+      install_requires = [
+        'gec-logging-handler'
+      ],
       zip_safe = True
 )
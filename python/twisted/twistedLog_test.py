@@ -0,0 +1,110 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the Twisted log observers."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+# Use the logging handler from the checkout when gec-logging-handler isn't installed.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'logging'))
+
+# pylint: disable=C0413
+from twisted.internet import task
+from twisted.python import failure, threadable
+
+from greplin.gec import suppression, twistedLog
+
+
+def makeEvent(message):
+  """Creates a log event carrying a failure, always raised from the same place."""
+  try:
+    raise ValueError(message)
+  except ValueError:
+    return {'failure': failure.Failure(), 'why': 'Failed to handle request', 'time': 1300000000.0, 'isError': 1}
+
+
+def readReports(directory):
+  """Returns the reports written to files in the directory, by message."""
+  reports = []
+  for name in os.listdir(directory):
+    with open(os.path.join(directory, name)) as f:
+      reports.append(json.load(f))
+  return sorted(reports, key=lambda report: report['message'])
+
+
+
+class ThreadedGecLogObserverTestCase(unittest.TestCase):
+  """Tests for the observer that buffers failures for a writer thread."""
+
+  def setUp(self):
+    threadable.registerAsIOThread()
+    self.directory = tempfile.mkdtemp()
+    self.clock = task.Clock()
+    self.now = 1000.0
+
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+
+  def observer(self, **kwargs):
+    """Returns an observer on the fake reactor.  It is never started, so stopping it writes what is buffered."""
+    return twistedLog.ThreadedGecLogObserver(self.directory, 'project', 'env', 'server', reactor=self.clock,
+                                             captureLoggedFrom=False, **kwargs)
+
+
+  def testCoalesces(self):
+    """Test that identical failures are written as one report counting them."""
+    observer = self.observer()
+    for _ in range(3):
+      observer.emit(makeEvent('same'))
+    observer.emit(makeEvent('other'))
+    self.assertEqual({'pending': 2, 'written': 0, 'coalesced': 2, 'dropped': 0, 'failed': 0}, observer.getStats())
+
+    observer.stop()
+    self.assertEqual([('other', None), ('same', {'occurrences': 3})],
+                     [(report['message'], report.get('context')) for report in readReports(self.directory)])
+    self.assertEqual(2, observer.getStats()['written'])
+
+
+  def testDrops(self):
+    """Test that distinct failures beyond maxPending are dropped and counted, while identical ones still coalesce."""
+    observer = self.observer(maxPending=2)
+    for message in ('a', 'b', 'c', 'a'):
+      observer.emit(makeEvent(message))
+    self.assertEqual({'pending': 2, 'written': 0, 'coalesced': 1, 'dropped': 1, 'failed': 0}, observer.getStats())
+
+    observer.stop()
+    self.assertEqual(['a', 'b'], [report['message'] for report in readReports(self.directory)])
+
+
+  def testCoalescedSuppressedCount(self):
+    """Test that the suppressed count of a failure coalesced in to a pending one is kept."""
+    suppressor = suppression.Suppressor(window=10, burst=1, clock=lambda: self.now)
+    observer = self.observer(suppressor=suppressor)
+    for _ in range(3):
+      observer.emit(makeEvent('same'))
+    self.now += 10
+    observer.emit(makeEvent('same'))
+    self.assertEqual(1, observer.getStats()['coalesced'])
+
+    observer.stop()
+    self.assertEqual([{'occurrences': 2, 'suppressed': 2}],
+                     [report.get('context') for report in readReports(self.directory)])
+
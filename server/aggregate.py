@@ -14,20 +14,14 @@
 
 """AppEngine server for aggregating exceptions."""
 
-# pylint: disable=E0611
-from google.appengine.dist import use_library
-use_library('django', '1.2')
+from backend import Timeout
 
 from datamodel import    LoggedErrorInstance, AggregatedStats
+import perf
+import jsoncodec
 from datetime import datetime, timedelta
 
-from google.appengine.api.datastore_errors import Timeout
-
 import collections
-try:
-  from django.utils import simplejson as json
-except ImportError:
-  import json
 import logging
 
 
@@ -63,6 +57,7 @@ def retryingIter(queryGenerator):
       logging.info('Attempt #%d failed', i)
 
 
+@perf.measured('aggregate')
 def main():
   """Runs the aggregation."""
   logging.info('running the cron')
@@ -94,7 +89,7 @@ def main():
 
   stat = AggregatedStats()
   stat.date = now
-  stat.json = json.dumps(result)
+  stat.json = jsoncodec.dumps(result)
   stat.put()
 
   logging.info('Put aggregate')
@@ -0,0 +1,137 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Email alerts on error spikes.
+
+The aggregation worker passes the per minute counts it aggregates to observeError and observeProjects.  Spike state is
+kept on each LoggedError, which the worker already reads and writes under its lock, and in one SpikeState entity per
+project.  Alert emails are sent from a task so a slow mail call never holds up aggregation.  The task only names the
+error or project, and the email is built from the spike kept in its stored state.
+
+Storms are kept quiet in two ways: each error and project alerts at most once per cooldown, and no more than
+maxSpikeAlertsPerHour alerts are sent in total.
+"""
+
+from backend import db, mail, memcache, taskqueue, webapp
+
+from common import isTaskRequest
+import config
+from datamodel import LoggedError, SpikeState
+import spikes
+
+import logging
+import time
+import urllib
+
+
+DETECTOR = spikes.SpikeDetector(alpha = config.get('spikeAlpha', 0.1),
+                                threshold = config.get('spikeThreshold', 4.0),
+                                minCount = config.get('spikeMinCount', 10),
+                                cooldown = config.get('spikeCooldownMinutes', 60) * 60,
+                                warmup = config.get('spikeWarmupMinutes', 30))
+
+NAMESPACE = 'spikes'
+
+
+def getEndpoints():
+  """Returns endpoints needed for sending alerts."""
+  return [
+    ('/spikeAlertWorker', SpikeAlertWorker)
+  ]
+
+
+def _queueAlert(params):
+  """Queues an alert email for the error or project named by params unless this hour's alert budget is spent."""
+  sent = memcache.incr('sent%d' % (time.time() // 3600), namespace = NAMESPACE, initial_value = 0)
+  if sent and sent > config.get('maxSpikeAlertsPerHour', 20):
+    logging.warn('Not sending spike alert for %s: hourly alert limit reached', params)
+    return
+  taskqueue.add(url = '/spikeAlertWorker', params = params)
+
+
+def observeError(error, occurrences):
+  """Adds a map from minute start timestamp to count to the error's spike state, queueing an alert on a spike.  The
+  caller must hold the error's lock and put the error afterwards."""
+  state, spike = DETECTOR.observe(error.spikeState, occurrences, time.time())
+  error.spikeState = db.Blob(state)
+  if spike:
+    _queueAlert({'error': str(error.key())})
+
+
+def observeProjects(occurrencesByProject):
+  """Adds maps from minute start timestamp to count to the spike state of each named project."""
+  names = [name for name in occurrencesByProject if memcache.add(name, True, time = 60, namespace = NAMESPACE)]
+  if len(names) < len(occurrencesByProject):
+    logging.info('Could not lock spike state for %d projects', len(occurrencesByProject) - len(names))
+  if not names:
+    return
+
+  try:
+    states = SpikeState.get_by_key_name(names)
+    now = time.time()
+    for i, name in enumerate(names):
+      state = states[i] or SpikeState(key_name = name)
+      packed, spike = DETECTOR.observe(state.state, occurrencesByProject[name], now)
+      state.state = db.Blob(packed)
+      states[i] = state
+      if spike:
+        _queueAlert({'project': name})
+    db.put(states)
+  finally:
+    memcache.delete_multi(names, namespace = NAMESPACE)
+
+
+
+class SpikeAlertWorker(webapp.RequestHandler):
+  """Worker handler for sending a spike alert."""
+
+  def post(self):
+    """Sends the alert email for the last spike of the error or project named by the request."""
+    if not isTaskRequest(self.request):
+      self.error(403)
+      return
+
+    toEmail = config.get('toEmail')
+    fromEmail = config.get('fromEmail')
+    if not (toEmail and fromEmail):
+      logging.info('Not sending spike alert: no email addresses configured')
+      return
+
+    if self.request.get('error'):
+      try:
+        error = LoggedError.get(self.request.get('error'))
+      except db.BadKeyError:
+        error = None
+      if error is None:
+        logging.warn('Not sending spike alert: no error %s', self.request.get('error'))
+        return
+      projectName = LoggedError.project.get_value_for_datastore(error).name()
+      subject, path, packed = '%s: %s' % (projectName, error.type), '/view/%s' % error.key(), error.spikeState
+    else:
+      name = self.request.get('project')
+      state = SpikeState.get_by_key_name(name) if name else None
+      if state is None:
+        logging.warn('Not sending spike alert: no project %s', name)
+        return
+      subject, path, packed = '%s: all errors' % name, '/?project=%s' % urllib.quote(name), state.state
+
+    spike = spikes.lastSpike(packed)
+    if not spike:
+      logging.warn('Not sending spike alert for %s: no spike recorded', subject)
+      return
+
+    start, count, baseline = spike
+    body = ('%d occurrences in the minute from %s, against a baseline of %.1f per minute.\n\n%s%s\n' %
+            (count, time.strftime('%Y-%m-%d %H:%M UTC', time.gmtime(start)), baseline, config.get('baseUrl', ''), path))
+    mail.send_mail(sender = fromEmail, to = toEmail, subject = 'GEC spike - %s' % subject, body = body)
@@ -0,0 +1,281 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""AppEngine cron for moving old error instances in to compressed archive blocks.
+
+Instances older than "archiveAfterDays" in config.json are packed, newest first, in to InstanceArchive blocks: one
+JSON row per line, zlib compressed, with every block holding instances of one error from one day.  Reading a block
+decompresses a chunk at a time and stops as soon as the caller has enough rows, so the view page only pays for the
+instances it shows.
+
+The cron starts a pass that archives a batch at a time from the rate limited "archive" queue.  A pass stops short of
+instances that may not have been aggregated yet: those dated after the oldest task in the aggregation queue was
+queued, or in the last day, which the stats cron reads.
+
+Instances archived after a day's blocks were written - reports that arrive late, or a retried batch - are merged in to
+the blocks they fall among, so a day's blocks never overlap and reading them by date returns instances newest first.
+Rows record their instance's id, so instances that an earlier try archived but didn't get to delete aren't archived
+twice.
+
+Blocks expire with their last instance.  Instances stored before expiry dates were kept are given the expiry the
+current retention settings would give them.
+"""
+
+from backend import db, memcache, taskqueue, webapp
+
+from common import AttrDict, isTaskRequest
+import config
+import jsoncodec
+from datamodel import InstanceArchive, LoggedErrorInstance
+import perf
+import retention
+
+import collections
+from datetime import datetime
+import logging
+import time
+import zlib
+
+
+BATCH_SIZE = 500
+
+# Most uncompressed bytes packed in to one block, keeping blocks well under the entity size limit.
+MAX_BLOCK_BYTES = 2 * 1024 * 1024
+
+# Compressed bytes decompressed at a time when reading a block.
+READ_CHUNK = 4096
+
+# Days of instances the stats cron in aggregate.py reads.
+STATS_DAYS = 1
+
+_FIELDS = (('environment', 'e'), ('server', 's'), ('errorLevel', 'l'), ('type', 't'), ('message', 'm'),
+           ('logMessage', 'g'), ('context', 'c'), ('affectedUser', 'u'))
+
+
+def getEndpoints():
+  """Returns endpoints needed for archiving instances."""
+  return [
+    ('/archiveWorker', ArchiveWorker)
+  ]
+
+
+def _timestamp(date):
+  """Converts a datetime to seconds since the epoch, keeping microseconds."""
+  return time.mktime(date.timetuple()) + date.microsecond / 1e6
+
+
+def packRows(rows):
+  """Packs a list of row dicts in to a compressed block."""
+  return zlib.compress(b'\n'.join(jsoncodec.dumps(row).encode('utf-8') for row in rows), 9)
+
+
+def iterRows(packed):
+  """Yields the row dicts of a compressed block in order, decompressing only as much as is read."""
+  decompressor = zlib.decompressobj()
+  buffered = b''
+  for offset in range(0, len(packed), READ_CHUNK):
+    buffered += decompressor.decompress(packed[offset:offset + READ_CHUNK])
+    lines = buffered.split(b'\n')
+    buffered = lines.pop()
+    for line in lines:
+      yield jsoncodec.loads(line.decode('utf-8'))
+  buffered += decompressor.flush()
+  if buffered:
+    yield jsoncodec.loads(buffered.decode('utf-8'))
+
+
+def _row(instance):
+  """Converts an instance to a row."""
+  row = {'d': _timestamp(instance.date), 'k': instance.key().id_or_name()}
+  for name, short in _FIELDS:
+    value = getattr(instance, name)
+    if value is not None:
+      row[short] = value
+  return row
+
+
+def _instance(row):
+  """Converts a row to an object with the fields of an instance."""
+  instance = AttrDict((name, row.get(short)) for name, short in _FIELDS)
+  instance.date = datetime.fromtimestamp(row['d'])
+  instance.archived = True
+  return instance
+
+
+def _blocks(entries):
+  """Splits (date, row, expiry) entries of one error from one day, newest first, in to lists small enough for one
+  block."""
+  block = []
+  size = 0
+  for entry in entries:
+    row = entry[1]
+    rowSize = sum(len(row.get(short) or '') for short in ('m', 'g', 'c')) + 200
+    if block and size + rowSize > MAX_BLOCK_BYTES:
+      yield block
+      block = []
+      size = 0
+    block.append(entry)
+    size += rowSize
+  if block:
+    yield block
+
+
+def _overlapping(errorKey, day, oldest, newest):
+  """Returns the archive blocks of the given error and day whose dates overlap the given range."""
+  return [block for block in InstanceArchive.all().ancestor(errorKey).filter('day =', day)
+          if block.oldest <= newest and block.newest >= oldest]
+
+
+def _expiry(instance):
+  """Returns when an instance expires, giving instances stored before expiry dates were kept the current setting's."""
+  if instance.expires is not None:
+    return instance.expires
+  project = LoggedErrorInstance.project.get_value_for_datastore(instance).name()
+  return retention.expiry(project, instance.errorLevel or 'error', instance.date)
+
+
+def archiveInstances(instances):
+  """Moves the given instances in to archive blocks, merging them with the blocks of their day that they overlap."""
+  byErrorDay = collections.defaultdict(list)
+  for instance in instances:
+    byErrorDay[(LoggedErrorInstance.error.get_value_for_datastore(instance), instance.date.date())].append(instance)
+
+  blocks = []
+  replaced = []
+  for (errorKey, day), group in byErrorDay.items():
+    dayStart = datetime(day.year, day.month, day.day)
+    entries = dict((instance.key().id_or_name(), (instance.date, _row(instance), _expiry(instance)))
+                   for instance in group)
+    dates = [instance.date for instance in group]
+    for block in _overlapping(errorKey, dayStart, min(dates), max(dates)):
+      replaced.append(block.key())
+      for row in iterRows(block.rows):
+        entries[row['k']] = (datetime.fromtimestamp(row['d']), row, block.expires)
+
+    project = LoggedErrorInstance.project.get_value_for_datastore(group[0])
+    for block in _blocks(sorted(entries.values(), key = lambda entry: entry[0], reverse = True)):
+      expires = [expiry for _, _, expiry in block]
+      blocks.append(InstanceArchive(
+          parent = errorKey,
+          key_name = '%s/%s' % (day.isoformat(), block[0][1]['k']),
+          project = project,
+          day = dayStart,
+          newest = block[0][0],
+          oldest = block[-1][0],
+          count = len(block),
+          expires = None if None in expires else max(expires),
+          rows = db.Blob(packRows([row for _, row, _ in block]))))
+
+  db.put(blocks)
+  written = set(block.key() for block in blocks)
+  db.delete([key for key in replaced if key not in written] + [instance.key() for instance in instances])
+  return len(blocks)
+
+
+def _matches(instance, filters):
+  """Returns whether an archived instance matches the given instance filters."""
+  for key, value in filters.items():
+    if key == 'affectedUser':
+      if instance.affectedUser is None or str(instance.affectedUser) != value:
+        return False
+    elif key in ('environment', 'server') and instance[key] != value:
+      return False
+  return True
+
+
+def getArchivedInstances(error, filters, before, limit):
+  """Gets up to limit archived instances of the given error from before the given date (or any date) that match the
+  given instance filters, newest first."""
+  query = InstanceArchive.all().ancestor(error)
+  if before:
+    query = query.filter('oldest <', before)
+  query = query.order('-oldest')
+
+  results = []
+  for block in query:
+    for row in iterRows(block.rows):
+      instance = _instance(row)
+      if before and instance.date >= before:
+        continue
+      if _matches(instance, filters):
+        results.append(instance)
+        if len(results) >= limit:
+          return results
+  return results
+
+
+def _queueBatch(before, cursor = None, archived = 0):
+  """Queues a task to archive the next batch of the pass."""
+  params = {'before': before, 'archived': archived}
+  if cursor:
+    params['cursor'] = cursor
+  taskqueue.add(queue_name = 'archive', url = '/archiveWorker', params = params)
+
+
+@perf.measured('archive')
+def main():
+  """Starts a pass archiving old instances, unless one was started in the last hour."""
+  days = config.get('archiveAfterDays')
+  if not days:
+    logging.info('No archiving configured')
+    return
+  if not memcache.add('started', True, time = 3600, namespace = 'archive'):
+    logging.info('An archive pass was started in the last hour')
+    return
+  before = min(time.time() - days * 86400, _aggregationWatermark())
+  _queueBatch(before)
+
+
+def _aggregationWatermark():
+  """Returns the time after which instances may not have been aggregated yet."""
+  now = time.time()
+  watermark = now - STATS_DAYS * 86400
+  # The aggregation worker reads each instance it is queued for, so those must stay until it has.
+  oldestEtaUsec = taskqueue.Queue('aggregation').fetch_statistics().oldest_eta_usec
+  if oldestEtaUsec:
+    watermark = min(watermark, oldestEtaUsec / 1e6)
+  return watermark
+
+
+
+class ArchiveWorker(webapp.RequestHandler):
+  """Worker handler for archiving a batch of old instances."""
+
+  def post(self):
+    """Archives a batch and queues the next one."""
+    if not isTaskRequest(self.request):
+      self.error(403)
+      return
+
+    before = float(self.request.get('before'))
+    archived = int(self.request.get('archived', 0))
+    query = LoggedErrorInstance.all().filter('date <', datetime.fromtimestamp(before)).order('date')
+    cursor = self.request.get('cursor')
+    if cursor:
+      query.with_cursor(cursor)
+
+    instances = query.fetch(BATCH_SIZE)
+    if instances:
+      blocks = archiveInstances(instances)
+      logging.info('Archived %d instances in to %d blocks', len(instances), blocks)
+    archived += len(instances)
+
+    if len(instances) == BATCH_SIZE:
+      _queueBatch(before, query.cursor(), archived)
+    else:
+      logging.info('Archive pass archived %d instances', archived)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,95 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for archiving old error instances."""
+
+from datetime import datetime, timedelta
+import unittest
+
+import localConfig
+localConfig.useLocalConfig('test', 'secret')
+
+# pylint: disable=C0413
+import archive
+from backend import db
+from datamodel import InstanceArchive, LoggedError, LoggedErrorInstance, Project
+
+
+
+class ArchiveTestCase(unittest.TestCase):
+  """Tests for archiving old error instances."""
+
+  def setUp(self):
+    db.configure(':memory:')
+    self.project = Project(key_name = 'frontend')
+    self.project.put()
+    self.error = LoggedError(project = self.project, hash = 'h', active = True)
+    self.error.put()
+    self.start = datetime(2011, 6, 1, 0, 0, 0)
+    self.maxBlockBytes = archive.MAX_BLOCK_BYTES
+
+
+  def tearDown(self):
+    archive.MAX_BLOCK_BYTES = self.maxBlockBytes
+
+
+  def archiveAt(self, hours):
+    """Stores and archives an instance of the error at each of the given hours of the day."""
+    instances = [LoggedErrorInstance(project = self.project, error = self.error, environment = 'prod',
+                                     date = self.start + timedelta(hours = hour), message = 'at %d' % hour,
+                                     expires = self.start + timedelta(days = 30))
+                 for hour in hours]
+    db.put(instances)
+    archive.archiveInstances(instances)
+    return instances
+
+
+  def blockRanges(self):
+    """Returns the hours of the oldest and newest instance of each block, oldest first."""
+    return sorted((block.oldest.hour, block.newest.hour) for block in InstanceArchive.all().ancestor(self.error))
+
+
+  def archived(self, before = None, limit = 100):
+    """Returns the messages of the archived instances read newest first."""
+    return [instance.message for instance in archive.getArchivedInstances(self.error, {}, before, limit)]
+
+
+  def testMergesLateInstances(self):
+    """Test that instances falling among a day's archived ones are merged in to their block, while later ones get their
+    own."""
+    self.archiveAt([1, 3, 5])
+    self.archiveAt([2, 4])
+    self.archiveAt([8])
+    self.assertEqual([(1, 5), (8, 8)], self.blockRanges())
+    self.assertEqual(['at 8', 'at 5', 'at 4', 'at 3', 'at 2', 'at 1'], self.archived())
+    self.assertEqual(0, LoggedErrorInstance.all().count())
+
+
+  def testMergedBlocksNeverOverlap(self):
+    """Test that merging in to full blocks splits them again without overlaps, so paging reads newest first."""
+    archive.MAX_BLOCK_BYTES = 450
+    self.archiveAt([1, 3, 5, 7])
+    self.assertEqual([(1, 3), (5, 7)], self.blockRanges())
+    self.archiveAt([2, 6])
+    self.assertEqual([(1, 2), (3, 5), (6, 7)], self.blockRanges())
+    self.assertEqual(['at 7', 'at 6', 'at 5', 'at 3', 'at 2', 'at 1'], self.archived())
+    self.assertEqual(['at 3', 'at 2'], self.archived(before = self.start + timedelta(hours = 4), limit = 2))
+
+
+  def testRetryArchivesOnce(self):
+    """Test that archiving instances again, as a retried batch does, doesn't repeat them."""
+    instances = self.archiveAt([1, 2])
+    archive.archiveInstances(instances)
+    self.assertEqual([(1, 2)], self.blockRanges())
+    self.assertEqual(['at 2', 'at 1'], self.archived())
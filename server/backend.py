@@ -0,0 +1,48 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Chooses the storage, queue, cache and web services the server runs on.
+
+With "backend": "appengine" (the default) these are the App Engine APIs.  With "backend": "local" they are SQLite
+(localdb.py), in-process memcache, task queue, users and mail (localservices.py) and plain WSGI (localwebapp.py), so
+the whole pipeline runs on one machine - see localserver.py.  Server modules import these names from here rather than
+from google.appengine.  On App Engine, app.yaml's libraries section picks the django version.
+"""
+
+import config
+
+
+BACKEND = config.get('backend', 'appengine')
+
+
+if BACKEND == 'local':
+  import localdb as db
+  from localdb import Timeout
+  from localservices import mail, memcache, taskqueue, users
+  import localwebapp as webapp
+  from localwebapp import run_wsgi_app, template
+
+  db.configure(config.get('localDatabase', 'gec.sqlite'))
+
+else:
+  # pylint: disable=E0611
+  from google.appengine.api import mail, memcache, taskqueue, users
+  # pylint: disable=E0611
+  from google.appengine.api.datastore_errors import Timeout
+  # pylint: disable=E0611
+  from google.appengine.ext import db, webapp
+  # pylint: disable=E0611
+  from google.appengine.ext.webapp import template
+  # pylint: disable=E0611
+  from google.appengine.ext.webapp.util import run_wsgi_app
@@ -0,0 +1,107 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Benchmark of JSON encoding and decoding over the life of a report on the server.
+
+For each JSON implementation installed, times decoding the report in the reportWorker, encoding its context to store
+on the instance, and encoding and decoding the aggregation task it queues.  The implementation jsoncodec chose is
+marked.
+
+Reports come from the ingest benchmark's corpus, with a context like a web request's.
+
+Usage: codecBenchmark.py [REPORTS]
+"""
+
+try:
+  from django.utils import simplejson as json
+except ImportError:
+  import json
+import sys
+import time
+
+import localConfig
+localConfig.useLocalConfig('benchmark', 'benchmark')
+
+# pylint: disable=C0413
+import ingestBenchmark
+import jsoncodec
+
+
+IMPLEMENTATIONS = ['ujson', 'simplejson', 'json', 'django.utils.simplejson']
+
+CONTEXT = {
+  'url': '/account/settings/notifications?tab=email&page=2',
+  'method': 'POST',
+  'headers': dict(('X-Header-%d' % i, 'value-%d-' % i + 'x' * 40) for i in range(12)),
+  'params': dict(('field%d' % i, 'some submitted value %d' % i) for i in range(20)),
+  'session': {'locale': 'en_US', 'experiments': ['new-nav', 'fast-search', 'dark-mode'], 'visits': 17},
+}
+
+
+def _reports(count):
+  """Returns serialized reports from the ingest benchmark's corpus, with a larger context."""
+  corpus = ingestBenchmark.Corpus(50, 1.1, 20, 3)
+  reports = []
+  for _ in range(count):
+    report = json.loads(corpus.report())
+    report['context'] = dict(CONTEXT, userId = report['context']['userId'])
+    reports.append(json.dumps(report))
+  return reports
+
+
+def _time(function, items):
+  """Returns the total seconds taken to call function on each item, and the results."""
+  start = time.time()
+  results = [function(item) for item in items]
+  return time.time() - start, results
+
+
+def _task(report):
+  """Builds the aggregation task payload queued for a report."""
+  return {'error': 'agx0ZXN0YmVkLXRlc3RyFQsSD0xvZ2dlZEVycm9yVjJfMhgBDA', 'instance': 'agx0ZXN0YmVkLXRlc3RyHQsS',
+          'backtraceDigest': '0123456789abcdef0123456789abcdef01234567', 'queued': report['timestamp']}
+
+
+def measure(loads, dumps, reports):
+  """Returns the seconds taken by each stage of the lives of the given reports."""
+  decode, decoded = _time(loads, reports)
+  encodeContext, _ = _time(lambda report: dumps(report['context']), decoded)
+  encodeTask, tasks = _time(lambda report: dumps(_task(report)), decoded)
+  decodeTask, _ = _time(loads, tasks)
+  return decode, encodeContext, encodeTask, decodeTask
+
+
+def main():
+  """Runs the benchmark."""
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  reports = _reports(count)
+
+  print 'Reports: %d of %d bytes on average' % (count, sum(len(report) for report in reports) / count)
+  print
+  print '%-26s %12s %12s %12s %12s %12s' % ('Implementation', 'Decode us', 'Context us', 'Task us', 'Task decode us',
+                                           'Total us')
+  for name in IMPLEMENTATIONS:
+    try:
+      module = __import__(name, fromlist = ['loads'])
+    except ImportError:
+      continue
+    perReport = [stage * 1e6 / count for stage in measure(module.loads, module.dumps, reports)]
+    label = name + (' (chosen)' if module.loads is jsoncodec.loads else '')
+    print '%-26s %12.1f %12.1f %12.1f %12.1f %12.1f' % tuple([label] + perReport + [sum(perReport)])
+
+
+if __name__ == '__main__':
+  main()
@@ -14,10 +14,7 @@
 
 """Common utility functions."""
 
-# pylint: disable=E0611
-from google.appengine.api import memcache
-# pylint: disable=E0611
-from google.appengine.ext import db
+from backend import db, memcache
 
 from datamodel import Project
 
@@ -41,6 +38,11 @@ def parseDate(string):
   return datetime.datetime.strptime(string.split('.')[0], '%Y-%m-%d %H:%M:%S')
 
 
+def isTaskRequest(request):
+  """Returns whether the request was made by the task queue.  App Engine strips this header from outside requests."""
+  return bool(request.environ.get('HTTP_X_APPENGINE_QUEUENAME'))
+
+
 def getTemplatePath(name):
   """Gets a path to the named template."""
   return os.path.join(os.path.dirname(__file__), 'templates', name)
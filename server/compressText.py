@@ -0,0 +1,29 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Mapper that puts errors and instances again so their long text is stored compressed.  Run it over the LoggedError
+and LoggedErrorInstance kinds after upgrading from a version that stored text uncompressed."""
+
+from mapreduce import operation as op
+
+from datamodel import CompressedTextProperty
+
+
+def process(entity):
+  """Process an entity by putting it again if any of its long text is stored uncompressed."""
+  for prop in entity.properties().values():
+    if isinstance(prop, CompressedTextProperty) and prop.needsCompression(entity):
+      yield op.db.Put(entity)
+      return
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of compressed text storage on the backtrace_test.py examples.
+
+For each example, and for a Java trace cut at the 10KB field limit of upload.py, prints the bytes stored by
+CompressedTextProperty, the compression ratio, and the microseconds taken to compress on put and to decompress on
+first read.
+
+Usage: compressionBenchmark.py [ITERATIONS]
+"""
+
+import sys
+import time
+
+import localConfig
+localConfig.useLocalConfig('benchmark', 'benchmark')
+
+# pylint: disable=C0413
+import backtrace_test
+from datamodel import LoggedErrorInstance
+
+
+# The field size limit of upload.trimDict.
+MAX_FIELD_SIZE = 10240
+
+
+def _truncatedJava():
+  """Returns a Java trace with repeated frames, cut at the upload field limit the way upload.py cuts it."""
+  lines = backtrace_test.EXAMPLE.strip().splitlines()
+  frames = [line for line in lines if line.strip().startswith('at ')]
+  text = '\n'.join(lines)
+  while len(text) <= MAX_FIELD_SIZE:
+    text += '\n' + '\n'.join(frames)
+  return text[:MAX_FIELD_SIZE] + '(...)'
+
+
+EXAMPLES = [
+  ('Java', backtrace_test.EXAMPLE),
+  ('Python', backtrace_test.PYTHON_EXAMPLE),
+  ('Objective-C', backtrace_test.OBJECTIVE_C_EXAMPLE),
+  ('Java at 10KB limit', _truncatedJava()),
+]
+
+
+def _microseconds(function, iterations):
+  """Returns the mean microseconds taken by a call of function."""
+  start = time.time()
+  for _ in range(iterations):
+    function()
+  return (time.time() - start) * 1e6 / iterations
+
+
+def main():
+  """Runs the benchmark."""
+  iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+  prop = LoggedErrorInstance.message
+
+  print '%-20s %8s %8s %8s %14s %14s' % ('Example', 'Bytes', 'Stored', 'Ratio', 'Compress us', 'Decompress us')
+  totalBytes = totalStored = 0
+  for name, text in EXAMPLES:
+    instance = LoggedErrorInstance(message = text)
+    stored = prop.get_value_for_datastore(instance)
+    compressed = not isinstance(stored, type(u''))
+    encodedBytes = len(text.encode('utf-8'))
+    storedBytes = len(stored) if compressed else encodedBytes
+    totalBytes += encodedBytes
+    totalStored += storedBytes
+    compress = _microseconds(lambda: prop.get_value_for_datastore(instance), iterations)
+    decompress = compressed and _microseconds(lambda: prop.make_value_from_datastore(stored).decode(), iterations)
+    print '%-20s %8d %8d %8.2f %14.1f %14.1f' % (
+        name, encodedBytes, storedBytes, float(encodedBytes) / storedBytes, compress, decompress)
+  print
+  print 'Total: %d bytes stored as %d (%.1f%%)' % (totalBytes, totalStored, 100.0 * totalStored / totalBytes)
+
+
+if __name__ == '__main__':
+  main()
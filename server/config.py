@@ -18,11 +18,12 @@ try:
   from django.utils import simplejson as json
 except ImportError:
   import json
+import os
 
 
 def _loadConfig():
-  """Loads application configuration."""
-  f = open('config.json')
+  """Loads application configuration from config.json, or the file named by the GEC_CONFIG environment variable."""
+  f = open(os.environ.get('GEC_CONFIG', 'config.json'))
   try:
     return json.loads(f.read())
   finally:
@@ -14,9 +14,89 @@
 
 """AppEngine data model for collecting exceptions."""
 
-from google.appengine.ext import db
+from backend import db
 
 import config
+import hyperloglog
+
+import time
+import zlib
+
+
+# Text longer than this many characters is stored compressed.
+COMPRESS_ABOVE = 1024
+
+# Most environments and servers an error summary lists.
+SUMMARY_VALUES = 5
+
+
+
+class _CompressedText(object):
+  """Compressed text read from the datastore, decompressed the first time it is read."""
+
+  __slots__ = ('compressed', 'text')
+
+  def __init__(self, compressed):
+    self.compressed = compressed
+    self.text = None
+
+
+  def decode(self):
+    """Returns the text, decompressing it if it has not been read before."""
+    if self.text is None:
+      self.text = db.Text(zlib.decompress(self.compressed).decode('utf-8'))
+    return self.text
+
+
+
+class CompressedTextProperty(db.TextProperty):
+  """Long text that is stored zlib compressed, as a blob, when it is longer than the threshold.
+
+  Compressed values are only decompressed when the attribute is read, and an entity that is put again without setting
+  the attribute keeps the stored bytes rather than compressing them again.  Text stored before the property was
+  compressed is read as is, and is compressed the next time its entity is put.
+  """
+
+  def __init__(self, verbose_name=None, threshold=COMPRESS_ABOVE, **kwds):
+    db.TextProperty.__init__(self, verbose_name, **kwds)
+    self.threshold = threshold
+
+
+  def validate(self, value):
+    if isinstance(value, _CompressedText):
+      return value
+    return db.TextProperty.validate(self, value)
+
+
+  def __get__(self, instance, owner):
+    value = db.TextProperty.__get__(self, instance, owner)
+    if isinstance(value, _CompressedText):
+      return value.decode()
+    return value
+
+
+  def get_value_for_datastore(self, instance):
+    value = db.TextProperty.__get__(self, instance, type(instance))
+    if isinstance(value, _CompressedText):
+      return db.Blob(value.compressed)
+    if value is not None and len(value) > self.threshold:
+      encoded = value.encode('utf-8')
+      compressed = zlib.compress(encoded)
+      if len(compressed) < len(encoded):
+        return db.Blob(compressed)
+    return value
+
+
+  def make_value_from_datastore(self, value):
+    if isinstance(value, db.Blob):
+      return _CompressedText(value)
+    return value
+
+
+  def needsCompression(self, instance):
+    """Returns whether the given entity's value is stored as text but would be compressed if it was put again."""
+    stored = db.TextProperty.__get__(self, instance, type(instance))
+    return not isinstance(stored, _CompressedText) and isinstance(self.get_value_for_datastore(instance), db.Blob)
 
 
 
@@ -32,32 +112,54 @@ class Project(db.Model):
 
 
 
+class Backtrace(db.Model):
+  """A backtrace, stored once however many errors share it, keyed by the SHA-1 digest of its text."""
+
+  text = CompressedTextProperty()
+
+
+
 class LoggedError(db.Model):
   """Model for a logged error."""
 
   project = db.ReferenceProperty(Project)
 
-  backtrace = db.TextProperty()
+  # The backtrace of errors stored before backtraces were shared.  Newer errors only have a backtraceDigest.
+  backtrace = CompressedTextProperty()
+
+  backtraceDigest = db.StringProperty(indexed = False)
 
-  type = db.StringProperty()
+  type = db.StringProperty(indexed = False)
 
   hash = db.StringProperty()
 
   active = db.BooleanProperty()
 
-  count = db.IntegerProperty()
+  count = db.IntegerProperty(indexed = False)
 
-  errorLevel = db.StringProperty(default = 'error')
+  errorLevel = db.StringProperty(default = 'error', indexed = False)
 
   firstOccurrence = db.DateTimeProperty()
 
   lastOccurrence = db.DateTimeProperty()
 
-  lastMessage = db.StringProperty(multiline=True)
+  lastMessage = db.StringProperty(multiline=True, indexed = False)
+
+  environments = db.StringListProperty(indexed = False)
+
+  servers = db.StringListProperty(indexed = False)
+
+  environmentCounts = db.TextProperty()
+
+  serverCounts = db.TextProperty()
 
-  environments = db.StringListProperty()
+  histogram = db.BlobProperty()
 
-  servers = db.StringListProperty()
+  spikeState = db.BlobProperty()
+
+  affectedUsers = db.BlobProperty()
+
+  dailyAffectedUsers = db.BlobProperty()
 
 
   @classmethod
@@ -66,6 +168,90 @@ class LoggedError(db.Model):
     return 'LoggedErrorV2_%d' % (config.get('datastoreVersion', 2))
 
 
+  def getBacktrace(self):
+    """Returns the backtrace of the error's latest occurrence."""
+    if self.backtraceDigest:
+      stored = Backtrace.get_by_key_name(self.backtraceDigest)
+      if stored:
+        return stored.text
+    return self.backtrace
+
+
+  def affectedUserCount(self):
+    """Returns the approximate number of distinct users who hit this error."""
+    return hyperloglog.HyperLogLog(self.affectedUsers).count()
+
+
+  def recentAffectedUserCounts(self):
+    """Returns the approximate number of distinct users who hit this error today and in the last week."""
+    daily = hyperloglog.DailySketches(self.dailyAffectedUsers)
+    now = time.time()
+    return daily.union(1, now).count(), daily.union(hyperloglog.DAYS, now).count()
+
+
+
+class LoggedErrorSummary(db.Model):
+  """The fields of an error shown in the error list, keyed by the error's key as a string.  Aggregation keeps it up to
+  date, so the list loads a few hundred bytes per error instead of the whole error."""
+
+  project = db.StringProperty()
+
+  type = db.StringProperty(indexed = False)
+
+  active = db.BooleanProperty()
+
+  count = db.IntegerProperty(indexed = False)
+
+  errorLevel = db.StringProperty(default = 'error')
+
+  firstOccurrence = db.DateTimeProperty()
+
+  lastOccurrence = db.DateTimeProperty()
+
+  lastMessage = db.StringProperty(multiline=True, indexed = False)
+
+  affectedUsers = db.IntegerProperty(indexed = False)
+
+  environments = db.StringListProperty(indexed = False)
+
+  otherEnvironments = db.IntegerProperty(default = 0, indexed = False)
+
+  servers = db.StringListProperty(indexed = False)
+
+  otherServers = db.IntegerProperty(default = 0, indexed = False)
+
+
+  @classmethod
+  def kind(cls):
+    """Returns the datastore name for this model class."""
+    return 'LoggedErrorSummaryV2_%d' % (config.get('datastoreVersion', 2))
+
+
+  @classmethod
+  def fromError(cls, error):
+    """Builds the summary of the given error."""
+    return cls(
+        key_name = str(error.key()),
+        project = LoggedError.project.get_value_for_datastore(error).name(),
+        type = error.type,
+        active = error.active,
+        count = error.count,
+        errorLevel = error.errorLevel,
+        firstOccurrence = error.firstOccurrence,
+        lastOccurrence = error.lastOccurrence,
+        lastMessage = error.lastMessage,
+        affectedUsers = error.affectedUserCount(),
+        environments = error.environments[:SUMMARY_VALUES],
+        otherEnvironments = max(0, len(error.environments) - SUMMARY_VALUES),
+        servers = error.servers[:SUMMARY_VALUES],
+        otherServers = max(0, len(error.servers) - SUMMARY_VALUES))
+
+
+  def errorKey(self):
+    """Returns the key of the summarized error."""
+    return db.Key(self.key().name())
+
+
 
 class LoggedErrorInstance(db.Model):
   """Model for each occurrence of an error."""
@@ -76,22 +262,24 @@ class LoggedErrorInstance(db.Model):
 
   environment = db.StringProperty()
 
-  type = db.StringProperty()
+  type = db.StringProperty(indexed = False)
 
-  errorLevel = db.StringProperty(default = 'error')
+  errorLevel = db.StringProperty(default = 'error', indexed = False)
 
   date = db.DateTimeProperty()
 
-  message = db.TextProperty()
+  message = CompressedTextProperty()
 
   server = db.StringProperty()
 
-  logMessage = db.TextProperty()
+  logMessage = CompressedTextProperty()
 
-  context = db.TextProperty()
+  context = CompressedTextProperty()
 
   affectedUser = db.IntegerProperty()
 
+  expires = db.DateTimeProperty()
+
 
   @classmethod
   def kind(cls):
@@ -100,6 +288,77 @@ class LoggedErrorInstance(db.Model):
 
 
 
+class InstanceArchive(db.Model):
+  """Compressed instances of one error from one day, newest first.  The error is the parent, and a busy day may span
+  several blocks."""
+
+  project = db.ReferenceProperty(Project)
+
+  day = db.DateTimeProperty()
+
+  newest = db.DateTimeProperty()
+
+  oldest = db.DateTimeProperty()
+
+  count = db.IntegerProperty()
+
+  expires = db.DateTimeProperty()
+
+  rows = db.BlobProperty()
+
+
+
+class DeletionJob(db.Model):
+  """A background job deleting instances and then errors, optionally of one project or from a range of dates."""
+
+  project = db.StringProperty()
+
+  before = db.DateTimeProperty()
+
+  after = db.DateTimeProperty()
+
+  phase = db.StringProperty(default = 'instances')
+
+  cursor = db.TextProperty()
+
+  instancesDeleted = db.IntegerProperty(default = 0)
+
+  archivesDeleted = db.IntegerProperty(default = 0)
+
+  errorsDeleted = db.IntegerProperty(default = 0)
+
+  created = db.DateTimeProperty(auto_now_add = True)
+
+  updated = db.DateTimeProperty(auto_now = True)
+
+
+
+class SearchIndex(db.Model):
+  """Search terms of an error.  Each error has one, with the key name 'search' and the error as its parent.  Whether
+  the error is active and when it last occurred are copied from it, so searches can filter and order by them."""
+
+  terms = db.StringListProperty()
+
+  active = db.BooleanProperty()
+
+  lastOccurrence = db.DateTimeProperty()
+
+
+
+class SearchFacets(db.Model):
+  """Number of active errors with each project, level, environment and server, keyed by project name."""
+
+  counts = db.TextProperty()
+
+
+
+class SpikeState(db.Model):
+  """Spike detection state for a project, keyed by project name."""
+
+  state = db.BlobProperty()
+
+
+
 class AggregatedStats(db.Model):
   """Stores aggregated stats."""
 
@@ -0,0 +1,189 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bulk deletion in batches, and background jobs clearing errors and instances.
+
+A job deletes a batch at a time from the "deletion" queue.  It first deletes the matching instances, then archive
+blocks whose newest instance is in range, then the errors whose last occurrence is in range, along with their search
+indexes and summaries.  Clearing every project finally deletes the stored backtraces, which errors of any project
+may share.
+
+After each batch the job records its cursor and counts, so a failed task resumes where the last one stopped and the
+clear page can show progress.  A job bounded by a start date leaves errors alone, since they may have older
+occurrences.
+"""
+
+from backend import db, memcache, taskqueue, webapp
+
+from common import isTaskRequest
+from datamodel import (Backtrace, DeletionJob, InstanceArchive, LoggedError, LoggedErrorInstance, LoggedErrorSummary,
+                       Project, SearchFacets, SearchIndex, SpikeState)
+
+import logging
+import queue
+
+
+BATCH_SIZE = 500
+
+
+def getEndpoints():
+  """Returns endpoints needed for deletion jobs."""
+  return [
+    ('/deletionWorker', DeletionWorker)
+  ]
+
+
+def deleteBatch(query, cursor = None, batchSize = BATCH_SIZE, related = None):
+  """Deletes the next batch of entities matched by a keys only query, starting after the given cursor.
+
+  related, if given, maps the batch's keys to more keys to delete with them.  Returns the number of entities matched
+  and a cursor to pass to the next call, or None when the query is exhausted.  The query must be built the same way on
+  every call for the cursor to be valid.
+  """
+  if cursor:
+    query.with_cursor(cursor)
+  keys = query.fetch(batchSize)
+  if keys:
+    db.delete(keys + (related(keys) if related else []))
+  return len(keys), (query.cursor() if len(keys) == batchSize else None)
+
+
+def startJob(project = None, before = None, after = None):
+  """Starts a job deleting instances, and then errors, of the given project (or all projects) dated before and at or
+  after the given times (or any time).  Returns the job."""
+  job = DeletionJob(project = project or None, before = before, after = after)
+  job.put()
+  _queueJob(job)
+  return job
+
+
+def _queueJob(job):
+  """Queues a task to delete the next batch of a job."""
+  taskqueue.add(queue_name = 'deletion', url = '/deletionWorker', params = {'key': str(job.key())})
+
+
+def _projectKey(job):
+  """Gets the key of the job's project."""
+  return db.Key.from_path(Project.kind(), job.project)
+
+
+def _instanceQuery(job):
+  """Builds the query for the instances the job deletes."""
+  query = LoggedErrorInstance.all(keys_only = True)
+  if job.project:
+    query = query.filter('project =', _projectKey(job))
+  if job.before:
+    query = query.filter('date <', job.before)
+  if job.after:
+    query = query.filter('date >=', job.after)
+  # Newest first, so a project's instances are found by the same index as its instance list.
+  return query.order('-date')
+
+
+def _archiveQuery(job):
+  """Builds the query for the archive blocks the job deletes."""
+  query = InstanceArchive.all(keys_only = True)
+  if job.project:
+    query = query.filter('project =', _projectKey(job))
+  if job.before:
+    query = query.filter('newest <', job.before)
+  if job.after:
+    query = query.filter('newest >=', job.after)
+  return query
+
+
+def _errorQuery(job):
+  """Builds the query for the errors the job deletes."""
+  query = LoggedError.all(keys_only = True)
+  if job.project:
+    query = query.filter('project =', _projectKey(job))
+  if job.before:
+    query = query.filter('lastOccurrence <', job.before)
+  return query
+
+
+def _errorEntityKeys(errorKeys):
+  """Gets the keys of the search indexes and summaries of the given errors.  Their archive blocks are all older than
+  their last occurrence, so the archive phase has already deleted them.
+
+  Active search indexes are first stored as inactive and taken off the facet counts, so a retried batch doesn't take
+  them off again.
+  """
+  indexKeys = [db.Key.from_path(SearchIndex.kind(), 'search', parent = key) for key in errorKeys]
+  active = [index for index in db.get(indexKeys) if index and index.active is not False]
+  if active:
+    for index in active:
+      index.active = False
+    db.put(active)
+    queue.uncountFacets(active)
+  return indexKeys + [db.Key.from_path(LoggedErrorSummary.kind(), str(key)) for key in errorKeys]
+
+
+def _forgetBacktraces(backtraceKeys):
+  """Forgets that the given backtraces are stored, so they are stored again when next reported.  Returns no more keys
+  to delete."""
+  memcache.delete_multi([key.name() for key in backtraceKeys], namespace = queue.BACKTRACE_NAMESPACE)
+  return []
+
+
+def _deleteProjectState(job):
+  """Deletes the facet counts and spike state of the job's project, or of every project."""
+  if job.project:
+    db.delete([db.Key.from_path(SearchFacets.kind(), job.project), db.Key.from_path(SpikeState.kind(), job.project)])
+  else:
+    db.delete(SearchFacets.all(keys_only = True).fetch(1000) + SpikeState.all(keys_only = True).fetch(1000))
+
+
+
+class DeletionWorker(webapp.RequestHandler):
+  """Worker handler for deleting a batch of a deletion job."""
+
+  def post(self):
+    """Deletes a batch, records progress and queues the next batch."""
+    if not isTaskRequest(self.request):
+      self.error(403)
+      return
+
+    job = DeletionJob.get(self.request.get('key'))
+    if not job or job.phase == 'done':
+      return
+
+    if job.phase == 'instances':
+      count, job.cursor = deleteBatch(_instanceQuery(job), job.cursor)
+      job.instancesDeleted += count
+      if not job.cursor:
+        job.phase = 'archives'
+    elif job.phase == 'archives':
+      count, job.cursor = deleteBatch(_archiveQuery(job), job.cursor)
+      job.archivesDeleted += count
+      if not job.cursor:
+        job.phase = 'done' if job.after else 'errors'
+    elif job.phase == 'errors':
+      count, job.cursor = deleteBatch(_errorQuery(job), job.cursor, related = _errorEntityKeys)
+      job.errorsDeleted += count
+      if not job.cursor:
+        if not job.before:
+          _deleteProjectState(job)
+        job.phase = 'done' if job.project or job.before else 'backtraces'
+    else:
+      _, job.cursor = deleteBatch(Backtrace.all(keys_only = True), job.cursor, related = _forgetBacktraces)
+      if not job.cursor:
+        job.phase = 'done'
+
+    job.put()
+    if job.phase == 'done':
+      logging.info('Deletion job %s deleted %d instances, %d archive blocks and %d errors',
+                   job.key(), job.instancesDeleted, job.archivesDeleted, job.errorsDeleted)
+    else:
+      _queueJob(job)
@@ -12,27 +12,70 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""AppEngine server for emailing new exceptions."""
+"""AppEngine server for emailing new exceptions.
 
-# pylint: disable=E0611
-from google.appengine.dist import use_library
-use_library('django', '1.2')
+The daily mail lists the errors first seen in the last day.  Their summaries, which carry the project name, are read
+in one pass a batch at a time, and only the ERRORS_PER_PROJECT most frequent of each project are kept in a heap, so a
+day with thousands of new errors lists them all in the counts without holding them all in memory.
+"""
 
-# pylint: disable=E0611
-from google.appengine.api import mail
-# pylint: disable=E0611
-from google.appengine.ext.webapp import template
+from backend import mail, template
 
 from common import getTemplatePath
 import config
-from datamodel import LoggedError
+from datamodel import LoggedErrorSummary
+import perf
 
 import collections
 from datetime import datetime, timedelta
+import heapq
+import itertools
 import logging
 
 
-
+# Most errors listed for each project.
+ERRORS_PER_PROJECT = 25
+
+BATCH_SIZE = 500
+
+
+def newSummaries(since):
+  """Yields the summaries of active errors first seen after the given time, newest first, reading a batch at a
+  time."""
+  query = (LoggedErrorSummary.all().filter('active =', True)
+      .filter('firstOccurrence >', since)
+      .order('-firstOccurrence'))
+  while True:
+    batch = query.fetch(BATCH_SIZE)
+    for summary in batch:
+      yield summary
+    if len(batch) < BATCH_SIZE:
+      return
+    query.with_cursor(query.cursor())
+
+
+def topErrors(summaries, size = ERRORS_PER_PROJECT):
+  """Groups summaries by project, keeping the given number with the highest counts in each.  Returns a sorted list of
+  (project, kept summaries by descending count, number of summaries not kept) and the number of summaries."""
+  heaps = collections.defaultdict(list)
+  totals = collections.defaultdict(int)
+  # Ties go to the summary seen first, without comparing summaries.
+  order = itertools.count()
+  for summary in summaries:
+    totals[summary.project] += 1
+    heap = heaps[summary.project]
+    entry = (summary.count or 0, -next(order), summary)
+    if len(heap) < size:
+      heapq.heappush(heap, entry)
+    else:
+      heapq.heappushpop(heap, entry)
+
+  projects = [(project, [entry[2] for entry in sorted(heap, reverse = True)], totals[project] - len(heap))
+              for project, heap in heaps.items()]
+  return sorted(projects), sum(totals.values())
+
+
+@perf.measured('emailCron')
 def main():
   """Runs the aggregation."""
   toEmail = config.get('toEmail')
@@ -41,18 +84,8 @@ def main():
   if toEmail and fromEmail:
     logging.info('running the email cron')
 
-    errorQuery = (LoggedError.all().filter('active =', True)
-        .filter('firstOccurrence >', datetime.now() - timedelta(hours = 24))
-        .order('-firstOccurrence'))
-
-    errors = errorQuery.fetch(500, 0)
-    errors.sort(key = lambda x: x.count, reverse=True)
-
-    projects = collections.defaultdict(list)
-    for error in errors:
-      projects[error.project.key().name()].append(error)
-
-    context = {'projects': sorted(projects.items()), 'errorCount': len(errors), 'baseUrl': config.get('baseUrl')}
+    projects, errorCount = topErrors(newSummaries(datetime.now() - timedelta(hours = 24)))
+    context = {'projects': projects, 'errorCount': errorCount, 'baseUrl': config.get('baseUrl')}
 
     body = template.render(getTemplatePath('dailymail.html'), context).strip()
     mail.send_mail(
@@ -61,4 +94,3 @@ def main():
 
 if __name__ == '__main__':
   main()
-
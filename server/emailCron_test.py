@@ -0,0 +1,65 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the daily mail."""
+
+import collections
+import unittest
+
+import localConfig
+localConfig.useLocalConfig('test', 'secret')
+
+# pylint: disable=C0413
+import emailCron
+
+
+Summary = collections.namedtuple('Summary', ['project', 'name', 'count'])
+
+
+
+class EmailCronTestCase(unittest.TestCase):
+  """Tests for the daily mail."""
+
+  def listed(self, summaries, size):
+    """Returns (project, names of the kept summaries, number not kept) triples and the number of summaries."""
+    projects, total = emailCron.topErrors(summaries, size)
+    return [(project, [summary.name for summary in kept], hidden) for project, kept, hidden in projects], total
+
+
+  def testKeepsHighestCounts(self):
+    """Test that the most frequent errors are kept by descending count and the rest are counted."""
+    summaries = [Summary('web', 'e%d' % count, count) for count in (5, 1, 9, 3, 7)]
+    self.assertEqual(([('web', ['e9', 'e7', 'e5'], 2)], 5), self.listed(summaries, 3))
+    self.assertEqual(([('web', ['e9', 'e7', 'e5', 'e3', 'e1'], 0)], 5), self.listed(summaries, 10))
+
+
+  def testTies(self):
+    """Test that errors with the same count are kept in the order they were read."""
+    summaries = [Summary('web', 'first', 2), Summary('web', 'none', None), Summary('web', 'second', 2),
+                 Summary('web', 'third', 2)]
+    self.assertEqual(([('web', ['first', 'second'], 2)], 4), self.listed(summaries, 2))
+    self.assertEqual(([('web', ['first', 'second', 'third', 'none'], 0)], 4), self.listed(summaries, 4))
+
+
+  def testMultipleProjects(self):
+    """Test that each project keeps its own most frequent errors, and projects are listed by name."""
+    summaries = [Summary('web', 'w1', 1), Summary('api', 'a5', 5), Summary('web', 'w8', 8), Summary('api', 'a2', 2),
+                 Summary('batch', 'b1', 1), Summary('api', 'a9', 9), Summary('web', 'w3', 3)]
+    self.assertEqual(([('api', ['a9', 'a5'], 1), ('batch', ['b1'], 0), ('web', ['w8', 'w3'], 1)], 7),
+                     self.listed(summaries, 2))
+
+
+  def testNoSummaries(self):
+    """Test that a day without new errors lists no projects."""
+    self.assertEqual(([], 0), self.listed([], 2))
@@ -0,0 +1,87 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Occurrence counts over time, in fixed size ring buffers packed in to a single string.
+
+Each resolution is a ring of bucket counts plus the number of its newest bucket (seconds since the epoch divided by
+the bucket width).  Adding an occurrence touches one bucket per resolution, so the cost and size stay the same however
+many occurrences an error has.  Occurrences older than a ring are dropped from it.
+"""
+
+import struct
+
+
+# (name, bucket width in seconds, number of buckets)
+RESOLUTIONS = (
+  ('minute', 60, 120),
+  ('hour', 3600, 168),
+  ('day', 86400, 90),
+)
+
+MAX_COUNT = 2 ** 32 - 1
+
+_NEWEST = struct.Struct('>q')
+
+
+
+class Histogram(object):
+  """Per minute, hour and day occurrence counts."""
+
+  def __init__(self, packed=None):
+    self.__newest = [0] * len(RESOLUTIONS)
+    self.__counts = [[0] * size for _, _, size in RESOLUTIONS]
+    if packed:
+      offset = 0
+      for i, (_, _, size) in enumerate(RESOLUTIONS):
+        self.__newest[i], = _NEWEST.unpack_from(packed, offset)
+        offset += _NEWEST.size
+        self.__counts[i] = list(struct.unpack_from('>%dI' % size, packed, offset))
+        offset += 4 * size
+
+
+  def add(self, timestamp, count=1):
+    """Adds count occurrences at the given time, in seconds since the epoch.  Returns self."""
+    for i, (_, width, size) in enumerate(RESOLUTIONS):
+      bucket = int(timestamp // width)
+      counts = self.__counts[i]
+      newest = self.__newest[i]
+      if bucket > newest:
+        for skipped in range(max(newest + 1, bucket - size + 1), bucket + 1):
+          counts[skipped % size] = 0
+        self.__newest[i] = newest = bucket
+      if bucket > newest - size:
+        counts[bucket % size] = min(MAX_COUNT, counts[bucket % size] + count)
+    return self
+
+
+  def series(self, resolution, now):
+    """Returns (bucket start timestamp, count) pairs for every bucket of the named resolution up to the one holding
+    now, oldest first."""
+    for i, (name, width, size) in enumerate(RESOLUTIONS):
+      if name == resolution:
+        counts = self.__counts[i]
+        newest = self.__newest[i]
+        last = max(newest, int(now // width))
+        return [(bucket * width, counts[bucket % size] if newest - size < bucket <= newest else 0)
+                for bucket in range(last - size + 1, last + 1)]
+    raise KeyError(resolution)
+
+
+  def pack(self):
+    """Returns the histogram as a string."""
+    parts = []
+    for i, (_, _, size) in enumerate(RESOLUTIONS):
+      parts.append(_NEWEST.pack(self.__newest[i]))
+      parts.append(struct.pack('>%dI' % size, *self.__counts[i]))
+    return b''.join(parts)
@@ -0,0 +1,63 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for occurrence histograms."""
+
+import unittest
+
+import histogram
+
+START = 1300000020
+
+
+
+class HistogramTestCase(unittest.TestCase):
+  """Tests for occurrence histograms."""
+
+  def testCounts(self):
+    """Test that occurrences land in the right buckets of each resolution."""
+    h = histogram.Histogram().add(START).add(START + 30, 2).add(START + 60)
+    minutes = h.series('minute', START + 60)
+    self.assertEqual(120, len(minutes))
+    self.assertEqual([(START, 3), (START + 60, 1)], minutes[-2:])
+    self.assertEqual(4, h.series('hour', START)[-1][1])
+    self.assertEqual(4, sum(count for _, count in h.series('day', START)))
+
+
+  def testRingWraps(self):
+    """Test that buckets that fall out of a ring are cleared and too old occurrences are dropped."""
+    h = histogram.Histogram().add(START, 5)
+    h.add(START + 120 * 60)
+    h.add(START + 60)
+    minutes = h.series('minute', START + 120 * 60)
+    self.assertEqual(2, sum(count for _, count in minutes))
+    self.assertEqual((START + 120 * 60, 1), minutes[-1])
+    self.assertEqual(7, sum(count for _, count in h.series('hour', START)))
+
+
+  def testSeriesAdvancesToNow(self):
+    """Test that a series ends at the current bucket even when nothing happened recently."""
+    h = histogram.Histogram().add(START, 7)
+    self.assertEqual(0, sum(count for _, count in h.series('minute', START + 3600 * 24)))
+    self.assertEqual(7, sum(count for _, count in h.series('day', START + 3600 * 24)))
+
+
+  def testPackRoundTrip(self):
+    """Test that packing keeps every count and has a fixed size."""
+    h = histogram.Histogram().add(START, 3).add(START + 7200, 4)
+    packed = h.pack()
+    self.assertEqual(len(histogram.Histogram().pack()), len(packed))
+    copy = histogram.Histogram(packed)
+    for name, _, _ in histogram.RESOLUTIONS:
+      self.assertEqual(h.series(name, START + 7200), copy.series(name, START + 7200))
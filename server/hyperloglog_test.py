@@ -0,0 +1,77 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for distinct count sketches."""
+
+import unittest
+
+import hyperloglog
+
+START = 1300000020
+
+
+
+class HyperLogLogTestCase(unittest.TestCase):
+  """Tests for distinct count sketches."""
+
+  def assertClose(self, expected, actual, tolerance):
+    """Asserts actual is within the given fraction of expected."""
+    self.assertTrue(abs(actual - expected) <= expected * tolerance, '%d is not close to %d' % (actual, expected))
+
+
+  def testSmallCountsAreExact(self):
+    """Test that small counts are exact and repeats are not counted."""
+    sketch = hyperloglog.HyperLogLog()
+    for i in range(20):
+      sketch.add(i).add(str(i)).add(u'%d' % i)
+    self.assertEqual(20, sketch.count())
+    self.assertEqual(0, hyperloglog.HyperLogLog().count())
+
+
+  def testLargeCounts(self):
+    """Test that large counts are within a few standard errors."""
+    sketch = hyperloglog.HyperLogLog()
+    for i in range(50000):
+      sketch.add('user%d' % i)
+    self.assertClose(50000, sketch.count(), 0.07)
+
+
+  def testMerge(self):
+    """Test that merged sketches count the union, including when folding a higher precision down."""
+    first = hyperloglog.HyperLogLog()
+    second = hyperloglog.HyperLogLog()
+    for i in range(3000):
+      first.add(i)
+      second.add(i + 2000)
+    self.assertClose(5000, hyperloglog.HyperLogLog(first.pack()).merge(second).count(), 0.07)
+
+    low = hyperloglog.HyperLogLog(precision = 8).merge(first).merge(second)
+    direct = hyperloglog.HyperLogLog(precision = 8)
+    for i in range(5000):
+      direct.add(i)
+    self.assertEqual(direct.pack(), low.pack())
+    self.assertRaises(ValueError, first.merge, low)
+
+
+  def testDailySketches(self):
+    """Test that windows union the right days and old days fall out of the ring."""
+    daily = hyperloglog.DailySketches()
+    daily.add('a', START).add('b', START + 86400).add('a', START + 2 * 86400)
+    daily = hyperloglog.DailySketches(daily.pack())
+    now = START + 2 * 86400
+    self.assertEqual(1, daily.union(1, now).count())
+    self.assertEqual(2, daily.union(7, now).count())
+    daily.add('c', START + 9 * 86400)
+    self.assertEqual(1, daily.union(7, START + 9 * 86400).count())
+    self.assertEqual(0, daily.union(7, START + 30 * 86400).count())
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Benchmark of the datastore write operations each stored error, summary and instance costs in index writes.
+
+Counts index rows from the model definitions in datamodel.py and the composite indexes in an index file, using the
+datastore's pricing of a new entity put: 2 write operations, plus 2 for each indexed property value, plus 1 for each
+composite index row.  List properties are given the numbers of environments and servers passed.
+
+Run it in an older checkout to compare against the indexes and models there.
+
+Usage: indexCostBenchmark.py [INDEX_FILE] [ENVIRONMENTS] [SERVERS]
+"""
+
+import os
+import sys
+
+import localConfig
+localConfig.useLocalConfig('benchmark', 'benchmark')
+
+# pylint: disable=C0413
+import config
+import datamodel
+
+
+MODELS = ['LoggedErrorInstance', 'LoggedError', 'LoggedErrorSummary']
+
+
+def readIndexes(path):
+  """Reads a map from kind to a list of the property name lists of its composite indexes from an index file."""
+  indexes = {}
+  version = str(config.get('datastoreVersion', 2))
+  properties = None
+  for line in open(path):
+    line = line.split('#')[0].strip()
+    if line.startswith('- kind:'):
+      properties = []
+      kind = line.split(':', 1)[1].strip().replace('<version>', version)
+      indexes.setdefault(kind, []).append(properties)
+    elif line.startswith('- name:') and properties is not None:
+      properties.append(line.split(':', 1)[1].strip())
+  return indexes
+
+
+def _valueCount(name, prop, listLengths):
+  """Returns the number of values the property has in a typical entity."""
+  return listLengths.get(name, 1) if isinstance(prop, datamodel.db.ListProperty) else 1
+
+
+def _indexed(prop):
+  """Returns whether the property is indexed."""
+  return getattr(prop, 'indexed', True) and not isinstance(prop, (datamodel.db.TextProperty,
+                                                                  datamodel.db.BlobProperty))
+
+
+def writeCost(model, composites, listLengths):
+  """Returns the number of indexed properties, built in index writes and composite index writes of a new entity."""
+  properties = model.properties()
+  indexed = [name for name, prop in properties.items() if _indexed(prop)]
+  builtIn = sum(2 * _valueCount(name, properties[name], listLengths) for name in indexed)
+  composite = 0
+  for names in composites:
+    rows = 1
+    for name in names:
+      rows *= _valueCount(name, properties[name], listLengths) if name in properties else 1
+    composite += rows
+  return len(indexed), builtIn, composite
+
+
+def main():
+  """Runs the benchmark."""
+  path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'index.yaml.template')
+  environments = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+  servers = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+  indexes = readIndexes(path)
+
+  print '%-22s %8s %10s %10s %10s %12s' % ('Kind', 'Indexed', 'Composites', 'Built in', 'Composite', 'Write ops')
+  for name in MODELS:
+    model = getattr(datamodel, name, None)
+    if model is None:
+      continue
+    listLengths = {'environments': environments, 'servers': servers}
+    if name == 'LoggedErrorSummary':
+      listLengths = dict((key, min(value, datamodel.SUMMARY_VALUES)) for key, value in listLengths.items())
+    composites = indexes.get(model.kind(), [])
+    indexed, builtIn, composite = writeCost(model, composites, listLengths)
+    print '%-22s %8d %10d %10d %10d %12d' % (name, indexed, len(composites), builtIn, composite,
+                                            2 + builtIn + composite)
+
+
+if __name__ == '__main__':
+  main()
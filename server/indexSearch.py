@@ -0,0 +1,25 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Mapper that brings each error's search index up to date, creating it and counting its facet values if it is
+missing.  Run it over the LoggedError kind to index errors stored before search was added, and after upgrading from a
+version whose search indexes lacked whether each error is active and when it last occurred."""
+
+import queue
+
+
+def process(entity):
+  """Process an error by indexing it."""
+  queue.indexErrors([entity])
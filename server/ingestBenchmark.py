@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+End to end ingestion benchmark on the local backend.
+
+Generates a corpus of Java, Python and Javascript reports whose fingerprints follow a Zipf distribution, posts them to
+/report and runs the reportWorker and aggregationWorker tasks they create, then prints throughput, latency per stage,
+queue backlog over time and RPCs per report.
+
+Reports arrive in batches.  After each batch the workers run up to TASKS_PER_REPORT tasks per report posted, so values
+below the roughly 2 tasks each report needs show how the backlog grows when the workers fall behind.
+
+Usage: ingestBenchmark.py [REPORTS] [FINGERPRINTS] [ZIPF_EXPONENT] [SERVERS] [ENVIRONMENTS] [TASKS_PER_REPORT]
+"""
+
+import bisect
+try:
+  from django.utils import simplejson as json
+except ImportError:
+  import json
+import random
+import sys
+import time
+
+import localConfig
+localConfig.useLocalConfig('benchmark', 'benchmark')
+
+# pylint: disable=C0413
+import backend
+from backend import taskqueue
+
+import backtrace_test
+import config
+import localrpc
+import localwebapp
+import server
+from datamodel import LoggedError
+
+
+BATCH_SIZE = 50
+
+JAVA_FRAMES = [line.strip() for line in backtrace_test.EXAMPLE.splitlines() if line.strip().startswith('at ')]
+
+WORDS = ['user', 'account', 'index', 'search', 'session', 'cache', 'request', 'render', 'query', 'sync', 'token',
+         'parse', 'fetch', 'store', 'load', 'update', 'notify', 'resolve', 'connect', 'handle']
+
+ENVIRONMENTS = ['prod', 'staging', 'dev', 'canary', 'test']
+
+
+
+####### Corpus. #######
+
+def _name(rng, count=2):
+  """Makes up an identifier."""
+  return ''.join(rng.choice(WORDS).title() for _ in range(count))
+
+
+def javaTrace(rng):
+  """Returns a (type, backtrace template) pair for a Java exception with a cause."""
+  exceptionType = 'com.example.%s.%sException' % (rng.choice(WORDS), _name(rng))
+  causeType = rng.choice(['java.io.IOException', 'java.sql.SQLException', 'java.lang.IllegalStateException'])
+  frames = ['\tat com.example.%s.%s.%s(%s.java:%d)' % (rng.choice(WORDS), _name(rng), _name(rng, 1).lower(),
+                                                      _name(rng), rng.randint(10, 900))
+            for _ in range(rng.randint(3, 10))]
+  frames += ['\t' + frame for frame in rng.sample(JAVA_FRAMES, rng.randint(5, len(JAVA_FRAMES)))]
+  lines = [exceptionType] + frames
+  lines += ['Caused by: %s: %%(message)s' % causeType] + frames[:3] + ['\t... %d more' % len(frames)]
+  return exceptionType, '\n'.join(lines)
+
+
+def pythonTrace(rng):
+  """Returns a (type, backtrace template) pair for a Python exception."""
+  exceptionType = rng.choice(['KeyError', 'ValueError', 'TypeError', 'AttributeError', 'HttpException'])
+  lines = ['Traceback (most recent call last):']
+  for _ in range(rng.randint(4, 20)):
+    module = '/'.join(rng.choice(WORDS) for _ in range(rng.randint(1, 3)))
+    lines.append('  File "/srv/app/%s.py", line %d, in %s' % (module, rng.randint(1, 2000), _name(rng, 1).lower()))
+    lines.append('    %s(%s)' % (_name(rng, 1).lower(), rng.choice(WORDS)))
+  lines.append('%s: %%(message)s' % exceptionType)
+  return exceptionType, '\n'.join(lines)
+
+
+def javascriptTrace(rng):
+  """Returns a (type, backtrace template) pair for a Javascript exception, as errorcatcher.js reports from Chrome."""
+  exceptionType = rng.choice(['TypeError', 'ReferenceError', 'RangeError'])
+  lines = ['%s: %%(message)s' % exceptionType]
+  for _ in range(rng.randint(3, 15)):
+    lines.append('    at %s (https://example.com/js/%s.js:%d:%d)' % (
+        _name(rng, 1).lower(), rng.choice(WORDS), rng.randint(1, 5000), rng.randint(1, 80)))
+  return exceptionType, '\n'.join(lines)
+
+
+LANGUAGES = [('java', javaTrace), ('python', pythonTrace), ('javascript', javascriptTrace)]
+
+
+
+class Corpus(object):
+  """Generates reports whose fingerprints follow a Zipf distribution."""
+
+  def __init__(self, fingerprints, exponent, servers, environments, seed=0):
+    self.__rng = random.Random(seed)
+    self.__errors = []
+    for i in range(fingerprints):
+      language, generator = LANGUAGES[i % len(LANGUAGES)]
+      exceptionType, template = generator(random.Random(i))
+      self.__errors.append((language, exceptionType, template))
+    total = 0
+    self.__cumulative = []
+    for rank in range(1, fingerprints + 1):
+      total += 1.0 / rank ** exponent
+      self.__cumulative.append(total)
+    self.__servers = ['%s-%d' % (ENVIRONMENTS[i % environments], i) for i in range(servers)]
+    self.__environments = ENVIRONMENTS[:environments]
+
+
+  def report(self):
+    """Returns the next serialized report."""
+    index = bisect.bisect(self.__cumulative, self.__rng.random() * self.__cumulative[-1])
+    language, exceptionType, template = self.__errors[min(index, len(self.__errors) - 1)]
+    n = self.__rng.randint(1, 100000)
+    message = 'Something went wrong for user #%d' % n
+    return json.dumps({
+      'project': language,
+      'serverName': self.__rng.choice(self.__servers),
+      'environment': self.__rng.choice(self.__environments),
+      'type': exceptionType,
+      'errorLevel': 'error',
+      'message': message,
+      'logMessage': 'Failed to handle request',
+      'backtrace': template % {'n': n, 'message': message},
+      'timestamp': time.time(),
+      'context': {'userId': n},
+    })
+
+
+
+####### Measurement. #######
+
+class Stage(object):
+  """Latencies of the requests handled by one stage of the pipeline."""
+
+  def __init__(self):
+    self.latencies = []
+    self.failures = 0
+
+
+  def record(self, elapsed, status):
+    """Records one request."""
+    self.latencies.append(elapsed)
+    if status >= 300:
+      self.failures += 1
+
+
+  def percentile(self, fraction):
+    """Returns the given percentile latency in milliseconds."""
+    ordered = sorted(self.latencies)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] * 1000 if ordered else 0
+
+
+
+def timedDispatch(stages, application, method, url, params=None, payload=None):
+  """Dispatches a request and records its latency under its path."""
+  start = time.time()
+  status = localwebapp.dispatch(application, method, url, params, payload)
+  stages.setdefault(url.split('?')[0], Stage()).record(time.time() - start, status)
+
+
+def runTasks(stages, application, maxTasks):
+  """Runs up to maxTasks push tasks, returning how many ran."""
+  count = 0
+  while maxTasks is None or count < maxTasks:
+    task = taskqueue.takePushTask()
+    if task is None:
+      break
+    timedDispatch(stages, application, task.method, task.url, task.params, task.payload)
+    count += 1
+  return count
+
+
+def backlog():
+  """Returns the number of tasks waiting in each queue."""
+  return [taskqueue.countTasks(name) for name in ('instances', 'aggregationWorker', 'aggregation')]
+
+
+def rpcCounts():
+  """Returns a copy of the RPC counts of every local service."""
+  return dict(localrpc.RPC_COUNTS)
+
+
+
+####### Main. #######
+
+def main():
+  """Runs the benchmark."""
+  args = [float(arg) for arg in sys.argv[1:]]
+  reports, fingerprints, exponent, servers, environments, tasksPerReport = (
+      args + [5000, 200, 1.1, 20, 3, 2.5][len(args):])
+  reports, fingerprints, servers, environments = int(reports), int(fingerprints), int(servers), int(environments)
+  if backend.BACKEND != 'local':
+    sys.exit('The benchmark needs "backend": "local"')
+
+  corpus = Corpus(fingerprints, exponent, servers, min(environments, len(ENVIRONMENTS)))
+  payloads = [corpus.report() for _ in range(reports)]
+  application = server.getApplication()
+  reportUrl = '/report?key=%s' % config.get('secretKey')
+  stages = {}
+  samples = []
+  startCounts = rpcCounts()
+
+  start = time.time()
+  for offset in range(0, reports, BATCH_SIZE):
+    batch = payloads[offset:offset + BATCH_SIZE]
+    for payload in batch:
+      timedDispatch(stages, application, 'POST', reportUrl, payload=payload)
+    runTasks(stages, application, int(len(batch) * tasksPerReport))
+    samples.append((time.time() - start, offset + len(batch)) + tuple(backlog()))
+  ingested = time.time() - start
+  while runTasks(stages, application, None):
+    pass
+  elapsed = time.time() - start
+  endCounts = rpcCounts()
+  samples.append((elapsed, reports) + tuple(backlog()))
+
+  aggregated = sum(error.count for error in LoggedError.all())
+  print 'Corpus: %d reports, %d fingerprints, zipf exponent %.2f, %d servers, %d environments' % (
+      reports, fingerprints, exponent, servers, environments)
+  print 'Posted in %.2fs, drained in %.2fs: %.0f reports/second end to end' % (ingested, elapsed, reports / elapsed)
+  print 'Errors: %d, aggregated count %d of %d reports, %d aggregation tasks never leased' % (
+      LoggedError.all().count(), aggregated, reports, samples[-1][-1])
+
+  print
+  print '%-20s %8s %8s %10s %10s' % ('Stage', 'Requests', 'Failed', 'p50 ms', 'p99 ms')
+  for path in ('/report', '/reportWorker', '/aggregationWorker'):
+    stage = stages.get(path, Stage())
+    print '%-20s %8d %8d %10.2f %10.2f' % (
+        path, len(stage.latencies), stage.failures, stage.percentile(0.5), stage.percentile(0.99))
+
+  print
+  print '%8s %8s %10s %18s %12s' % ('Seconds', 'Posted', 'instances', 'aggregationWorker', 'aggregation')
+  step = max(1, len(samples) // 20)
+  for sample in samples[::step] + ([samples[-1]] if (len(samples) - 1) % step else []):
+    print '%8.2f %8d %10d %18d %12d' % sample
+
+  print
+  print '%-32s %10s' % ('RPC', 'Per report')
+  for name in sorted(endCounts):
+    calls = endCounts[name] - startCounts.get(name, 0)
+    if calls:
+      print '%-32s %10.2f' % (name, float(calls) / reports)
+
+
+if __name__ == '__main__':
+  main()
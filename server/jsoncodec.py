@@ -0,0 +1,57 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""JSON encoding and decoding with the fastest implementation available.
+
+Implementations are tried in order: ujson, simplejson (which has C speedups when installed on its own), the standard
+library's json, and finally the simplejson bundled with Django, which is pure Python.  NAME is the one chosen.
+
+ujson rejects integers that don't fit in 64 bits, which reports may hold in their context, so values it fails on are
+handled by the next implementation available.
+"""
+
+try:
+  import simplejson as _standard
+except ImportError:
+  try:
+    import json as _standard
+  except ImportError:
+    from django.utils import simplejson as _standard
+
+try:
+  import ujson as _implementation
+except ImportError:
+  _implementation = _standard
+
+
+def _fallingBack(fast, standard):
+  """Returns a function calling fast, or standard when fast fails on the value."""
+  def call(value):
+    """Encodes or decodes the value."""
+    try:
+      return fast(value)
+    except (OverflowError, ValueError):
+      return standard(value)
+  return call
+
+
+NAME = _implementation.__name__
+
+if _implementation is _standard:
+  loads = _standard.loads
+  dumps = _standard.dumps
+else:
+  loads = _fallingBack(_implementation.loads, _standard.loads)
+  dumps = _fallingBack(_implementation.dumps, _standard.dumps)
@@ -0,0 +1,60 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for JSON encoding and decoding."""
+
+import json
+import unittest
+
+import jsoncodec
+
+
+
+class JsonCodecTestCase(unittest.TestCase):
+  """Tests for JSON encoding and decoding."""
+
+  def report(self, i):
+    """Returns a report like a client sends."""
+    return {
+      u'project': u'frontend', u'environment': u'prod', u'serverName': u'web%d' % (i % 3),
+      u'message': u'Bad value caf\xe9 %d' % i, u'timestamp': 1300000000.25 + i, u'backtrace': u'Traceback\n  at /x',
+      u'errorLevel': u'error', u'context': {u'userId': i - 5, u'big': 2 ** 70, u'small': -2 ** 70,
+                                           u'tags': [True, False, None, 1.5]}
+    }
+
+
+  def testReportsRoundTrip(self):
+    """Test that reports, including integers beyond 64 bits, decode to what was encoded."""
+    reports = [self.report(i) for i in range(20)]
+    for report in reports:
+      self.assertEqual(report, jsoncodec.loads(jsoncodec.dumps(report)))
+    self.assertEqual(reports, jsoncodec.loads(jsoncodec.dumps(reports)))
+    self.assertEqual(reports, jsoncodec.loads(json.dumps(reports)))
+
+
+  def testFallingBack(self):
+    """Test that values the fast implementation fails on are handled by the standard one."""
+    def fast(value):
+      """Fails on integers beyond 64 bits like ujson."""
+      if abs(value['big']) >= 2 ** 64:
+        raise OverflowError('int too big to convert')
+      return 'fast'
+    # pylint: disable=W0212
+    dumps = jsoncodec._fallingBack(fast, json.dumps)
+    self.assertEqual('fast', dumps({'big': 1}))
+    self.assertEqual({'big': 2 ** 70}, json.loads(dumps({'big': 2 ** 70})))
+
+    loads = jsoncodec._fallingBack(lambda _: json.loads('{"abc", [1, 2'), json.loads)
+    self.assertEqual([1], loads('[1]'))
+    self.assertRaises(ValueError, loads, '{"abc", [1, 2')
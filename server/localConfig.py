@@ -0,0 +1,39 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Configuration for tests and benchmarks that run the server on the local backend.
+
+Call useLocalConfig before importing anything that reads the config.
+"""
+
+try:
+  from django.utils import simplejson as json
+except ImportError:
+  import json
+import atexit
+import os
+import tempfile
+
+
+def useLocalConfig(name, secretKey):
+  """Points GEC_CONFIG at a temporary config for the local backend with an in memory database, unless it is already
+  set."""
+  if 'GEC_CONFIG' in os.environ:
+    return
+  configFile = tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False)
+  with configFile:
+    json.dump({'name': name, 'secretKey': secretKey, 'requireAuth': False, 'backend': 'local',
+               'localDatabase': ':memory:'}, configFile)
+  atexit.register(os.unlink, configFile.name)
+  os.environ['GEC_CONFIG'] = configFile.name
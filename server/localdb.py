@@ -0,0 +1,956 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""SQLite implementation of the parts of google.appengine.ext.db used by the server.
+
+Each kind gets a table with a column per property, plus a side table per list property.  Every indexed property gets
+a single property index, and queries are answered with SQL.  Cursors are keyset based, so they stay valid while the
+entities before them are deleted.
+"""
+
+import base64
+import collections
+from datetime import datetime
+import json
+import pickle
+import sqlite3
+import threading
+
+import localrpc
+
+try:
+  basestring
+except NameError:
+  # pylint: disable=C0103,W0622
+  basestring = str
+  long = int
+  unicode = str
+
+
+
+####### Errors. #######
+
+class Error(Exception):
+  """Base class for datastore errors."""
+
+
+class BadValueError(Error):
+  """A property was given an invalid value."""
+
+
+class BadKeyError(Error):
+  """A key could not be parsed."""
+
+
+class NotSavedError(Error):
+  """The entity has no key because it has never been put."""
+
+
+class KindError(Error):
+  """No model class is defined for a kind."""
+
+
+class Timeout(Error):
+  """The datastore timed out.  Never raised locally, but callers catch it."""
+
+
+
+####### Value types. #######
+
+class Text(unicode):
+  """Long, unindexed text."""
+
+
+class Blob(bytes):
+  """Long, unindexed binary data."""
+
+
+class ByteString(bytes):
+  """Short, indexed binary data."""
+
+
+
+class Key(object):
+  """A datastore key: a path of (kind, id or name) pairs."""
+
+  def __init__(self, encoded=None):
+    self._path = ()
+    if encoded is not None:
+      if isinstance(encoded, Key):
+        self._path = encoded._path
+        return
+      try:
+        padded = str(encoded) + '=' * (-len(encoded) % 4)
+        self._path = tuple(tuple(pair) for pair in json.loads(base64.urlsafe_b64decode(padded).decode('utf-8')))
+      except (TypeError, ValueError):
+        raise BadKeyError('Invalid key: %r' % encoded)
+      if not self._path:
+        raise BadKeyError('Invalid key: %r' % encoded)
+
+
+  @classmethod
+  def from_path(cls, *args, **kwds):
+    """Builds a key from alternating kinds and ids or names, optionally below a parent key."""
+    parent = kwds.get('parent')
+    key = cls()
+    path = list(parent._path) if parent else []
+    for i in range(0, len(args), 2):
+      path.append((args[i], args[i + 1]))
+    key._path = tuple(path)
+    return key
+
+
+  def kind(self):
+    """Returns the kind of the entity."""
+    return self._path[-1][0]
+
+
+  def id(self):
+    """Returns the numeric id, or None if the key has a name."""
+    value = self._path[-1][1]
+    return value if isinstance(value, (int, long)) else None
+
+
+  def name(self):
+    """Returns the name, or None if the key has a numeric id."""
+    value = self._path[-1][1]
+    return value if isinstance(value, basestring) else None
+
+
+  def id_or_name(self):
+    """Returns the id or name."""
+    return self._path[-1][1]
+
+
+  def parent(self):
+    """Returns the parent key, or None."""
+    if len(self._path) < 2:
+      return None
+    key = Key()
+    key._path = self._path[:-1]
+    return key
+
+
+  def __str__(self):
+    encoded = base64.urlsafe_b64encode(json.dumps([list(pair) for pair in self._path]).encode('utf-8'))
+    return encoded.decode('ascii').rstrip('=')
+
+
+  def __repr__(self):
+    return 'datastore_types.Key.from_path(%s)' % ', '.join(repr(part) for pair in self._path for part in pair)
+
+
+  def __eq__(self, other):
+    return isinstance(other, Key) and self._path == other._path
+
+
+  def __ne__(self, other):
+    return not self == other
+
+
+  def __hash__(self):
+    return hash(self._path)
+
+
+
+def _toKey(value):
+  """Converts a model, key or encoded key to a key."""
+  if isinstance(value, Model):
+    return value.key()
+  if isinstance(value, Key):
+    return value
+  return Key(value)
+
+
+
+####### Properties. #######
+
+class Property(object):
+  """A property of a model."""
+
+  data_type = object
+
+  def __init__(self, verbose_name=None, name=None, default=None, required=False, indexed=True, **_):
+    self.verbose_name = verbose_name
+    self.name = name
+    self.default = default
+    self.required = required
+    self.indexed = indexed
+
+
+  def default_value(self):
+    """Returns the value of the property for an entity that never set it."""
+    return self.default
+
+
+  def validate(self, value):
+    """Checks the given value, returning the value to store."""
+    if value is None and self.required:
+      raise BadValueError('Property %s is required' % self.name)
+    return value
+
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    if self.name in instance._values:
+      return instance._values[self.name]
+    return self.default_value()
+
+
+  def __set__(self, instance, value):
+    instance._values[self.name] = self.validate(value)
+
+
+  def get_value_for_datastore(self, instance):
+    """Returns the value to store for the given entity."""
+    return self.__get__(instance, type(instance))
+
+
+  def make_value_from_datastore(self, value):
+    """Converts a stored value back to the property's value."""
+    return value
+
+
+  def fromStorage(self, value):
+    """Converts a value read from SQLite to the datastore type."""
+    return value
+
+
+
+class StringProperty(Property):
+  """A short string."""
+
+  data_type = unicode
+
+  def __init__(self, verbose_name=None, multiline=False, **kwds):
+    Property.__init__(self, verbose_name, **kwds)
+    self.multiline = multiline
+
+
+  def validate(self, value):
+    if isinstance(value, bytes):
+      value = value.decode('utf-8')
+    return Property.validate(self, value)
+
+
+
+class TextProperty(Property):
+  """Long text, never indexed."""
+
+  data_type = Text
+
+  def __init__(self, verbose_name=None, **kwds):
+    kwds['indexed'] = False
+    Property.__init__(self, verbose_name, **kwds)
+
+
+  def validate(self, value):
+    if isinstance(value, bytes):
+      value = value.decode('utf-8')
+    return Property.validate(self, None if value is None else Text(value))
+
+
+  def fromStorage(self, value):
+    if value is None:
+      return None
+    if isinstance(value, unicode):
+      return Text(value)
+    # Like the datastore, keep blobs put in a text property as blobs.
+    return Blob(bytes(value))
+
+
+
+class BlobProperty(Property):
+  """Binary data, never indexed."""
+
+  data_type = Blob
+
+  def __init__(self, verbose_name=None, **kwds):
+    kwds['indexed'] = False
+    Property.__init__(self, verbose_name, **kwds)
+
+
+  def fromStorage(self, value):
+    return None if value is None else Blob(bytes(value))
+
+
+
+class ByteStringProperty(Property):
+  """Short, indexed binary data."""
+
+  data_type = ByteString
+
+  def fromStorage(self, value):
+    return None if value is None else ByteString(bytes(value))
+
+
+
+class IntegerProperty(Property):
+  """An integer."""
+
+  data_type = int
+
+
+
+class FloatProperty(Property):
+  """A floating point number."""
+
+  data_type = float
+
+
+
+class BooleanProperty(Property):
+  """A boolean."""
+
+  data_type = bool
+
+  def fromStorage(self, value):
+    return None if value is None else bool(value)
+
+
+
+class DateTimeProperty(Property):
+  """A date and time."""
+
+  data_type = datetime
+
+  def __init__(self, verbose_name=None, auto_now=False, auto_now_add=False, **kwds):
+    Property.__init__(self, verbose_name, **kwds)
+    self.auto_now = auto_now
+    self.auto_now_add = auto_now_add
+
+
+  def get_value_for_datastore(self, instance):
+    if self.auto_now or (self.auto_now_add and self.__get__(instance, type(instance)) is None):
+      self.__set__(instance, datetime.now())
+    return Property.get_value_for_datastore(self, instance)
+
+
+  def fromStorage(self, value):
+    return None if value is None else datetime.strptime(value, _DATETIME_FORMAT)
+
+
+
+class ListProperty(Property):
+  """A list of values, stored in a side table."""
+
+  data_type = list
+
+  def __init__(self, item_type, verbose_name=None, default=None, **kwds):
+    Property.__init__(self, verbose_name, default=default, **kwds)
+    self.item_type = item_type
+
+
+  def default_value(self):
+    return list(self.default or [])
+
+
+  def validate(self, value):
+    return list(value or [])
+
+
+  def fromStorage(self, value):
+    if self.item_type is datetime:
+      return [datetime.strptime(item, _DATETIME_FORMAT) for item in value]
+    return list(value)
+
+
+
+class StringListProperty(ListProperty):
+  """A list of strings."""
+
+  def __init__(self, verbose_name=None, default=None, **kwds):
+    ListProperty.__init__(self, basestring, verbose_name, default=default, **kwds)
+
+
+
+class ReferenceProperty(Property):
+  """A reference to another entity, fetched when the attribute is read."""
+
+  data_type = Key
+
+  def __init__(self, reference_class=None, verbose_name=None, collection_name=None, **kwds):
+    Property.__init__(self, verbose_name, **kwds)
+    self.reference_class = reference_class
+
+
+  def __get__(self, instance, owner):
+    if instance is None:
+      return self
+    resolved = instance._references.get(self.name)
+    if resolved is None:
+      key = instance._values.get(self.name)
+      if key is None:
+        return None
+      resolved = get(key)
+      instance._references[self.name] = resolved
+    return resolved
+
+
+  def __set__(self, instance, value):
+    instance._references.pop(self.name, None)
+    if isinstance(value, Model):
+      instance._references[self.name] = value
+      value = value.key()
+    elif value is not None:
+      value = _toKey(value)
+    instance._values[self.name] = self.validate(value)
+
+
+  def get_value_for_datastore(self, instance):
+    return instance._values.get(self.name)
+
+
+  def fromStorage(self, value):
+    return None if value is None else Key(value)
+
+
+
+####### Models. #######
+
+_MODEL_CLASSES = []
+
+
+class PropertiedClass(type):
+  """Metaclass that names each property and records the properties of each model class."""
+
+  def __init__(cls, name, bases, attrs):
+    type.__init__(cls, name, bases, attrs)
+    properties = {}
+    for base in reversed(cls.__mro__[1:]):
+      properties.update(getattr(base, '_properties', {}))
+    for attrName, value in attrs.items():
+      if isinstance(value, Property):
+        value.name = value.name or attrName
+        properties[attrName] = value
+    cls._properties = properties
+    _MODEL_CLASSES.append(cls)
+
+
+
+_ModelBase = PropertiedClass('_ModelBase', (object,), {})
+
+
+class Model(_ModelBase):
+  """Base class for datastore entities."""
+
+  def __init__(self, parent=None, key_name=None, key=None, **kwds):
+    self._values = {}
+    self._references = {}
+    self._key = key
+    self._parent = _toKey(parent) if parent is not None else None
+    self._keyName = key_name
+    for name, prop in self._properties.items():
+      if name in kwds:
+        prop.__set__(self, kwds[name])
+      elif not isinstance(prop, ReferenceProperty):
+        self._values[name] = prop.default_value()
+
+
+  @classmethod
+  def kind(cls):
+    """Returns the datastore name for this model class."""
+    return cls.__name__
+
+
+  @classmethod
+  def properties(cls):
+    """Returns a dict of the properties of this model class."""
+    return dict(cls._properties)
+
+
+  @classmethod
+  def all(cls, keys_only=False):
+    """Returns a query over all entities of this model class."""
+    return Query(cls, keys_only=keys_only)
+
+
+  @classmethod
+  def get(cls, keys):
+    """Gets one entity or a list of entities by key."""
+    return get(keys)
+
+
+  @classmethod
+  def get_by_key_name(cls, key_names, parent=None):
+    """Gets one entity or a list of entities by key name."""
+    parent = _toKey(parent) if parent is not None else None
+    if isinstance(key_names, basestring):
+      return get(Key.from_path(cls.kind(), key_names, parent=parent))
+    return get([Key.from_path(cls.kind(), name, parent=parent) for name in key_names])
+
+
+  @classmethod
+  def get_by_id(cls, ids, parent=None):
+    """Gets one entity or a list of entities by numeric id."""
+    parent = _toKey(parent) if parent is not None else None
+    if isinstance(ids, (int, long)):
+      return get(Key.from_path(cls.kind(), ids, parent=parent))
+    return get([Key.from_path(cls.kind(), i, parent=parent) for i in ids])
+
+
+  @classmethod
+  def get_or_insert(cls, key_name, **kwds):
+    """Gets the named entity, creating it if it does not exist."""
+    with _LOCK:
+      entity = cls.get_by_key_name(key_name, parent=kwds.get('parent'))
+      if entity is None:
+        entity = cls(key_name=key_name, **kwds)
+        entity.put()
+      return entity
+
+
+  def key(self):
+    """Returns the key of this entity."""
+    if self._key is None:
+      if self._keyName is None:
+        raise NotSavedError('Entity has not been put')
+      self._key = Key.from_path(self.kind(), self._keyName, parent=self._parent)
+    return self._key
+
+
+  def has_key(self):
+    """Returns whether this entity has a key yet."""
+    return self._key is not None or self._keyName is not None
+
+
+  def is_saved(self):
+    """Returns whether this entity has been put."""
+    return self._key is not None
+
+
+  def parent_key(self):
+    """Returns the key of the parent entity."""
+    return self._key.parent() if self._key is not None else self._parent
+
+
+  def parent(self):
+    """Returns the parent entity."""
+    parentKey = self.parent_key()
+    return get(parentKey) if parentKey else None
+
+
+  def put(self):
+    """Stores this entity."""
+    return put(self)
+
+
+  def delete(self):
+    """Deletes this entity."""
+    delete(self)
+
+
+
+####### Storage. #######
+
+_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+_LOCK = threading.RLock()
+
+_STATE = {'path': ':memory:', 'connection': None, 'tables': {}, 'ids': {}}
+
+
+def configure(path):
+  """Sets the SQLite database to use, closing the current one."""
+  with _LOCK:
+    if _STATE['connection'] is not None:
+      _STATE['connection'].close()
+    _STATE.update(path=path, connection=None, tables={}, ids={})
+
+
+def _connection():
+  """Returns the shared connection, opening it if needed."""
+  if _STATE['connection'] is None:
+    connection = sqlite3.connect(_STATE['path'], check_same_thread=False, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.execute('PRAGMA journal_mode = MEMORY')
+    _STATE['connection'] = connection
+  return _STATE['connection']
+
+
+def _quote(name):
+  """Quotes an SQL identifier."""
+  return '"%s"' % name.replace('"', '""')
+
+
+def _classForKind(kind):
+  """Returns the model class for the given kind."""
+  for cls in reversed(_MODEL_CLASSES):
+    if cls is not Model and cls.kind() == kind:
+      return cls
+  raise KindError('No model class found for kind %r' % kind)
+
+
+def _ensureTable(cls):
+  """Creates or extends the tables for the given model class, returning the kind."""
+  kind = cls.kind()
+  columns = _STATE['tables'].get(kind)
+  if columns is not None and len(columns) == len(cls._properties):
+    return kind
+
+  db = _connection()
+  db.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT PRIMARY KEY, id INTEGER, ancestry TEXT)' % _quote(kind))
+  existing = set(row[1] for row in db.execute('PRAGMA table_info(%s)' % _quote(kind)))
+  for name, prop in cls._properties.items():
+    if isinstance(prop, ListProperty):
+      table = _quote(kind + '__' + name)
+      db.execute('CREATE TABLE IF NOT EXISTS %s (key TEXT, value)' % table)
+      db.execute('CREATE INDEX IF NOT EXISTS %s ON %s (key)' % (_quote(kind + '__' + name + '__key'), table))
+      if prop.indexed:
+        db.execute('CREATE INDEX IF NOT EXISTS %s ON %s (value, key)' % (_quote(kind + '__' + name + '__value'), table))
+    elif name not in existing:
+      db.execute('ALTER TABLE %s ADD COLUMN %s' % (_quote(kind), _quote(name)))
+      if prop.indexed:
+        db.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s)' % (_quote(kind + '__' + name), _quote(kind), _quote(name)))
+  _STATE['tables'][kind] = set(cls._properties)
+  return kind
+
+
+def _encode(value):
+  """Converts a datastore value to an SQLite value."""
+  if isinstance(value, datetime):
+    return value.strftime(_DATETIME_FORMAT)
+  if isinstance(value, Model):
+    return str(value.key())
+  if isinstance(value, Key):
+    return str(value)
+  if isinstance(value, bool):
+    return int(value)
+  if isinstance(value, bytes) and not isinstance(value, str):
+    return sqlite3.Binary(value)
+  if isinstance(value, (Blob, ByteString)):
+    return sqlite3.Binary(value)
+  return value
+
+
+def _allocateId(kind):
+  """Allocates a new numeric id for an entity of the given kind."""
+  if kind not in _STATE['ids']:
+    row = _connection().execute('SELECT MAX(id) FROM %s' % _quote(kind)).fetchone()
+    _STATE['ids'][kind] = row[0] or 0
+  _STATE['ids'][kind] += 1
+  return _STATE['ids'][kind]
+
+
+def _ancestry(key):
+  """Returns a string that contains each ancestor of the key (and the key itself) delimited by '|'."""
+  parts = []
+  while key is not None:
+    parts.append(str(key))
+    key = key.parent()
+  return '|' + '|'.join(parts) + '|'
+
+
+def _asList(values):
+  """Returns (list, wasSingle) for a single value or a list of values."""
+  if isinstance(values, (list, tuple)):
+    return list(values), False
+  return [values], True
+
+
+@localrpc.rpc('datastore_v3', 'Put')
+def put(models):
+  """Stores one entity or a list of entities, returning the key or keys."""
+  models, single = _asList(models)
+  keys = []
+  with _LOCK:
+    db = _connection()
+    db.execute('BEGIN')
+    try:
+      for model in models:
+        cls = type(model)
+        kind = _ensureTable(cls)
+        if not model.has_key():
+          model._key = Key.from_path(kind, _allocateId(kind), parent=model._parent)
+        key = model.key()
+        model._key = key
+
+        columns = ['key', 'id', 'ancestry']
+        values = [str(key), key.id(), _ancestry(key)]
+        for name, prop in cls._properties.items():
+          value = prop.get_value_for_datastore(model)
+          if isinstance(prop, ListProperty):
+            table = _quote(kind + '__' + name)
+            db.execute('DELETE FROM %s WHERE key = ?' % table, (str(key),))
+            db.executemany('INSERT INTO %s (key, value) VALUES (?, ?)' % table,
+                           [(str(key), _encode(item)) for item in value or []])
+          else:
+            columns.append(_quote(name))
+            values.append(_encode(value))
+        db.execute('INSERT OR REPLACE INTO %s (%s) VALUES (%s)' %
+                   (_quote(kind), ', '.join(columns), ', '.join('?' * len(columns))), values)
+        keys.append(key)
+      db.execute('COMMIT')
+    except:
+      db.execute('ROLLBACK')
+      raise
+  return keys[0] if single else keys
+
+
+def _fromRow(cls, row):
+  """Builds an entity from a table row."""
+  key = Key(row['key'])
+  entity = cls(key=key)
+  kind = cls.kind()
+  for name, prop in cls._properties.items():
+    if isinstance(prop, ListProperty):
+      stored = [item[0] for item in _connection().execute(
+          'SELECT value FROM %s WHERE key = ? ORDER BY rowid' % _quote(kind + '__' + name), (str(key),))]
+    else:
+      stored = row[name]
+    entity._values[name] = prop.make_value_from_datastore(prop.fromStorage(stored))
+  return entity
+
+
+@localrpc.rpc('datastore_v3', 'Get')
+def get(keys):
+  """Gets one entity or a list of entities by key.  Missing entities are returned as None."""
+  keys, single = _asList(keys)
+  keys = [_toKey(key) for key in keys]
+  found = {}
+  with _LOCK:
+    byKind = collections.defaultdict(list)
+    for key in keys:
+      byKind[key.kind()].append(key)
+    for kind, kindKeys in byKind.items():
+      cls = _classForKind(kind)
+      _ensureTable(cls)
+      encoded = [str(key) for key in kindKeys]
+      for start in range(0, len(encoded), 500):
+        chunk = encoded[start:start + 500]
+        rows = _connection().execute('SELECT * FROM %s WHERE key IN (%s)' % (_quote(kind), ', '.join('?' * len(chunk))),
+                                     chunk)
+        for row in rows.fetchall():
+          found[row['key']] = _fromRow(cls, row)
+  results = [found.get(str(key)) for key in keys]
+  return results[0] if single else results
+
+
+@localrpc.rpc('datastore_v3', 'Delete')
+def delete(models):
+  """Deletes one entity or a list of entities, given as entities or keys."""
+  models, _ = _asList(models)
+  keys = [_toKey(model) for model in models]
+  with _LOCK:
+    db = _connection()
+    db.execute('BEGIN')
+    try:
+      for key in keys:
+        cls = _classForKind(key.kind())
+        kind = _ensureTable(cls)
+        db.execute('DELETE FROM %s WHERE key = ?' % _quote(kind), (str(key),))
+        for name, prop in cls._properties.items():
+          if isinstance(prop, ListProperty):
+            db.execute('DELETE FROM %s WHERE key = ?' % _quote(kind + '__' + name), (str(key),))
+      db.execute('COMMIT')
+    except:
+      db.execute('ROLLBACK')
+      raise
+
+
+def run_in_transaction(function, *args, **kwds):
+  """Runs the function while holding the datastore lock."""
+  with _LOCK:
+    return function(*args, **kwds)
+
+
+def model_to_protobuf(model):
+  """Serializes an entity (as a pickle, not a protocol buffer)."""
+  values = dict((name, prop.get_value_for_datastore(model)) for name, prop in model._properties.items())
+  return pickle.dumps((model.kind(), str(model.key()), values), pickle.HIGHEST_PROTOCOL)
+
+
+def model_from_protobuf(serialized):
+  """Deserializes an entity serialized by model_to_protobuf."""
+  kind, key, values = pickle.loads(serialized)
+  entity = _classForKind(kind)(key=Key(key))
+  entity._values.update(values)
+  return entity
+
+
+
+####### Queries. #######
+
+_OPERATORS = {'=': '=', '==': '=', '<': '<', '<=': '<=', '>': '>', '>=': '>=', '!=': '!=', 'IN': 'IN', 'in': 'IN'}
+
+
+class Query(object):
+  """A query over the entities of one model class."""
+
+  BATCH_SIZE = 100
+
+  def __init__(self, model_class, keys_only=False):
+    self._modelClass = model_class
+    self._keysOnly = keys_only
+    self._filters = []
+    self._orders = []
+    self._ancestor = None
+    self._startCursor = None
+    self._lastPosition = None
+
+
+  def filter(self, property_operator, value):
+    """Adds a filter such as 'date >=' to the query."""
+    parts = property_operator.split()
+    name = parts[0]
+    operator = _OPERATORS[parts[1]] if len(parts) > 1 else '='
+    if name == '__key__':
+      prop = None
+    else:
+      prop = self._modelClass._properties[name]
+    if operator == 'IN':
+      value = [_encode(item) for item in value]
+    else:
+      value = _encode(value)
+    self._filters.append((name, prop, operator, value))
+    return self
+
+
+  def order(self, prop):
+    """Adds a sort order such as '-date' to the query."""
+    descending = prop.startswith('-')
+    self._orders.append((prop.lstrip('-'), descending))
+    return self
+
+
+  def ancestor(self, ancestor):
+    """Restricts the query to descendants of the given entity or key."""
+    self._ancestor = str(_toKey(ancestor))
+    return self
+
+
+  def with_cursor(self, start_cursor):
+    """Starts the query after the position recorded in the given cursor."""
+    self._startCursor = start_cursor
+    return self
+
+
+  def cursor(self):
+    """Returns a cursor for the position after the last result returned."""
+    if self._lastPosition is None:
+      return self._startCursor
+    return base64.urlsafe_b64encode(json.dumps(self._lastPosition).encode('utf-8')).decode('ascii')
+
+
+  def __orderColumns(self):
+    """Returns (column, descending) pairs, always ending with the key."""
+    orders = [(name if name != '__key__' else 'key', descending) for name, descending in self._orders]
+    if not orders or orders[-1][0] != 'key':
+      orders.append(('key', False))
+    return orders
+
+
+  def __where(self, kind, cursor):
+    """Builds the WHERE clause and its parameters."""
+    clauses = []
+    params = []
+    for name, prop, operator, value in self._filters:
+      if operator == 'IN':
+        placeholders = '(%s)' % ', '.join('?' * len(value))
+      else:
+        placeholders = '?'
+        value = [value]
+      if isinstance(prop, ListProperty):
+        clauses.append('EXISTS (SELECT 1 FROM %s l WHERE l.key = t.key AND l.value %s %s)' %
+                       (_quote(kind + '__' + name), operator, placeholders))
+      else:
+        clauses.append('t.%s %s %s' % (_quote(name if prop else 'key'), operator, placeholders))
+      params.extend(value)
+
+    if self._ancestor:
+      clauses.append("instr(t.ancestry, ?) > 0")
+      params.append('|' + self._ancestor + '|')
+
+    orders = self.__orderColumns()
+    for column, _ in orders:
+      if column != 'key':
+        # Like the datastore, entities without a value for a sort property are not returned.
+        clauses.append('t.%s IS NOT NULL' % _quote(column))
+
+    if cursor:
+      position = json.loads(base64.urlsafe_b64decode(str(cursor)).decode('utf-8'))
+      alternatives = []
+      for i, (column, descending) in enumerate(orders):
+        terms = ['t.%s = ?' % _quote(previous) for previous, _ in orders[:i]]
+        terms.append('t.%s %s ?' % (_quote(column), '<' if descending else '>'))
+        alternatives.append('(%s)' % ' AND '.join(terms))
+        params.extend(position[:i + 1])
+      clauses.append('(%s)' % ' OR '.join(alternatives))
+
+    return (' WHERE ' + ' AND '.join(clauses)) if clauses else '', params
+
+
+  @localrpc.rpc('datastore_v3', 'RunQuery')
+  def __run(self, limit, offset, cursor):
+    """Runs the query, returning a list of (entity or key, position)."""
+    cls = self._modelClass
+    with _LOCK:
+      kind = _ensureTable(cls)
+      where, params = self.__where(kind, cursor)
+      orders = self.__orderColumns()
+      sql = 'SELECT t.* FROM %s t%s ORDER BY %s' % (
+          _quote(kind), where, ', '.join('t.%s %s' % (_quote(column), 'DESC' if descending else 'ASC')
+                                         for column, descending in orders))
+      if limit is not None:
+        sql += ' LIMIT %d OFFSET %d' % (limit, offset or 0)
+      elif offset:
+        sql += ' LIMIT -1 OFFSET %d' % offset
+      results = []
+      for row in _connection().execute(sql, params).fetchall():
+        position = [row[column] for column, _ in orders]
+        if self._keysOnly:
+          results.append((Key(row['key']), position))
+        else:
+          results.append((_fromRow(cls, row), position))
+      return results
+
+
+  def fetch(self, limit, offset=0):
+    """Returns up to limit results, skipping the first offset."""
+    results = self.__run(limit, offset, self._startCursor)
+    if results:
+      self._lastPosition = results[-1][1]
+    return [result for result, _ in results]
+
+
+  def get(self):
+    """Returns the first result, or None."""
+    results = self.fetch(1)
+    return results[0] if results else None
+
+
+  @localrpc.rpc('datastore_v3', 'Count')
+  def count(self, limit=None):
+    """Counts the results, up to limit."""
+    with _LOCK:
+      kind = _ensureTable(self._modelClass)
+      where, params = self.__where(kind, self._startCursor)
+      sql = 'SELECT COUNT(*) FROM (SELECT 1 FROM %s t%s%s)' % (
+          _quote(kind), where, ' LIMIT %d' % limit if limit is not None else '')
+      return _connection().execute(sql, params).fetchone()[0]
+
+
+  def __iter__(self):
+    """Iterates over every result in batches, so the datastore is not locked between batches."""
+    cursor = self._startCursor
+    while True:
+      results = self.__run(self.BATCH_SIZE, 0, cursor)
+      for result, position in results:
+        self._lastPosition = position
+        yield result
+      if len(results) < self.BATCH_SIZE:
+        return
+      cursor = self.cursor()
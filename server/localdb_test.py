@@ -0,0 +1,103 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the SQLite datastore."""
+
+from datetime import datetime, timedelta
+import unittest
+
+import localdb as db
+
+
+
+class Project(db.Model):
+  """A referenced model."""
+
+
+
+class Item(db.Model):
+  """A model with one of each kind of property the server uses."""
+
+  project = db.ReferenceProperty(Project)
+
+  name = db.StringProperty()
+
+  body = db.TextProperty()
+
+  count = db.IntegerProperty(default = 0)
+
+  active = db.BooleanProperty()
+
+  date = db.DateTimeProperty()
+
+  tags = db.StringListProperty()
+
+
+  @classmethod
+  def kind(cls):
+    """Returns the datastore name for this model class."""
+    return 'ItemV1'
+
+
+
+class LocalDbTestCase(unittest.TestCase):
+  """Tests for the SQLite datastore."""
+
+  def setUp(self):
+    db.configure(':memory:')
+    self.project = Project.get_or_insert('frontend')
+    self.start = datetime(2011, 6, 1, 12, 0, 0)
+    self.items = [Item(project = self.project, name = 'item%d' % i, body = 'x' * i, count = i, active = i % 2 == 0,
+                       date = self.start + timedelta(minutes = i), tags = ['all', 'tag%d' % (i % 3)])
+                  for i in range(10)]
+    db.put(self.items)
+
+
+  def testRoundTrip(self):
+    """Test that every property survives a put and a get."""
+    item = Item.get(str(self.items[3].key()))
+    self.assertEqual('item3', item.name)
+    self.assertEqual('xxx', item.body)
+    self.assertEqual(3, item.count)
+    self.assertEqual(False, item.active)
+    self.assertEqual(self.start + timedelta(minutes = 3), item.date)
+    self.assertEqual(['all', 'tag0'], item.tags)
+    self.assertEqual('frontend', item.project.key().name())
+    self.assertEqual(None, Item.get(db.Key.from_path('ItemV1', 12345)))
+
+
+  def testFilterAndOrder(self):
+    """Test equality, inequality, reference and list filters with sort orders."""
+    names = [item.name for item in Item.all().filter('active =', True).filter('count >', 2).order('-count')]
+    self.assertEqual(['item8', 'item6', 'item4'], names)
+    self.assertEqual(10, Item.all().filter('project =', self.project).count())
+    self.assertEqual(4, Item.all().filter('tags =', 'tag0').count())
+    self.assertEqual(3, len(Item.all(keys_only = True).filter('date <', self.start + timedelta(minutes = 3)).fetch(10)))
+
+
+  def testCursorSurvivesDeletes(self):
+    """Test that a cursor continues after the last result even when the results before it are deleted."""
+    query = Item.all().order('date')
+    first = query.fetch(4)
+    cursor = query.cursor()
+    db.delete(first)
+    rest = Item.all().order('date').with_cursor(cursor).fetch(100)
+    self.assertEqual(['item%d' % i for i in range(4, 10)], [item.name for item in rest])
+
+
+  def testSerialization(self):
+    """Test that serialized entities keep their key and values."""
+    copy = db.model_from_protobuf(db.model_to_protobuf(self.project))
+    self.assertEqual(self.project.key(), copy.key())
+    self.assertEqual(self.project.key(), Project.get_or_insert('frontend').key())
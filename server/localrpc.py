@@ -0,0 +1,50 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Accounting for the calls made to the local services, named like the App Engine RPCs they stand in for."""
+
+import collections
+import functools
+import time
+
+
+# Calls made, by 'service.Call' name.
+RPC_COUNTS = collections.Counter()
+
+# Functions called as hook(service, call, seconds) after every call, like apiproxy post call hooks on App Engine.
+HOOKS = []
+
+
+def rpc(service, name):
+  """Decorator that counts and times each call of the function as the named RPC."""
+  fullName = service + '.' + name
+
+  def decorator(function):
+    """Wraps the function."""
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwds):
+      """Counts, times and calls the function."""
+      RPC_COUNTS[fullName] += 1
+      start = time.time()
+      try:
+        return function(*args, **kwds)
+      finally:
+        elapsed = time.time() - start
+        for hook in HOOKS:
+          hook(service, name, elapsed)
+
+    return wrapper
+
+  return decorator
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs the server on the local backend, without App Engine.
+
+Set "backend": "local" in config.json (and optionally "localDatabase", the SQLite file to use), then run from the server
+directory.  Task queue pushes are dispatched by a pool of threads, and the cron jobs can be run by fetching
+/tasks/aggregate, /tasks/email, /tasks/retention and /tasks/archive.
+
+Usage: localserver.py [PORT] [TASK_THREADS]
+"""
+
+import logging
+import mimetypes
+import os.path
+import sys
+from wsgiref.simple_server import make_server, WSGIServer
+try:
+  from SocketServer import ThreadingMixIn
+except ImportError:
+  from socketserver import ThreadingMixIn
+
+import backend
+if backend.BACKEND != 'local':
+  sys.exit('Set "backend": "local" in config.json to run the server locally.')
+
+from backend import taskqueue, webapp
+
+import aggregate
+import archive
+import emailCron
+import localservices
+import retention
+import server
+
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+
+
+
+class AggregateCronPage(webapp.RequestHandler):
+  """Runs the daily stats aggregation."""
+
+  def get(self):
+    """Runs the aggregation."""
+    aggregate.main()
+    self.response.out.write('Done')
+
+
+
+class EmailCronPage(webapp.RequestHandler):
+  """Runs the daily email."""
+
+  def get(self):
+    """Sends the email."""
+    emailCron.main()
+    self.response.out.write('Done')
+
+
+
+class ArchiveCronPage(webapp.RequestHandler):
+  """Starts archiving old instances."""
+
+  def get(self):
+    """Starts the archive pass."""
+    archive.main()
+    self.response.out.write('Done')
+
+
+
+class RetentionCronPage(webapp.RequestHandler):
+  """Starts deleting expired instances."""
+
+  def get(self):
+    """Starts the retention pass."""
+    retention.main()
+    self.response.out.write('Done')
+
+
+
+class StaticPage(webapp.RequestHandler):
+  """Serves files from the static directory."""
+
+  def get(self, name):
+    """Serves a static file."""
+    path = os.path.abspath(os.path.join(STATIC_DIR, name))
+    if not path.startswith(STATIC_DIR + os.sep) or not os.path.isfile(path):
+      self.error(404)
+      return
+    self.response.headers['Content-Type'] = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    with open(path, 'rb') as f:
+      self.response.out.write(f.read())
+
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+  """Handles each request in its own thread."""
+
+  daemon_threads = True
+
+
+
+def getApplication():
+  """Creates the application, including the cron and static handlers that app.yaml provides on App Engine."""
+  application = server.getApplication()
+  extra = webapp.WSGIApplication([
+    ('/tasks/aggregate', AggregateCronPage),
+    ('/tasks/email', EmailCronPage),
+    ('/tasks/retention', RetentionCronPage),
+    ('/tasks/archive', ArchiveCronPage),
+    ('/static/(.+)', StaticPage),
+  ], debug=True)
+
+  def route(environ, startResponse):
+    """Sends cron and static requests to the extra handlers."""
+    path = environ.get('PATH_INFO', '')
+    if path.startswith('/tasks/') or path.startswith('/static/'):
+      return extra(environ, startResponse)
+    return application(environ, startResponse)
+
+  return route
+
+
+def main():
+  """Runs the server."""
+  logging.basicConfig(level=logging.INFO)
+  port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080
+  threads = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+
+  application = getApplication()
+  runner = localservices.TaskRunner(taskqueue, application, threads)
+  runner.start()
+  httpd = make_server('', port, application, server_class=ThreadingWSGIServer)
+  logging.info('Serving on http://localhost:%d/', port)
+  try:
+    httpd.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    runner.stop()
+
+
+if __name__ == '__main__':
+  main()
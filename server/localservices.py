@@ -0,0 +1,528 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""In-process implementations of the memcache, taskqueue, users and mail services used by the server.
+
+The module level memcache, taskqueue, users and mail objects have the same methods as the App Engine modules of the
+same names, so backend.py can hand them out in their place.
+"""
+
+import collections
+import logging
+import pickle
+import threading
+import time
+import uuid
+
+import localrpc
+
+
+
+####### Memcache. #######
+
+class Memcache(object):
+  """A bounded, least recently used cache with expiration.  Values are pickled, so callers get copies."""
+
+  MAX_ITEMS = 100000
+
+
+  def __init__(self, maxItems=MAX_ITEMS, clock=time.time):
+    self.__maxItems = maxItems
+    self.__clock = clock
+    self.__items = collections.OrderedDict()
+    self.__lock = threading.Lock()
+
+
+  def __lookup(self, key):
+    """Returns the (value, expires) entry for the key, or None.  Must hold the lock."""
+    entry = self.__items.pop(key, None)
+    if entry is None:
+      return None
+    if entry[1] and entry[1] <= self.__clock():
+      return None
+    self.__items[key] = entry
+    return entry
+
+
+  def __store(self, key, value, expires):
+    """Stores an entry, evicting the least recently used.  Must hold the lock."""
+    self.__items.pop(key, None)
+    if len(self.__items) >= self.__maxItems:
+      self.__items.popitem(last=False)
+    self.__items[key] = (value, self.__clock() + expires if expires else 0)
+
+
+  def get(self, key, namespace=None):
+    """Gets a value, or None."""
+    return self.get_multi([key], namespace=namespace).get(key)
+
+
+  @localrpc.rpc('memcache', 'Get')
+  def get_multi(self, keys, key_prefix='', namespace=None):
+    """Gets a dict of the values found for the given keys."""
+    result = {}
+    with self.__lock:
+      for key in keys:
+        entry = self.__lookup((namespace, key_prefix + key))
+        if entry:
+          result[key] = entry[0]
+    return dict((key, pickle.loads(value)) for key, value in result.items())
+
+
+  def set(self, key, value, time=0, namespace=None): # pylint: disable=W0621
+    """Sets a value."""
+    return not self.set_multi({key: value}, time, namespace=namespace)
+
+
+  @localrpc.rpc('memcache', 'Set')
+  def set_multi(self, mapping, time=0, key_prefix='', namespace=None): # pylint: disable=W0621
+    """Sets several values, returning the list of keys that were not set."""
+    serialized = [(key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)) for key, value in mapping.items()]
+    with self.__lock:
+      for key, value in serialized:
+        self.__store((namespace, key_prefix + key), value, time)
+    return []
+
+
+  @localrpc.rpc('memcache', 'Set')
+  def add(self, key, value, time=0, namespace=None): # pylint: disable=W0621
+    """Sets a value only if the key is not already present."""
+    serialized = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    with self.__lock:
+      if self.__lookup((namespace, key)):
+        return False
+      self.__store((namespace, key), serialized, time)
+    return True
+
+
+  def Client(self): # pylint: disable=C0103
+    """Returns a client for compare and set, like memcache.Client()."""
+    return _MemcacheClient(self)
+
+
+  @localrpc.rpc('memcache', 'Get')
+  def getEntry(self, key, namespace=None):
+    """Returns the stored entry for a key, or None.  Every store makes a new entry, so it identifies the version."""
+    with self.__lock:
+      return self.__lookup((namespace, key))
+
+
+  @localrpc.rpc('memcache', 'Set')
+  def compareAndSet(self, key, value, entry, time=0, namespace=None): # pylint: disable=W0621
+    """Sets a value only if the key still holds the given entry."""
+    serialized = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+    with self.__lock:
+      if entry is None or self.__lookup((namespace, key)) is not entry:
+        return False
+      self.__store((namespace, key), serialized, time)
+    return True
+
+
+  def delete(self, key, seconds=0, namespace=None):
+    """Deletes a value."""
+    self.delete_multi([key], seconds, namespace=namespace)
+    return 2
+
+
+  @localrpc.rpc('memcache', 'Delete')
+  def delete_multi(self, keys, seconds=0, key_prefix='', namespace=None): # pylint: disable=W0613
+    """Deletes several values."""
+    with self.__lock:
+      for key in keys:
+        self.__items.pop((namespace, key_prefix + key), None)
+    return True
+
+
+  def incr(self, key, delta=1, namespace=None, initial_value=None):
+    """Atomically increments a value, returning the new value or None if it is missing and there is no initial
+    value."""
+    return self.offset_multi({key: delta}, namespace=namespace, initial_value=initial_value)[key]
+
+
+  def decr(self, key, delta=1, namespace=None, initial_value=None):
+    """Atomically decrements a value, stopping at zero."""
+    return self.incr(key, -delta, namespace, initial_value)
+
+
+  @localrpc.rpc('memcache', 'Increment')
+  def offset_multi(self, mapping, key_prefix='', namespace=None, initial_value=None):
+    """Atomically increments several values, returning a dict of the new values."""
+    result = {}
+    with self.__lock:
+      for key, delta in mapping.items():
+        entry = self.__lookup((namespace, key_prefix + key))
+        if entry is None:
+          if initial_value is None:
+            result[key] = None
+            continue
+          value, expires = initial_value, 0
+        else:
+          value, expires = pickle.loads(entry[0]), entry[1]
+        value = max(0, int(value) + delta)
+        self.__items[(namespace, key_prefix + key)] = (pickle.dumps(value, pickle.HIGHEST_PROTOCOL), expires)
+        result[key] = value
+    return result
+
+
+  def flush_all(self):
+    """Deletes every value."""
+    with self.__lock:
+      self.__items.clear()
+    return True
+
+
+
+class _MemcacheClient(object):
+  """The gets and cas calls of memcache.Client."""
+
+  def __init__(self, cache):
+    self.__cache = cache
+    self.__seen = {}
+
+
+  def gets(self, key, namespace=None):
+    """Gets a value, or None, remembering its version for cas."""
+    entry = self.__seen[(namespace, key)] = self.__cache.getEntry(key, namespace)
+    return pickle.loads(entry[0]) if entry else None
+
+
+  def cas(self, key, value, time=0, namespace=None): # pylint: disable=W0621
+    """Sets a value only if it hasn't changed since gets.  Returns whether it was set."""
+    return self.__cache.compareAndSet(key, value, self.__seen.pop((namespace, key), None), time, namespace)
+
+
+
+####### Task queue. #######
+
+class Task(object):
+  """A push or pull task."""
+
+  def __init__(self, payload=None, url=None, params=None, method='POST', countdown=None, name=None, **_):
+    self.payload = payload
+    self.url = url
+    self.params = params or {}
+    self.method = method
+    self.name = name or uuid.uuid4().hex
+    self.eta = time.time() + (countdown or 0)
+    self.retry_count = 0
+    self.queueName = None
+
+
+
+class QueueStatistics(object):
+  """The size of a queue, as returned by Queue.fetch_statistics."""
+
+  def __init__(self, queue, tasks, oldestEtaUsec, inFlight):
+    self.queue = queue
+    self.tasks = tasks
+    self.oldest_eta_usec = oldestEtaUsec # pylint: disable=C0103
+    self.in_flight = inFlight # pylint: disable=C0103
+
+
+
+class _QueueState(object):
+  """The tasks in one named queue."""
+
+  def __init__(self):
+    self.tasks = collections.OrderedDict()
+    self.lock = threading.Lock()
+
+
+
+class TaskQueue(object):
+  """Named push and pull queues.
+
+  Pull tasks are leased and deleted by the code that uses them.  Push tasks wait until something dispatches them -
+  runPending for a synchronous harness, or a TaskRunner thread pool for a running server.
+  """
+
+  def __init__(self):
+    self.__queues = collections.defaultdict(_QueueState)
+    self.__lock = threading.Lock()
+    self.__added = threading.Condition(self.__lock)
+    self.Task = Task # pylint: disable=C0103
+    service = self
+
+
+    class Queue(object):
+      """A named queue."""
+
+      def __init__(self, name='default'):
+        self.name = name
+
+
+      def add(self, task):
+        """Adds a task or a list of tasks."""
+        service.addTasks(self.name, task if isinstance(task, list) else [task])
+
+
+      def lease_tasks(self, lease_seconds, max_tasks):
+        """Leases up to max_tasks pull tasks for lease_seconds."""
+        return service.leaseTasks(self.name, lease_seconds, max_tasks)
+
+
+      def delete_tasks(self, tasks):
+        """Deletes a task or a list of tasks."""
+        service.deleteTasks(self.name, tasks if isinstance(tasks, list) else [tasks])
+
+
+      def purge(self):
+        """Deletes every task."""
+        service.purge(self.name)
+
+
+      def fetch_statistics(self):
+        """Returns the QueueStatistics of this queue."""
+        return service.fetchStatistics(self.name)
+
+
+    self.Queue = Queue # pylint: disable=C0103
+
+
+  def add(self, queue_name='default', **kwds):
+    """Adds a push task to the named queue."""
+    task = Task(**kwds)
+    self.addTasks(queue_name, [task])
+    return task
+
+
+  @localrpc.rpc('taskqueue', 'BulkAdd')
+  def addTasks(self, queueName, tasks):
+    """Adds tasks to the named queue."""
+    self.__enqueue(queueName, tasks)
+
+
+  def __enqueue(self, queueName, tasks):
+    """Adds tasks to the named queue without counting an RPC."""
+    state = self.__queues[queueName]
+    with state.lock:
+      for task in tasks:
+        task.queueName = queueName
+        state.tasks[task.name] = task
+    with self.__added:
+      self.__added.notify_all()
+
+
+  @localrpc.rpc('taskqueue', 'QueryAndOwnTasks')
+  def leaseTasks(self, queueName, leaseSeconds, maxTasks):
+    """Leases up to maxTasks available tasks from the named queue."""
+    state = self.__queues[queueName]
+    now = time.time()
+    leased = []
+    with state.lock:
+      for task in state.tasks.values():
+        if len(leased) >= maxTasks:
+          break
+        if task.method == 'PULL' and task.eta <= now:
+          task.eta = now + leaseSeconds
+          task.retry_count += 1
+          leased.append(task)
+    return leased
+
+
+  @localrpc.rpc('taskqueue', 'Delete')
+  def deleteTasks(self, queueName, tasks):
+    """Deletes tasks from the named queue."""
+    state = self.__queues[queueName]
+    with state.lock:
+      for task in tasks:
+        state.tasks.pop(task.name, None)
+
+
+  def purge(self, queueName):
+    """Deletes every task in the named queue."""
+    state = self.__queues[queueName]
+    with state.lock:
+      state.tasks.clear()
+
+
+  @localrpc.rpc('taskqueue', 'FetchQueueStats')
+  def fetchStatistics(self, queueName):
+    """Returns the QueueStatistics of the named queue."""
+    state = self.__queues[queueName]
+    now = time.time()
+    with state.lock:
+      etas = [task.eta for task in state.tasks.values()]
+    return QueueStatistics(queueName, len(etas), int(min(etas) * 1e6) if etas else None,
+                           len([eta for eta in etas if eta > now]))
+
+
+  def countTasks(self, queueName):
+    """Returns the number of tasks in the named queue."""
+    state = self.__queues[queueName]
+    with state.lock:
+      return len(state.tasks)
+
+
+  def takePushTask(self, timeout=None):
+    """Removes and returns the next push task that is due, waiting up to timeout seconds.  Returns None if no task
+    became due in time."""
+    deadline = time.time() + (timeout or 0)
+    while True:
+      now = time.time()
+      for name in list(self.__queues):
+        state = self.__queues[name]
+        with state.lock:
+          for task in state.tasks.values():
+            if task.method != 'PULL' and task.eta <= now:
+              del state.tasks[task.name]
+              return task
+      if timeout is None or now >= deadline:
+        return None
+      with self.__added:
+        self.__added.wait(min(0.1, max(0, deadline - now)))
+
+
+  def retry(self, task, delay):
+    """Puts a failed push task back to be retried after delay seconds."""
+    task.retry_count += 1
+    task.eta = time.time() + delay
+    self.__enqueue(task.queueName, [task])
+
+
+  def runPending(self, application, maxTasks=None):
+    """Synchronously dispatches due push tasks to the WSGI application until there are none left or maxTasks have run.
+    Returns the number of tasks run."""
+    import localwebapp
+    count = 0
+    while maxTasks is None or count < maxTasks:
+      task = self.takePushTask()
+      if task is None:
+        break
+      status = localwebapp.dispatch(application, task.method, task.url, task.params, task.payload, task.queueName,
+                                    task.retry_count)
+      if status >= 300:
+        logging.warn('Task %s to %s failed with status %d', task.name, task.url, status)
+      count += 1
+    return count
+
+
+
+class TaskRunner(object):
+  """Dispatches push tasks to a WSGI application from a pool of threads, retrying failures with backoff."""
+
+  MAX_RETRIES = 5
+
+
+  def __init__(self, service, application, threads=4):
+    self.__service = service
+    self.__application = application
+    self.__stopped = threading.Event()
+    self.__threads = [threading.Thread(target=self.__run, name='TaskRunner-%d' % i) for i in range(threads)]
+    for thread in self.__threads:
+      thread.daemon = True
+
+
+  def start(self):
+    """Starts the dispatch threads."""
+    for thread in self.__threads:
+      thread.start()
+
+
+  def stop(self):
+    """Stops the dispatch threads once their current tasks finish."""
+    self.__stopped.set()
+    for thread in self.__threads:
+      thread.join()
+
+
+  def __run(self):
+    """Dispatches tasks until stopped."""
+    import localwebapp
+    while not self.__stopped.is_set():
+      task = self.__service.takePushTask(timeout=0.5)
+      if task is None:
+        continue
+      try:
+        status = localwebapp.dispatch(self.__application, task.method, task.url, task.params, task.payload,
+                                      task.queueName, task.retry_count)
+      except Exception: # pylint: disable=W0703
+        logging.exception('Task %s to %s raised', task.name, task.url)
+        status = 500
+      if status >= 300:
+        if task.retry_count < TaskRunner.MAX_RETRIES:
+          self.__service.retry(task, 0.1 * 2 ** task.retry_count)
+        else:
+          logging.error('Giving up on task %s to %s', task.name, task.url)
+
+
+
+####### Users and mail. #######
+
+class User(object):
+  """A signed in user."""
+
+  def __init__(self, email):
+    self.__email = email
+
+
+  def email(self):
+    """Returns the user's email address."""
+    return self.__email
+
+
+  def nickname(self):
+    """Returns the user's nickname."""
+    return self.__email.split('@')[0]
+
+
+  def __str__(self):
+    return self.nickname()
+
+
+
+class Users(object):
+  """Treats every request as coming from a single local administrator."""
+
+  def __init__(self, email='admin@localhost'):
+    self.__user = User(email)
+
+
+  def get_current_user(self):
+    """Returns the current user."""
+    return self.__user
+
+
+  def is_current_user_admin(self):
+    """Returns whether the current user is an administrator."""
+    return True
+
+
+  def create_login_url(self, dest_url):
+    """Returns a URL for signing in."""
+    return dest_url
+
+
+  def create_logout_url(self, dest_url):
+    """Returns a URL for signing out."""
+    return dest_url
+
+
+
+class Mail(object):
+  """Logs mail instead of sending it."""
+
+  def send_mail(self, sender, to, subject, body, **kwds):
+    """Logs a message."""
+    logging.info('Mail from %s to %s: %s\n%s', sender, to, subject, kwds.get('html') or body)
+
+
+
+memcache = Memcache() # pylint: disable=C0103
+
+taskqueue = TaskQueue() # pylint: disable=C0103
+
+users = Users() # pylint: disable=C0103
+
+mail = Mail() # pylint: disable=C0103
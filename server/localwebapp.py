@@ -0,0 +1,230 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""The parts of google.appengine.ext.webapp used by the server, on top of plain WSGI."""
+
+import io
+import logging
+import os.path
+import re
+import sys
+import traceback
+
+try:
+  from urllib.parse import parse_qsl, urlencode
+except ImportError:
+  from urllib import urlencode
+  from urlparse import parse_qsl
+
+
+STATUS_MESSAGES = {
+  200: 'OK', 302: 'Found', 301: 'Moved Permanently', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+  405: 'Method Not Allowed', 409: 'Conflict', 415: 'Unsupported Media Type', 500: 'Internal Server Error'
+}
+
+
+
+class Request(object):
+  """An HTTP request."""
+
+  def __init__(self, environ):
+    self.environ = environ
+    self.method = environ.get('REQUEST_METHOD', 'GET')
+    self.path = environ.get('PATH_INFO', '/')
+    self.query_string = environ.get('QUERY_STRING', '')
+    self.uri = self.path + ('?' + self.query_string if self.query_string else '')
+    self.headers = dict((name[5:].replace('_', '-').title(), value)
+                        for name, value in environ.items() if name.startswith('HTTP_'))
+    if environ.get('CONTENT_TYPE'):
+      self.headers['Content-Type'] = environ['CONTENT_TYPE']
+
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    self.body = environ['wsgi.input'].read(length) if length else b''
+
+    self.params = dict(parse_qsl(self.query_string, keep_blank_values=True))
+    if environ.get('CONTENT_TYPE', '').startswith('application/x-www-form-urlencoded'):
+      self.params.update(parse_qsl(self.body.decode('utf-8'), keep_blank_values=True))
+
+
+  def get(self, name, default_value=''):
+    """Gets a query or form parameter."""
+    return self.params.get(name, default_value)
+
+
+
+class _Output(object):
+  """Collects the response body."""
+
+  def __init__(self):
+    self.parts = []
+
+
+  def write(self, text):
+    """Appends text or bytes to the body."""
+    self.parts.append(text.encode('utf-8') if not isinstance(text, bytes) else text)
+
+
+  def getvalue(self):
+    """Returns the body as bytes."""
+    return b''.join(self.parts)
+
+
+
+class Response(object):
+  """An HTTP response."""
+
+  def __init__(self):
+    self.out = _Output()
+    self.headers = {'Content-Type': 'text/html; charset=utf-8'}
+    self.status = 200
+
+
+  def set_status(self, code):
+    """Sets the status code."""
+    self.status = code
+
+
+  def clear(self):
+    """Discards the body written so far."""
+    self.out = _Output()
+
+
+
+class RequestHandler(object):
+  """Base class for page handlers."""
+
+  def initialize(self, request, response):
+    """Attaches the request and response."""
+    self.request = request # pylint: disable=W0201
+    self.response = response # pylint: disable=W0201
+
+
+  def error(self, code):
+    """Clears the response and sets an error status."""
+    self.response.set_status(code)
+    self.response.clear()
+
+
+  def redirect(self, uri, permanent=False):
+    """Redirects to the given URI."""
+    self.response.set_status(301 if permanent else 302)
+    self.response.headers['Location'] = str(uri)
+    self.response.clear()
+
+
+  def handle_exception(self, exception, debug_mode): # pylint: disable=W0613
+    """Logs an exception raised by a handler and responds with a 500."""
+    logging.exception('Handler raised %r', exception)
+    self.error(500)
+    if debug_mode:
+      self.response.out.write(traceback.format_exc())
+
+
+
+class WSGIApplication(object):
+  """Routes requests to handlers by regular expression."""
+
+  def __init__(self, url_mapping, debug=False):
+    self.__mapping = [(re.compile('^%s$' % pattern), handler) for pattern, handler in url_mapping]
+    self.__debug = debug
+
+
+  def __call__(self, environ, start_response):
+    request = Request(environ)
+    response = Response()
+    for pattern, handlerClass in self.__mapping:
+      match = pattern.match(request.path)
+      if match:
+        handler = handlerClass()
+        handler.initialize(request, response)
+        method = getattr(handler, request.method.lower(), None)
+        if method is None:
+          response.set_status(405)
+        else:
+          try:
+            method(*match.groups())
+          except Exception as e: # pylint: disable=W0703
+            handler.handle_exception(e, self.__debug)
+        break
+    else:
+      response.set_status(404)
+
+    body = response.out.getvalue()
+    headers = [(str(name), str(value)) for name, value in response.headers.items()]
+    headers.append(('Content-Length', str(len(body))))
+    start_response('%d %s' % (response.status, STATUS_MESSAGES.get(response.status, 'Unknown')), headers)
+    return [body]
+
+
+
+def dispatch(application, method, url, params=None, payload=None, queueName='default', retryCount=0):
+  """Calls the WSGI application directly, as the task queue does.  Returns the status code."""
+  path, _, query = url.partition('?')
+  if method == 'POST' and params and payload is None:
+    body = urlencode(params).encode('utf-8')
+    contentType = 'application/x-www-form-urlencoded'
+  else:
+    if params:
+      query = urlencode(params) + ('&' + query if query else '')
+    body = payload.encode('utf-8') if payload is not None and not isinstance(payload, bytes) else (payload or b'')
+    contentType = 'application/octet-stream'
+  environ = {
+    'REQUEST_METHOD': method,
+    'PATH_INFO': path,
+    'QUERY_STRING': query,
+    'CONTENT_TYPE': contentType,
+    'CONTENT_LENGTH': str(len(body)),
+    'SERVER_NAME': 'localhost',
+    'SERVER_PORT': '80',
+    'HTTP_X_APPENGINE_QUEUENAME': queueName,
+    'HTTP_X_APPENGINE_TASKRETRYCOUNT': str(retryCount),
+    'wsgi.input': io.BytesIO(body),
+    'wsgi.errors': sys.stderr,
+    'wsgi.url_scheme': 'http',
+  }
+  status = []
+  application(environ, lambda line, headers: status.append(int(line.split()[0])))
+  return status[0]
+
+
+
+class template(object): # pylint: disable=C0103
+  """Renders Django templates the way webapp does, with the template's own directory as the template path."""
+
+  @staticmethod
+  def render(path, context):
+    """Renders the template at path with the given dict."""
+    # pylint: disable=F0401
+    import django
+    from django import template as djangoTemplate
+    directory, name = os.path.split(path)
+    if hasattr(djangoTemplate, 'Engine'):
+      engine = djangoTemplate.Engine(dirs=[directory], libraries={})
+      return engine.get_template(name).render(djangoTemplate.Context(context))
+
+    from django.conf import settings
+    if not settings.configured:
+      settings.configure(TEMPLATE_DIRS=(directory,))
+      if hasattr(django, 'setup'):
+        django.setup()
+    settings.TEMPLATE_DIRS = (directory,)
+    with open(path) as f:
+      return djangoTemplate.Template(f.read()).render(djangoTemplate.Context(context))
+
+
+
+def run_wsgi_app(application):
+  """Runs the application as a CGI script."""
+  from wsgiref.handlers import CGIHandler
+  CGIHandler().run(application)
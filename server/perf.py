@@ -0,0 +1,290 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Counts and times the datastore, memcache and taskqueue calls made by each handler, by call site.
+
+Calls are observed with apiproxy hooks on App Engine and localrpc hooks on the local backend.  Each instance keeps
+per minute totals for the last WINDOW_MINUTES minutes and copies them to memcache at most every FLUSH_INTERVAL seconds,
+and report() merges the copies from every instance.
+"""
+
+import os
+import sys
+import threading
+import time
+import uuid
+
+from backend import BACKEND, memcache
+
+
+WINDOW_MINUTES = 60
+
+FLUSH_INTERVAL = 10
+
+NAMESPACE = 'perf'
+
+CAS_ATTEMPTS = 5
+
+INSTANCE_ID = os.environ.get('INSTANCE_ID') or uuid.uuid4().hex
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Files whose frames are never reported as the call site.
+PLUMBING = frozenset(['perf.py', 'backend.py', 'localdb.py', 'localservices.py', 'localrpc.py', 'localwebapp.py'])
+
+BACKGROUND = '(background)'
+
+
+_local = threading.local() # pylint: disable=C0103
+
+_lock = threading.Lock() # pylint: disable=C0103
+
+# minute -> {'requests': {handler: [count, seconds]}, 'calls': {(handler, rpc, site): [count, seconds]}}
+_buckets = {} # pylint: disable=C0103
+
+_state = {'lastFlush': 0, 'installed': False} # pylint: disable=C0103
+
+_siteFiles = {} # pylint: disable=C0103
+
+
+
+####### Recording. #######
+
+def _callSite():
+  """Returns 'file:line function' for the innermost server frame that is not plumbing."""
+  frame = sys._getframe(2) # pylint: disable=W0212
+  while frame is not None:
+    filename = frame.f_code.co_filename
+    name = _siteFiles.get(filename)
+    if name is None:
+      absolute = os.path.abspath(filename)
+      base = os.path.basename(absolute)
+      name = base if os.path.dirname(absolute) == SERVER_DIR and base not in PLUMBING else ''
+      _siteFiles[filename] = name
+    if name:
+      return '%s:%d %s' % (name, frame.f_lineno, frame.f_code.co_name)
+    frame = frame.f_back
+  return 'unknown'
+
+
+def _bucket(now):
+  """Returns the bucket for the current minute, dropping expired ones.  Must hold the lock."""
+  minute = int(now // 60)
+  bucket = _buckets.get(minute)
+  if bucket is None:
+    for old in [old for old in _buckets if old <= minute - WINDOW_MINUTES]:
+      del _buckets[old]
+    bucket = _buckets[minute] = {'requests': {}, 'calls': {}}
+  return bucket
+
+
+def _add(totals, key, count, seconds):
+  """Adds to a [count, seconds] total."""
+  total = totals.get(key)
+  if total is None:
+    totals[key] = [count, seconds]
+  else:
+    total[0] += count
+    total[1] += seconds
+
+
+def recordRpc(service, call, seconds):
+  """Records one call."""
+  if getattr(_local, 'flushing', False):
+    return
+  key = ('%s.%s' % (service, call), _callSite())
+  calls = getattr(_local, 'calls', None)
+  if calls is not None:
+    _add(calls, key, 1, seconds)
+  else:
+    with _lock:
+      _add(_bucket(time.time())['calls'], (BACKGROUND,) + key, 1, seconds)
+
+
+def _preCall(service, call, request, response, *_): # pylint: disable=W0613
+  """apiproxy pre call hook: notes when the call started."""
+  starts = getattr(_local, 'starts', None)
+  if starts is None:
+    starts = _local.starts = {}
+  starts[id(request)] = time.time()
+
+
+def _postCall(service, call, request, response, *_): # pylint: disable=W0613
+  """apiproxy post call hook: records the call."""
+  start = getattr(_local, 'starts', {}).pop(id(request), None)
+  if start is not None:
+    recordRpc(service, call, time.time() - start)
+
+
+def install():
+  """Starts observing calls."""
+  if _state['installed']:
+    return
+  _state['installed'] = True
+  if BACKEND == 'local':
+    import localrpc
+    localrpc.HOOKS.append(recordRpc)
+  else:
+    # pylint: disable=E0611
+    from google.appengine.api import apiproxy_stub_map
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('perf', _preCall)
+    apiproxy_stub_map.apiproxy.GetPostCallHooks().Append('perf', _postCall)
+
+
+
+class request(object): # pylint: disable=C0103
+  """Context manager that attributes the calls made inside it to the named handler.  Nested uses are ignored."""
+
+  def __init__(self, handler):
+    self.__handler = handler
+    self.__start = None
+
+
+  def __enter__(self):
+    if getattr(_local, 'calls', None) is None:
+      _local.calls = {}
+      self.__start = time.time()
+
+
+  def __exit__(self, *_):
+    if self.__start is None:
+      return
+    now = time.time()
+    calls, _local.calls = _local.calls, None
+    with _lock:
+      bucket = _bucket(now)
+      _add(bucket['requests'], self.__handler, 1, now - self.__start)
+      for (rpc, site), (count, seconds) in calls.items():
+        _add(bucket['calls'], (self.__handler, rpc, site), count, seconds)
+      due = now - _state['lastFlush'] >= FLUSH_INTERVAL
+      if due:
+        _state['lastFlush'] = now
+    if due:
+      flush()
+
+
+
+def measured(handler):
+  """Decorator that runs the function as the named handler."""
+
+  def decorator(function):
+    """Wraps the function."""
+
+    def wrapper(*args, **kwds):
+      """Runs the function inside a request."""
+      with request(handler):
+        return function(*args, **kwds)
+
+    wrapper.__name__ = function.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
+
+  return decorator
+
+
+def instrument(application, endpoints):
+  """Wraps a WSGI application so each request is attributed to the handler class its path routes to."""
+  import re
+  routes = [(re.compile('^%s$' % pattern), handler.__name__) for pattern, handler in endpoints]
+
+  def instrumented(environ, startResponse):
+    """Runs the request inside a perf request."""
+    path = environ.get('PATH_INFO', '')
+    name = next((handler for pattern, handler in routes if pattern.match(path)), path)
+    with request(name):
+      return application(environ, startResponse)
+
+  return instrumented
+
+
+
+####### Reporting. #######
+
+def flush():
+  """Copies this instance's totals to memcache."""
+  with _lock:
+    snapshot = dict((minute, {'requests': dict((k, list(v)) for k, v in bucket['requests'].items()),
+                              'calls': dict((k, list(v)) for k, v in bucket['calls'].items())})
+                    for minute, bucket in _buckets.items())
+  _local.flushing = True
+  try:
+    now = time.time()
+    memcache.set('instance:' + INSTANCE_ID, snapshot, namespace=NAMESPACE)
+
+    # Other instances update the list too, so only replace the version that was read.
+    client = memcache.Client()
+    for _ in range(CAS_ATTEMPTS):
+      instances = client.gets('instances', namespace=NAMESPACE)
+      if instances is None:
+        if memcache.add('instances', {INSTANCE_ID: now}, namespace=NAMESPACE):
+          break
+        continue
+      instances = dict((instance, seen) for instance, seen in instances.items() if seen > now - WINDOW_MINUTES * 60)
+      instances[INSTANCE_ID] = now
+      if client.cas('instances', instances, namespace=NAMESPACE):
+        break
+  finally:
+    _local.flushing = False
+
+
+def report(minutes=WINDOW_MINUTES):
+  """Returns the totals of every instance over the last minutes, busiest first, as JSON friendly dicts."""
+  flush()
+  _local.flushing = True
+  try:
+    instances = memcache.get('instances', namespace=NAMESPACE) or {}
+    snapshots = memcache.get_multi(['instance:' + instance for instance in instances], namespace=NAMESPACE)
+  finally:
+    _local.flushing = False
+
+  since = int(time.time() // 60) - minutes
+  requests = {}
+  calls = {}
+  for snapshot in snapshots.values():
+    for minute, bucket in snapshot.items():
+      if minute > since:
+        for handler, (count, seconds) in bucket['requests'].items():
+          _add(requests, handler, count, seconds)
+        for key, (count, seconds) in bucket['calls'].items():
+          _add(calls, key, count, seconds)
+
+  callsByHandler = {}
+  for (handler, _, _), (count, _) in calls.items():
+    callsByHandler[handler] = callsByHandler.get(handler, 0) + count
+
+  handlers = [{
+    'handler': handler,
+    'requests': count,
+    'seconds': round(seconds, 3),
+    'meanMs': round(seconds * 1000 / count, 2),
+    'rpcs': callsByHandler.get(handler, 0),
+    'rpcsPerRequest': round(float(callsByHandler.get(handler, 0)) / count, 2),
+  } for handler, (count, seconds) in requests.items()]
+  handlers.sort(key=lambda item: item['seconds'], reverse=True)
+
+  rows = [{
+    'handler': handler,
+    'rpc': rpc,
+    'site': site,
+    'count': count,
+    'seconds': round(seconds, 3),
+    'meanMs': round(seconds * 1000 / count, 2),
+    'perRequest': round(float(count) / requests[handler][0], 2) if handler in requests else None,
+  } for (handler, rpc, site), (count, seconds) in calls.items()]
+  rows.sort(key=lambda item: item['seconds'], reverse=True)
+
+  return {'minutes': minutes, 'instances': len(snapshots), 'handlers': handlers, 'calls': rows}
+
+
+install()
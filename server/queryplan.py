@@ -0,0 +1,102 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Plans for queries with equality filters that no declared index serves.
+
+When few entities match, a keys only query on the filters alone is answered by the datastore merge joining its built
+in single property indexes, and the matches are read and sorted in memory.  Otherwise an ordered index is scanned
+newest first, keeping the matches.  A scan reads at most MAX_SCAN entities per page; when it stops short, the page
+says so and where to continue from.
+"""
+
+
+# Most entities a merge join reads.  More matches than this are common enough that a scan finds a page sooner.
+MAX_JOIN = 200
+
+# Most entities a scan reads for one page.
+MAX_SCAN = 1000
+
+# Entities read per batch when scanning.
+SCAN_BATCH = 100
+
+
+
+class Page(list):
+  """A page of entities, newest first by the date property named by order.
+
+  truncated is whether a scan stopped after reading MAX_SCAN entities without filling the page, and resumeBefore is
+  then the date to continue the scan before.
+  """
+
+  def __init__(self, order, entities = ()):
+    list.__init__(self, entities)
+    self.order = order
+    self.truncated = False
+    self.resumeBefore = None
+
+
+  def nextBefore(self, size):
+    """Returns the date the page after the first size entities starts before, or None if there are no more."""
+    if len(self) > size:
+      return getattr(self[size - 1], self.order)
+    return self.resumeBefore
+
+
+
+def matches(model, entity, equalities):
+  """Returns whether the entity has the given values for the given properties."""
+  for name, value in equalities.items():
+    if model.properties()[name].get_value_for_datastore(entity) != value:
+      return False
+  return True
+
+
+def mergeJoin(model, equalities, order, limit, test = None):
+  """Fetches entities matching the given equality filters and sorts them newest first by the given date property.
+
+  test, if given, is a further in memory filter.  Returns None when more than MAX_JOIN entities match.
+  """
+  query = model.all(keys_only = True)
+  for name, value in equalities.items():
+    query = query.filter(name + ' =', value)
+  keys = query.fetch(MAX_JOIN + 1)
+  if len(keys) > MAX_JOIN:
+    return None
+  entities = [entity for entity in model.get(keys) if entity and (test is None or test(entity))]
+  entities.sort(key = lambda entity: getattr(entity, order), reverse = True)
+  return Page(order, entities[:limit])
+
+
+def scan(query, model, equalities, order, limit):
+  """Runs a query ordered newest first by the given date property, keeping the entities that match the given equality
+  filters until a page of them is found or MAX_SCAN entities have been read."""
+  if not equalities:
+    return Page(order, query.fetch(limit))
+  page = Page(order)
+  scanned = 0
+  while scanned < MAX_SCAN:
+    batchSize = min(SCAN_BATCH, MAX_SCAN - scanned)
+    batch = query.fetch(batchSize)
+    scanned += len(batch)
+    for entity in batch:
+      if matches(model, entity, equalities):
+        page.append(entity)
+        if len(page) == limit:
+          return page
+    if len(batch) < batchSize:
+      return page
+    query.with_cursor(query.cursor())
+  page.truncated = True
+  page.resumeBefore = getattr(batch[-1], order)
+  return page
@@ -0,0 +1,117 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the plans of filtered queries."""
+
+from datetime import datetime, timedelta
+import unittest
+
+import localdb as db
+import queryplan
+
+
+
+class Occurrence(db.Model):
+  """A model filtered by server and listed newest first."""
+
+  server = db.StringProperty()
+
+  date = db.DateTimeProperty()
+
+
+  @classmethod
+  def kind(cls):
+    """Returns the datastore name for this model class."""
+    return 'OccurrenceV1'
+
+
+
+class QueryPlanTestCase(unittest.TestCase):
+  """Tests for the plans of filtered queries."""
+
+  def setUp(self):
+    db.configure(':memory:')
+    self.start = datetime(2011, 6, 1, 12, 0, 0)
+
+
+  def addOccurrences(self, servers):
+    """Stores an occurrence on each of the given servers, a minute apart with the last newest."""
+    db.put([Occurrence(server = server, date = self.start + timedelta(minutes = i))
+            for i, server in enumerate(servers)])
+
+
+  def scan(self, limit, before = None):
+    """Scans for occurrences on the rare server."""
+    query = Occurrence.all()
+    if before:
+      query = query.filter('date <', before)
+    return queryplan.scan(query.order('-date'), Occurrence, {'server': 'rare'}, 'date', limit)
+
+
+  def testMergeJoinSortsMatchesNewestFirst(self):
+    """Test that a merge join returns the newest matches first."""
+    self.addOccurrences(['rare', 'common', 'rare', 'common', 'rare'])
+    page = queryplan.mergeJoin(Occurrence, {'server': 'rare'}, 'date', 2)
+    self.assertEqual([self.start + timedelta(minutes = 4), self.start + timedelta(minutes = 2)],
+                     [occurrence.date for occurrence in page])
+    self.assertFalse(page.truncated)
+    self.assertEqual(self.start + timedelta(minutes = 4), page.nextBefore(1))
+    self.assertEqual(None, page.nextBefore(2))
+
+
+  def testMergeJoinAppliesTest(self):
+    """Test that a merge join keeps only the matches passing its further test."""
+    self.addOccurrences(['rare', 'rare', 'rare'])
+    before = self.start + timedelta(minutes = 2)
+    page = queryplan.mergeJoin(Occurrence, {'server': 'rare'}, 'date', 10, lambda occurrence: occurrence.date < before)
+    self.assertEqual([self.start + timedelta(minutes = 1), self.start], [occurrence.date for occurrence in page])
+
+
+  def testMergeJoinGivesWayWhenManyMatch(self):
+    """Test that a merge join returns None when more entities match than it reads."""
+    self.addOccurrences(['rare'] * (queryplan.MAX_JOIN + 1))
+    self.assertEqual(None, queryplan.mergeJoin(Occurrence, {'server': 'rare'}, 'date', 10))
+
+
+  def testScanFillsPage(self):
+    """Test that a scan stops once it has a page of matches."""
+    self.addOccurrences(['rare', 'common'] * 300)
+    page = self.scan(3)
+    self.assertEqual([self.start + timedelta(minutes = minutes) for minutes in (598, 596, 594)],
+                     [occurrence.date for occurrence in page])
+    self.assertFalse(page.truncated)
+
+
+  def testScanReachesEnd(self):
+    """Test that a scan reaching the end of its index has no more pages."""
+    self.addOccurrences(['rare'] + ['common'] * 50)
+    page = self.scan(3)
+    self.assertEqual([self.start], [occurrence.date for occurrence in page])
+    self.assertFalse(page.truncated)
+    self.assertEqual(None, page.nextBefore(3))
+
+
+  def testScanStopsAndResumes(self):
+    """Test that a scan stops after reading MAX_SCAN entities and resumes before the last one."""
+    self.addOccurrences(['rare'] * 2 + ['common'] * (queryplan.MAX_SCAN + 10) + ['rare'])
+    page = self.scan(3)
+    self.assertEqual([self.start + timedelta(minutes = queryplan.MAX_SCAN + 12)],
+                     [occurrence.date for occurrence in page])
+    self.assertTrue(page.truncated)
+    before = page.nextBefore(3)
+    self.assertEqual(self.start + timedelta(minutes = 13), before)
+
+    page = self.scan(3, before)
+    self.assertEqual([self.start + timedelta(minutes = 1), self.start], [occurrence.date for occurrence in page])
+    self.assertFalse(page.truncated)
@@ -34,27 +34,40 @@ error, and a get/set is performed.  If the lock can't be acquired, the tasks are
 the next worker.  In this case, the worker throws an exception so that it is rerun.
 """
 
-# pylint: disable=E0611
-from google.appengine.api import memcache, taskqueue
-# pylint: disable=E0611
-from google.appengine.ext import webapp
+from backend import db, memcache, taskqueue, webapp
 
+import alerts
 import backtrace
 import collections
 from datetime import datetime
 import hashlib
-try:
-  from django.utils import simplejson as json
-except ImportError:
-  import json
+import histogram
+import hyperloglog
+import jsoncodec
 import logging
+import retention
+import search
+import time
+import topk
+import wireformat
 
 from common import AttrDict, getProject, parseDate
-from datamodel import LoggedError, LoggedErrorInstance, Queue
+from datamodel import Backtrace, LoggedError, LoggedErrorInstance, LoggedErrorSummary, Queue, SearchFacets, SearchIndex
 
 
 AGGREGATION_ID = 'currentAggregationId'
 
+STATS_NAMESPACE = 'aggregationStats'
+
+# Memcache namespace noting the digests of backtraces already stored.
+BACKTRACE_NAMESPACE = 'backtraces'
+
+# Most aggregation tasks leased by one worker run.
+LEASE_LIMIT = 250
+
+AGGREGATION_METRICS = ('enqueued', 'backlog', 'oldestPendingAge', 'oldestLeasedAge', 'secondsSinceLastRun', 'runs',
+                       'leased', 'leasedLastRun', 'leasedPerRun', 'lockFailures', 'retries')
+
 
 def getEndpoints():
   """Returns endpoints needed for queue processing."""
@@ -74,6 +87,26 @@ def generateHash(exceptionType, backtraceText):
   return hasher.hexdigest()
 
 
+def storeBacktrace(backtraceText):
+  """Stores the given backtrace, unless it is already stored, and returns its digest.  Returns None for an empty
+  backtrace.  Backtraces are never changed once stored, so storing one twice is harmless."""
+  if not backtraceText:
+    return None
+  digest = hashlib.sha1(backtraceText.encode('utf-8')).hexdigest()
+  if not memcache.get(digest, namespace = BACKTRACE_NAMESPACE):
+    Backtrace(key_name = digest, text = backtraceText).put()
+    memcache.set(digest, True, namespace = BACKTRACE_NAMESPACE)
+  return digest
+
+
+def _backtraceDigest(payload):
+  """Gets the backtrace digest of an aggregation payload.  Payloads queued before backtraces were shared carry the
+  backtrace itself, which is stored on the way."""
+  if 'backtraceDigest' in payload:
+    return payload['backtraceDigest']
+  return storeBacktrace(payload.get('backtrace'))
+
+
 def getAggregatedError(project, errorHash):
   """Gets (and updates) the error matching the given report, or None if no matching error is found."""
   error = None
@@ -88,7 +121,7 @@ def getAggregatedError(project, errorHash):
   return error
 
 
-def aggregate(destination, count, first, last, lastMessage, backtraceText, environments, servers):
+def aggregate(destination, count, first, last, lastMessage, backtraceDigest):
   """Aggregates in to the given destination."""
   destination.count += count
 
@@ -99,23 +132,165 @@ def aggregate(destination, count, first, last, lastMessage, backtraceText, envir
 
   if not destination.lastOccurrence or last > destination.lastOccurrence:
     destination.lastOccurrence = last
-    destination.backtrace = backtraceText
+    destination.backtraceDigest = backtraceDigest
     destination.lastMessage = lastMessage
 
-  destination.environments = [str(x) for x in (set(destination.environments) | set(environments))]
-  destination.servers = [str(x) for x in (set(destination.servers) | set(servers))]
 
+def _counts(values):
+  """Returns a map from value to count.  Payloads queued before counts were kept list each value once."""
+  if isinstance(values, dict):
+    return values
+  return dict.fromkeys(values, 1)
+
+
+def _breakdownName(value):
+  """Returns the name an environment or server is counted under.  Reports without one count as 'Unknown'."""
+  return 'Unknown' if value is None else '%s' % value
+
+
+def addBreakdowns(error, environments, servers):
+  """Adds maps from environment and server name to count to the error's top environments and servers.  The
+  environments and servers lists are kept to the tracked values, most common first."""
+  for countsName, listName, counts in (('environmentCounts', 'environments', environments),
+                                       ('serverCounts', 'servers', servers)):
+    names = collections.Counter()
+    for value, count in counts.items():
+      names[_breakdownName(value)] += count
+    serialized = getattr(error, countsName)
+    top = topk.TopK(serialized)
+    if not serialized:
+      # Errors stored before counts were kept start with their known values, uncounted.
+      for value in getattr(error, listName)[:topk.DEFAULT_SIZE]:
+        top.add(value, 0)
+    top.update(names)
+    setattr(error, countsName, top.serialize())
+    setattr(error, listName, top.values())
+
+
+def _minute(timestamp):
+  """Returns the start of the minute holding the given timestamp, as a string key."""
+  return str(int(timestamp // 60 * 60))
+
+
+def addOccurrences(error, occurrences):
+  """Adds a map from minute (as returned by _minute) to count to the error's histogram."""
+  counts = histogram.Histogram(error.histogram)
+  for minute, count in occurrences.items():
+    counts.add(int(minute), count)
+  error.histogram = db.Blob(counts.pack())
+
+
+def _countFacets(projectName, counts, sign = 1):
+  """Adds (or with sign -1, subtracts) the given map from facet to a map from value to count to the project's facet
+  counts."""
+  facets = SearchFacets.get_by_key_name(projectName) or SearchFacets(key_name = projectName)
+  totals = jsoncodec.loads(facets.counts) if facets.counts else {}
+  for facet, values in counts.items():
+    facetTotals = totals.setdefault(facet, {})
+    for value, count in values.items():
+      facetTotals[value] = facetTotals.get(value, 0) + sign * count
+      if facetTotals[value] <= 0:
+        del facetTotals[value]
+  facets.counts = jsoncodec.dumps(totals)
+  facets.put()
+
+
+def uncountFacets(indexes):
+  """Takes the facet values of the given search indexes off their projects' facet counts.  Call it once the indexes
+  are stored as inactive, or deleted, so a retry can't take them off twice."""
+  removed = collections.defaultdict(list)
+  for index in indexes:
+    facetTerms = [term for term in index.terms if ':' in term]
+    projectName = next((term.partition(':')[2] for term in facetTerms if term.startswith('project:')), None)
+    if projectName:
+      removed[projectName].append(facetTerms)
+  for projectName, terms in removed.items():
+    try:
+      db.run_in_transaction(_countFacets, projectName, search.facetCounts(terms), -1)
+    except Exception: # pylint: disable=W0703
+      logging.exception('Failed to uncount search facets for %s', projectName)
+
+
+def indexErrors(errors):
+  """Adds the current terms of the given errors to their search indexes, creating any that are missing.
+
+  Terms are only ever added, so an error can be found by any message it has had.  Indexes are written when they gain
+  terms or their error's activity or last occurrence changes.  Facet values new to an active error are added to its
+  project's facet counts.
+  """
+  indexKeys = [db.Key.from_path(SearchIndex.kind(), 'search', parent = error.key()) for error in errors]
+  backtraceKeys = [db.Key.from_path(Backtrace.kind(), digest)
+                   for digest in set(error.backtraceDigest for error in errors) if digest]
+  stored = db.get(indexKeys + backtraceKeys)
+  backtraces = dict((entity.key().name(), entity.text) for entity in stored[len(indexKeys):] if entity)
+  changed = []
+  added = collections.defaultdict(list)
+  for error, index in zip(errors, stored[:len(indexKeys)]):
+    projectName = LoggedError.project.get_value_for_datastore(error).name()
+    oldTerms = index.terms if index else []
+    terms = search.mergeTerms(oldTerms, search.errorTerms(
+        projectName, error.errorLevel, error.environments, error.servers, error.type,
+        backtraces.get(error.backtraceDigest, error.backtrace), error.lastMessage))
+    if (terms is None and index and index.active == error.active and
+        index.lastOccurrence == error.lastOccurrence):
+      continue
+    changed.append(SearchIndex(parent = error, key_name = 'search', terms = terms or oldTerms, active = error.active,
+                               lastOccurrence = error.lastOccurrence))
+    if terms is not None and error.active:
+      added[projectName].append(terms[len(oldTerms):])
+  if changed:
+    db.put(changed)
+  for projectName, terms in added.items():
+    try:
+      db.run_in_transaction(_countFacets, projectName, search.facetCounts(terms))
+    except Exception: # pylint: disable=W0703
+      logging.exception('Failed to count search facets for %s', projectName)
+
+
+def _day(timestamp):
+  """Returns the start of the day holding the given timestamp, as a string key."""
+  return str(int(timestamp // 86400 * 86400))
+
+
+def addUsers(error, users):
+  """Adds a map from day (as returned by _day) to a list of user ids to the error's affected user sketches."""
+  if not users:
+    return
+  allTime = hyperloglog.HyperLogLog(error.affectedUsers)
+  daily = hyperloglog.DailySketches(error.dailyAffectedUsers)
+  for day, userIds in users.items():
+    for userId in userIds:
+      allTime.add(userId)
+      daily.add(userId, int(day))
+  error.affectedUsers = db.Blob(allTime.pack())
+  error.dailyAffectedUsers = db.Blob(daily.pack())
 
-def aggregateSingleInstance(instance, backtraceText):
+
+def _userId(instance):
+  """Gets the user id from an instance's context, or None."""
+  if instance.affectedUser is not None:
+    return instance.affectedUser
+  if instance.context and 'userId' in instance.context:
+    context = jsoncodec.loads(instance.context)
+    if isinstance(context, dict):
+      return context.get('userId')
+  return None
+
+
+def aggregateSingleInstance(instance, backtraceDigest):
   """Aggregates a single instance into an "aggregate" object."""
+  timestamp = time.mktime(instance.date.timetuple())
+  userId = _userId(instance)
   return {
+    'occurrences': {_minute(timestamp): 1},
+    'users': {_day(timestamp): [userId]} if userId is not None else {},
     'count': 1,
     'firstOccurrence': str(instance.date),
     'lastOccurrence': str(instance.date),
     'lastMessage': instance.message[:300],
-    'backtrace': backtraceText,
-    'environments': (instance.environment,),
-    'servers': (instance.server,),
+    'backtraceDigest': backtraceDigest,
+    'environments': {_breakdownName(instance.environment): 1},
+    'servers': {_breakdownName(instance.server): 1},
   }
 
 
@@ -126,21 +301,34 @@ def aggregateInstances(instances):
     firstOccurrence = None,
     lastOccurrence = None,
     lastMessage = None,
-    backtrace = None,
-    environments = set(),
-    servers = set()
+    backtraceDigest = None,
+    environments = {},
+    servers = {},
+    occurrences = {},
+    users = {}
   )
+  # Each user once per day, as text, which is how the affected user sketches hash them.
+  users = collections.defaultdict(set)
 
   for instance in instances:
+    # Retries queued before occurrences were recorded count everything at the last occurrence.
+    occurrences = (instance.get('occurrences') or
+                   {_minute(time.mktime(parseDate(instance['lastOccurrence']).timetuple())): int(instance['count'])})
+    for minute, count in occurrences.items():
+      result.occurrences[minute] = result.occurrences.get(minute, 0) + count
+    for day, userIds in (instance.get('users') or {}).items():
+      users[day].update('%s' % userId for userId in userIds)
+    for name in ('environments', 'servers'):
+      for value, count in _counts(instance[name]).items():
+        result[name][value] = result[name].get(value, 0) + count
     aggregate(result,
               int(instance['count']),
               parseDate(instance['firstOccurrence']),
               parseDate(instance['lastOccurrence']),
               instance['lastMessage'],
-              instance['backtrace'],
-              instance['environments'],
-              instance['servers'])
+              _backtraceDigest(instance))
 
+  result.users = dict((day, sorted(userIds)) for day, userIds in users.items())
   return result
 
 
@@ -151,11 +339,37 @@ def queueException(serializedException):
   taskqueue.add(queue_name='instances', url='/reportWorker', params={'key': task.key()})
 
 
-def queueAggregation(error, instance, backtraceText):
+def queueExceptions(serializedExceptions):
+  """Enqueues each of the given exceptions, with one put and one task queue call for them all."""
+  tasks = [Queue(payload = serialized) for serialized in serializedExceptions]
+  db.put(tasks)
+  taskqueue.Queue('instances').add([
+    taskqueue.Task(url='/reportWorker', params={'key': str(task.key())}) for task in tasks
+  ])
+
+
+def resolveBacktraces(reports):
+  """Replaces the backtraces sent by digest in the given decoded reports with their stored text.  Returns the digests
+  that are not stored, in which case no report is changed."""
+  digests = list(set(report['backtrace'] for report in reports
+                     if isinstance(report.get('backtrace'), wireformat.Digest)))
+  if not digests:
+    return []
+  stored = dict((digest, entity.text) for digest, entity in zip(digests, Backtrace.get_by_key_name(digests)) if entity)
+  missing = [digest for digest in digests if digest not in stored]
+  if not missing:
+    for report in reports:
+      if isinstance(report.get('backtrace'), wireformat.Digest):
+        report['backtrace'] = stored[report['backtrace']]
+  return missing
+
+
+def queueAggregation(error, instance, backtraceDigest):
   """Enqueues a task to aggregate the given instance in to the given error."""
-  payload = {'error': str(error.key()), 'instance': str(instance.key()), 'backtrace': backtraceText}
+  payload = {'error': str(error.key()), 'instance': str(instance.key()), 'backtraceDigest': backtraceDigest,
+             'queued': time.time()}
   taskqueue.Queue('aggregation').add([
-    taskqueue.Task(payload = json.dumps(payload), method='PULL')
+    taskqueue.Task(payload = jsoncodec.dumps(payload), method='PULL')
   ])
   queueAggregationWorker()
 
@@ -182,6 +396,7 @@ def _putInstance(exception):
   errorLevel = exception.get('errorLevel')
 
   errorHash = generateHash(exceptionType, backtraceText)
+  backtraceDigest = storeBacktrace(backtraceText)
 
   error = getAggregatedError(project, errorHash)
 
@@ -194,7 +409,7 @@ def _putInstance(exception):
   if not error:
     error = LoggedError(
         project = getProject(project),
-        backtrace = backtraceText,
+        backtraceDigest = backtraceDigest,
         type = exceptionType,
         hash = errorHash,
         active = True,
@@ -202,10 +417,14 @@ def _putInstance(exception):
         count = 1,
         firstOccurrence = timestamp,
         lastOccurrence = timestamp,
-        lastMessage = message[:300],
-        environments = [str(environment)],
-        servers = [server])
+        lastMessage = message[:300])
+    addBreakdowns(error, {environment: 1}, {server: 1})
+    addOccurrences(error, {_minute(exception['timestamp']): 1})
+    if isinstance(context, dict) and context.get('userId') is not None:
+      addUsers(error, {_day(exception['timestamp']): [context['userId']]})
     error.put()
+    LoggedErrorSummary.fromError(error).put()
+    indexErrors([error])
     needsAggregation = False
 
   instance = LoggedErrorInstance(
@@ -217,9 +436,10 @@ def _putInstance(exception):
       date = timestamp,
       message = message,
       server = server,
-      logMessage = logMessage)
+      logMessage = logMessage,
+      expires = retention.expiry(project, errorLevel or 'error', timestamp))
   if context:
-    instance.context = json.dumps(context)
+    instance.context = jsoncodec.dumps(context)
     if 'userId' in context:
       try:
         instance.affectedUser = int(context['userId'])
@@ -228,7 +448,7 @@ def _putInstance(exception):
   instance.put()
 
   if needsAggregation:
-    queueAggregation(error, instance, backtraceText)
+    queueAggregation(error, instance, backtraceDigest)
 
 
 
@@ -241,7 +461,7 @@ class ReportWorker(webapp.RequestHandler):
     if not task:
       return
 
-    exception = json.loads(task.payload)
+    exception = jsoncodec.loads(task.payload)
     _putInstance(exception)
     task.delete()
 
@@ -266,7 +486,7 @@ def _unlockError(key):
 def _getTasks(q):
   """Get tasks in smaller chunks to try to work around GAE issues."""
   tasks = []
-  while len(tasks) < 250:
+  while len(tasks) < LEASE_LIMIT:
     try:
       newTasks = q.lease_tasks(180, 25)
     except Exception: # pylint: disable=W0703
@@ -280,6 +500,52 @@ def _getTasks(q):
   return tasks
 
 
+def _recordRun(leased, oldestQueued, lockFailures, retries):
+  """Publishes the metrics of one aggregation run."""
+  now = time.time()
+  memcache.offset_multi({'runs': 1, 'leased': leased, 'lockFailures': lockFailures, 'retries': retries},
+                        namespace = STATS_NAMESPACE, initial_value = 0)
+  memcache.set_multi({
+    'lastRun': now,
+    'leasedLastRun': leased,
+    'oldestLeasedAge': now - oldestQueued if oldestQueued else 0
+  }, namespace = STATS_NAMESPACE)
+
+
+def getAggregationStats():
+  """Gets the aggregation lag and backlog metrics published by the workers.
+
+  The backlog and the age of the oldest pending task come from the aggregation queue's own statistics.  A leased task's
+  eta is when its lease runs out, so while a worker holds tasks the age is that of the oldest task not leased.
+  """
+  stats = memcache.get_multi(['runs', 'leased', 'lockFailures', 'retries', 'lastRun', 'leasedLastRun',
+                              'oldestLeasedAge'], namespace = STATS_NAMESPACE)
+  enqueued = int(memcache.get(AGGREGATION_ID) or 0)
+  runs = stats.get('runs', 0)
+  leased = stats.get('leased', 0)
+  queueStats = taskqueue.Queue('aggregation').fetch_statistics()
+  backlog = queueStats.tasks
+
+  now = time.time()
+  lastRun = stats.get('lastRun')
+  sinceLastRun = now - lastRun if lastRun else 0
+  oldestPendingAge = max(0, now - queueStats.oldest_eta_usec / 1e6) if queueStats.oldest_eta_usec else 0
+
+  return {
+    'enqueued': enqueued,
+    'backlog': backlog,
+    'oldestPendingAge': oldestPendingAge,
+    'oldestLeasedAge': stats.get('oldestLeasedAge', 0),
+    'secondsSinceLastRun': sinceLastRun,
+    'runs': runs,
+    'leased': leased,
+    'leasedLastRun': stats.get('leasedLastRun', 0),
+    'leasedPerRun': float(leased) / runs if runs else 0,
+    'lockFailures': stats.get('lockFailures', 0),
+    'retries': stats.get('retries', 0),
+  }
+
+
 
 class AggregationWorker(webapp.RequestHandler):
   """Worker handler for reporting a new exception."""
@@ -288,7 +554,7 @@ class AggregationWorker(webapp.RequestHandler):
     """Handles a new error report via POST."""
     taskId = self.request.get('id', '0')
     currentId = memcache.get(AGGREGATION_ID)
-    if taskId == 'None' or not (taskId == currentId or int(taskId) % 50 == 0):
+    if taskId == 'None' or not (taskId == str(currentId) or int(taskId) % 50 == 0):
       # Skip this task unless it is the most recently added or if it is one of every fifty tasks.
       logging.debug('Skipping task %s, current is %s', taskId, currentId)
       return
@@ -300,12 +566,15 @@ class AggregationWorker(webapp.RequestHandler):
     byError = collections.defaultdict(list)
     instanceKeys = []
     tasksByError = collections.defaultdict(list)
+    queuedByError = {}
     for task in tasks:
-      data = json.loads(task.payload)
+      data = jsoncodec.loads(task.payload)
       errorKey = data['error']
-      if 'instance' in data and 'backtrace' in data:
+      if 'queued' in data:
+        queuedByError[errorKey] = min(data['queued'], queuedByError.get(errorKey, data['queued']))
+      if 'instance' in data and ('backtraceDigest' in data or 'backtrace' in data):
         instanceKey = data['instance']
-        byError[errorKey].append((instanceKey, data['backtrace']))
+        byError[errorKey].append((instanceKey, _backtraceDigest(data)))
         instanceKeys.append(instanceKey)
         tasksByError[errorKey].append(task)
       elif 'aggregation' in data:
@@ -317,24 +586,42 @@ class AggregationWorker(webapp.RequestHandler):
         q.delete_tasks([task])
 
     retries = 0
+    lockFailures = 0
+    occurrencesByProject = collections.defaultdict(collections.Counter)
+    aggregated = []
     instanceByKey = getInstanceMap(instanceKeys)
     for errorKey, instances in byError.items():
       instances = [keyOrDict
                       if isinstance(keyOrDict, dict)
                       else aggregateSingleInstance(instanceByKey[keyOrDict[0]], keyOrDict[1])
-                   for keyOrDict in instances]
+                   for keyOrDict in instances
+                   if isinstance(keyOrDict, dict) or instanceByKey[keyOrDict[0]]]
+      if not instances:
+        # Every instance was cleared before it could be aggregated.
+        q.delete_tasks(tasksByError[errorKey])
+        continue
       aggregation = aggregateInstances(instances)
 
       success = False
       if _lockError(errorKey):
         try:
           error = LoggedError.get(errorKey)
-          aggregate(
-              error, aggregation.count, aggregation.firstOccurrence,
-              aggregation.lastOccurrence, aggregation.lastMessage, aggregation.backtrace,
-              aggregation.environments, aggregation.servers)
-          error.put()
-          logging.info('Successfully aggregated %r items for key %s', aggregation.count, errorKey)
+          if error is None:
+            # The error was cleared while its instances waited to be aggregated.
+            logging.info('Dropping %r items for deleted key %s', aggregation.count, errorKey)
+          else:
+            aggregate(
+                error, aggregation.count, aggregation.firstOccurrence,
+                aggregation.lastOccurrence, aggregation.lastMessage, aggregation.backtraceDigest)
+            addBreakdowns(error, aggregation.environments, aggregation.servers)
+            addOccurrences(error, aggregation.occurrences)
+            addUsers(error, aggregation.users)
+            alerts.observeError(error, aggregation.occurrences)
+            db.put([error, LoggedErrorSummary.fromError(error)])
+            aggregated.append(error)
+            occurrencesByProject[LoggedError.project.get_value_for_datastore(error).name()].update(
+                aggregation.occurrences)
+            logging.info('Successfully aggregated %r items for key %s', aggregation.count, errorKey)
           success = True
         except: # pylint: disable=W0702
           logging.exception('Error writing to data store for key %s.', errorKey)
@@ -342,21 +629,28 @@ class AggregationWorker(webapp.RequestHandler):
           _unlockError(errorKey)
       else:
         logging.info('Could not lock %s', errorKey)
+        lockFailures += 1
 
       if not success:
         # Add a retry task.
         logging.info('Retrying aggregation for %d items for key %s', len(instances), errorKey)
         aggregation.firstOccurrence = str(aggregation.firstOccurrence)
         aggregation.lastOccurrence = str(aggregation.lastOccurrence)
-        aggregation.environments = list(aggregation.environments)
-        aggregation.servers = list(aggregation.servers)
         taskqueue.Queue('aggregation').add([
-          taskqueue.Task(payload = json.dumps({'error': errorKey, 'aggregation': aggregation}), method='PULL')
+          taskqueue.Task(payload = jsoncodec.dumps({'error': errorKey, 'aggregation': aggregation,
+                                               'queued': queuedByError.get(errorKey, time.time())}),
+                         method='PULL')
         ])
         retries += 1
 
       q.delete_tasks(tasksByError[errorKey])
 
+    if aggregated:
+      indexErrors(aggregated)
+      alerts.observeProjects(occurrencesByProject)
+
+    _recordRun(len(tasks), min(queuedByError.values()) if queuedByError else None, lockFailures, retries)
+
     if retries:
       logging.warn("Retrying %d tasks", retries)
       for _ in range(retries):
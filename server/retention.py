@@ -0,0 +1,149 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""AppEngine cron for deleting expired error instances.
+
+How long instances are kept is set by "retention" in config.json, in days:
+
+  "retention": {"days": 30, "levels": {"warning": 7}, "projects": {"web": {"days": 14, "levels": {"info": 1}}}}
+
+A project's level setting wins over the project's days, then the level's, then the overall days.  Instances with no
+setting are kept forever.
+
+Each instance is given an expiry date when it is stored, so finding expired instances is a keys only query on one
+property.  Archive blocks expire with their last instance.  Instances stored before expiry dates were kept, and archive
+blocks without an expiry, are deleted once they are older than the longest setting.
+The cron starts a pass that deletes a batch at a time from the rate limited "retention" queue, each task resuming
+from its predecessor's cursor.  Counts on LoggedError are never changed.
+"""
+
+from backend import memcache, taskqueue, webapp
+
+from common import isTaskRequest
+import config
+from datamodel import InstanceArchive, LoggedErrorInstance
+import deletion
+import perf
+
+from datetime import datetime, timedelta
+import logging
+import time
+
+
+# Instances are always kept at least this long, so they are aggregated before they expire.
+MIN_DAYS = 1
+
+
+def getEndpoints():
+  """Returns endpoints needed for deleting expired instances."""
+  return [
+    ('/retentionWorker', RetentionWorker)
+  ]
+
+
+def ttlDays(project, errorLevel):
+  """Returns the number of days to keep instances of the given project and level, or None to keep them forever."""
+  settings = config.get('retention') or {}
+  projectSettings = settings.get('projects', {}).get(project, {})
+  for days in (projectSettings.get('levels', {}).get(errorLevel), projectSettings.get('days'),
+               settings.get('levels', {}).get(errorLevel), settings.get('days')):
+    if days is not None:
+      return max(days, MIN_DAYS)
+  return None
+
+
+def expiry(project, errorLevel, date):
+  """Returns when an instance of the given project and level from the given date expires, or None."""
+  days = ttlDays(project, errorLevel)
+  return date + timedelta(days = days) if days is not None else None
+
+
+def _longestDays():
+  """Returns the longest number of days any instance is kept, or None if some are kept forever."""
+  settings = config.get('retention') or {}
+  if settings.get('days') is None:
+    return None
+  days = [settings['days']] + list(settings.get('levels', {}).values())
+  for projectSettings in settings.get('projects', {}).values():
+    days.extend([projectSettings.get('days') or 0] + list(projectSettings.get('levels', {}).values()))
+  return max(max(days), MIN_DAYS)
+
+
+def _queueBatch(phase, before, cursor = None, deleted = 0):
+  """Queues a task to delete the next batch of the pass."""
+  params = {'phase': phase, 'before': before, 'deleted': deleted}
+  if cursor:
+    params['cursor'] = cursor
+  taskqueue.add(queue_name = 'retention', url = '/retentionWorker', params = params)
+
+
+@perf.measured('retention')
+def main():
+  """Starts a pass deleting expired instances, unless one was started in the last hour."""
+  if not config.get('retention'):
+    logging.info('No retention configured')
+    return
+  if not memcache.add('started', True, time = 3600, namespace = 'retention'):
+    logging.info('A retention pass was started in the last hour')
+    return
+  _queueBatch('expires', time.time())
+
+
+
+class RetentionWorker(webapp.RequestHandler):
+  """Worker handler for deleting a batch of expired instances."""
+
+  def post(self):
+    """Deletes a batch and queues the next one."""
+    if not isTaskRequest(self.request):
+      self.error(403)
+      return
+
+    phase = self.request.get('phase')
+    before = float(self.request.get('before'))
+    deleted = int(self.request.get('deleted', 0))
+    longestDays = _longestDays()
+
+    if phase == 'expires':
+      query = LoggedErrorInstance.all(keys_only = True).filter('expires <', datetime.fromtimestamp(before))
+    elif phase == 'archives':
+      query = InstanceArchive.all(keys_only = True).filter('expires <', datetime.fromtimestamp(before))
+    elif longestDays is None:
+      return
+    elif phase == 'legacy':
+      query = LoggedErrorInstance.all(keys_only = True).filter(
+          'date <', datetime.fromtimestamp(before) - timedelta(days = longestDays))
+    else:
+      # Blocks with an expiry are never kept this long, so only those without one are left to match.
+      query = InstanceArchive.all(keys_only = True).filter(
+          'newest <', datetime.fromtimestamp(before) - timedelta(days = longestDays))
+
+    count, cursor = deletion.deleteBatch(query, self.request.get('cursor') or None)
+    deleted += count
+    if deleted >= config.get('retentionMaxDeletesPerPass', 100000):
+      logging.warn('Retention pass stopped after deleting %d instances', deleted)
+    elif cursor:
+      _queueBatch(phase, before, cursor, deleted)
+    elif phase == 'expires':
+      _queueBatch('archives', before, deleted = deleted)
+    elif phase == 'archives' and longestDays is not None:
+      _queueBatch('legacy', before, deleted = deleted)
+    elif phase == 'legacy':
+      _queueBatch('legacyArchives', before, deleted = deleted)
+    else:
+      logging.info('Retention pass deleted %d instances', deleted)
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,113 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Search terms for errors and search queries.
+
+An error's terms are the words of its type, backtrace and messages, lower cased, plus one "facet:value" term for its
+project, level and each environment and server.  Terms are stored in a list property, and a query for several terms
+is a merge join of one composite index on a term, whether the error is active and its last occurrence, so the newest
+matches come first whatever the number of terms.
+"""
+
+import re
+
+
+FACETS = ('project', 'level', 'environment', 'server')
+
+# Most terms kept for one error.  Each term costs two index rows, and an entity may have at most 5000.
+MAX_TERMS = 1000
+
+# Most terms in one query, to bound the merge join.
+MAX_QUERY_TERMS = 10
+
+_WORD = re.compile(r'[A-Za-z0-9_]+')
+
+_DIGIT = re.compile(r'[0-9]')
+
+_STOP_WORDS = frozenset(['a', 'an', 'and', 'at', 'file', 'in', 'is', 'line', 'of', 'on', 'the', 'to'])
+
+
+def tokenize(text):
+  """Returns the searchable words of the given text, in order of first appearance and without repeats.
+
+  Numbers and long words with digits in them are mostly ids, addresses and line numbers, which would make every
+  message a new set of terms, so they are dropped.
+  """
+  words = []
+  seen = set()
+  for word in _WORD.findall(text or ''):
+    word = word.lower()
+    if word in seen or word in _STOP_WORDS or len(word) > 40:
+      continue
+    if word.isdigit() or (len(word) > 4 and _DIGIT.search(word)):
+      continue
+    seen.add(word)
+    words.append(word)
+  return words
+
+
+def facetTerm(facet, value):
+  """Returns the term for the given facet value."""
+  return '%s:%s' % (facet, value)
+
+
+def errorTerms(project, errorLevel, environments, servers, exceptionType, backtraceText, message):
+  """Returns the terms of an error, most important first and without repeats."""
+  terms = [facetTerm('project', project), facetTerm('level', errorLevel or 'error')]
+  terms.extend(facetTerm('environment', environment) for environment in environments)
+  terms.extend(facetTerm('server', server) for server in servers)
+  terms.extend(tokenize(exceptionType))
+  terms.extend(tokenize(backtraceText))
+  terms.extend(tokenize(message))
+  return mergeTerms([], terms) or []
+
+
+def mergeTerms(old, new):
+  """Returns old terms followed by the new terms not in them, up to MAX_TERMS, or None if nothing was added."""
+  merged = list(old)
+  known = set(old)
+  for term in new:
+    if len(merged) >= MAX_TERMS:
+      break
+    if term not in known:
+      known.add(term)
+      merged.append(term)
+  if len(merged) == len(old):
+    return None
+  return merged
+
+
+def parseQuery(query):
+  """Returns the terms of a query, which is words to search for and "facet:value" filters."""
+  terms = []
+  for part in query.split():
+    facet, _, value = part.partition(':')
+    if value and facet in FACETS:
+      term = facetTerm(facet, value)
+      if term not in terms:
+        terms.append(term)
+    else:
+      terms.extend(word for word in tokenize(part) if word not in terms)
+  return terms[:MAX_QUERY_TERMS]
+
+
+def facetCounts(terms):
+  """Returns a map from facet to a map from value to count of the facet terms in the given term lists."""
+  counts = dict((facet, {}) for facet in FACETS)
+  for termList in terms:
+    for term in termList:
+      facet, _, value = term.partition(':')
+      if value and facet in counts:
+        counts[facet][value] = counts[facet].get(value, 0) + 1
+  return counts
@@ -0,0 +1,59 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for search terms."""
+
+import unittest
+
+import search
+
+
+
+class SearchTestCase(unittest.TestCase):
+  """Tests for search terms."""
+
+  def testTokenize(self):
+    """Test that words are split on punctuation, lower cased and deduplicated, and ids are dropped."""
+    self.assertEqual(['com', 'example', 'foo', 'bar', 'java', 'utf8'],
+                     search.tokenize('at com.example.Foo.bar(Foo.java:1234) UTF8 8f3a9c2e1d'))
+
+
+  def testErrorTerms(self):
+    """Test that an error's facets come before its words."""
+    terms = search.errorTerms('web', None, ['prod'], ['web-1'], 'KeyError', 'File "a.py", line 3, in get',
+                              "KeyError: 'userName'")
+    self.assertEqual(['project:web', 'level:error', 'environment:prod', 'server:web-1', 'keyerror', 'py', 'get',
+                      'username'], terms)
+
+
+  def testMergeTerms(self):
+    """Test that merging keeps old terms, appends new ones, and reports no change."""
+    self.assertEqual(['a', 'b', 'c'], search.mergeTerms(['a', 'b'], ['b', 'c']))
+    self.assertEqual(None, search.mergeTerms(['a', 'b'], ['b', 'a']))
+    merged = search.mergeTerms([], ['t%d' % i for i in range(search.MAX_TERMS + 10)])
+    self.assertEqual(search.MAX_TERMS, len(merged))
+
+
+  def testParseQuery(self):
+    """Test that facet filters are kept whole and other words are tokenized like errors."""
+    self.assertEqual(['project:web', 'null', 'pointer', 'server:web-1', 'unknown'],
+                     search.parseQuery('project:web Null.Pointer server:web-1 unknown:'))
+
+
+  def testFacetCounts(self):
+    """Test that facet terms are counted once per term list."""
+    counts = search.facetCounts([['project:web', 'server:a', 'x'], ['project:web', 'server:b']])
+    self.assertEqual({'web': 2}, counts['project'])
+    self.assertEqual({'a': 1, 'b': 1}, counts['server'])
+    self.assertEqual({}, counts['environment'])
@@ -14,35 +14,33 @@
 
 """AppEngine server for collecting exceptions."""
 
-# pylint: disable=E0611
-from google.appengine.dist import use_library
-use_library('django', '1.2')
-
-# pylint: disable=E0611
-from google.appengine.api import users
-# pylint: disable=E0611
-from google.appengine.ext import db, webapp
-# pylint: disable=E0611
-from google.appengine.ext.webapp import template
-# pylint: disable=E0611
-from google.appengine.ext.webapp.util import run_wsgi_app
+from backend import db, run_wsgi_app, template, users, webapp
 
+import alerts
+import archive
 import config
+import deletion
+import histogram
+import jsoncodec
+import perf
+import queryplan
 import queue
+import retention
+import search
+import topk
+import wireformat
 
 from datetime import datetime, timedelta
-try:
-  from django.utils import simplejson as json
-except ImportError:
-  import json
 import logging
 import random
 import sys
 import time
 import traceback
+import urllib
 
 from common import getProject, getTemplatePath
-from datamodel import LoggedError, LoggedErrorInstance, AggregatedStats
+from datamodel import (LoggedError, LoggedErrorInstance, LoggedErrorSummary, AggregatedStats, DeletionJob, SearchFacets,
+                       SearchIndex)
 
 
 ####### Parse the configuration. #######
@@ -71,53 +69,169 @@ def getFilters(request):
   return filters
 
 
-def filterInstances(dataSet, key, value):
-  """Filters a data set."""
+def filterValue(key, value):
+  """Converts the value of an instance filter to the type stored."""
   if key in INTEGER_FILTERS:
-    return dataSet.filter(key + ' =', int(value))
-  elif key == 'maxAgeHours':
-    return dataSet
-  else:
-    return dataSet.filter(key + ' =', value)
+    return int(value)
+  return value
+
 
+def getErrors(filters, limit, before = None):
+  """Gets a page of error summaries from before the given date (or any date), filtered by the given filters.
 
-def getErrors(filters, limit, offset):
-  """Gets a list of errors, filtered by the given filters."""
+  Summaries are listed from an index on whether they are active and when they last (or first) occurred, optionally
+  led by project.  Filters that index does not serve, the level and, for recent errors, the project, are answered by
+  a merge join when few summaries match, and otherwise by scanning that index.
+  """
   for key in filters:
     if key in INSTANCE_FILTERS:
-      return None, getInstances(filters, limit=limit, offset=offset)
-
-  errors = LoggedError.all().filter('active =', True)
-  for key, value in filters.items():
-    if key == 'maxAgeHours':
-      errors = errors.filter('firstOccurrence >', datetime.now() - timedelta(hours = int(value)))
-    elif key == 'project':
-      errors = errors.filter('project =', getProject(value))
-    else:
-      errors = errors.filter(key, value)
+      return None, getInstances(filters, limit = limit, before = before)
+
+  errors = LoggedErrorSummary.all().filter('active =', True)
   if 'maxAgeHours' in filters:
-    errors = errors.order('-firstOccurrence')
+    since = datetime.now() - timedelta(hours = int(filters['maxAgeHours']))
+    errors = errors.filter('firstOccurrence >', since)
+    order = 'firstOccurrence'
+    indexed = ()
   else:
-    errors = errors.order('-lastOccurrence')
+    since = None
+    if 'project' in filters:
+      errors = errors.filter('project =', filters['project'])
+    order = 'lastOccurrence'
+    indexed = ('project',)
+  if before:
+    errors = errors.filter(order + ' <', before)
+  errors = errors.order('-' + order)
+
+  unindexed = dict((key, filters[key]) for key in ('project', 'errorLevel') if key in filters and key not in indexed)
+  if unindexed:
+    equalities = dict((key, filters[key]) for key in ('project', 'errorLevel') if key in filters)
+    test = lambda summary: ((since is None or summary.firstOccurrence > since) and
+                            (before is None or getattr(summary, order) < before))
+    results = queryplan.mergeJoin(LoggedErrorSummary, dict(equalities, active = True), order, limit, test)
+    if results is not None:
+      return results, None
+  return queryplan.scan(errors, LoggedErrorSummary, unindexed, order, limit), None
+
+
+def getInstances(filters, parent = None, limit = 51, before = None):
+  """Gets a page of instances of the given parent error from before the given date (or any date), filtered by the
+  given filters.
+
+  Instances are only indexed by error and date, and by project and date.  Environment, server and user filters are
+  answered by a merge join when few instances match, and otherwise by scanning the error's, the project's or all
+  instances newest first.
+  """
+  query = LoggedErrorInstance.all()
+  equalities = {}
+  if parent:
+    query = query.filter('error =', parent)
+    equalities['error'] = parent.key()
+  elif 'project' in filters:
+    projectKey = getProject(filters['project']).key()
+    query = query.filter('project =', projectKey)
+    equalities['project'] = projectKey
+  if before:
+    query = query.filter('date <', before)
+  query = query.order('-date')
+
+  unindexed = dict((key, filterValue(key, value)) for key, value in filters.items() if key in INSTANCE_FILTERS)
+  if unindexed:
+    results = queryplan.mergeJoin(LoggedErrorInstance, dict(equalities, **unindexed), 'date', limit,
+                                  (lambda instance: instance.date < before) if before else None)
+    if results is not None:
+      return results
+  return queryplan.scan(query, LoggedErrorInstance, unindexed, 'date', limit)
+
+
+# Most errors a search returns.
+MAX_SEARCH_RESULTS = 200
+
+
+def searchErrors(terms):
+  """Searches for active errors with all the given terms.  Returns the errors, most recent first, and a map from
+  facet to a list of (value, number of errors) pairs, most common first.
+
+  When the only term is a project, or there are none, the facet counts are the ones kept for each project.  Otherwise
+  they are counted over the errors found.
+  """
+  facetCounts = None
+  if len(terms) <= 1 and all(term.startswith('project:') for term in terms):
+    if terms:
+      facets = [SearchFacets.get_by_key_name(terms[0].partition(':')[2])]
+    else:
+      facets = SearchFacets.all().fetch(1000)
+    facetCounts = dict((facet, {}) for facet in search.FACETS)
+    for entity in facets:
+      for facet, values in (jsoncodec.loads(entity.counts) if entity and entity.counts else {}).items():
+        for value, count in values.items():
+          facetCounts[facet][value] = facetCounts[facet].get(value, 0) + count
 
-  return errors.fetch(limit, offset), None
+  errors = []
+  if terms:
+    query = SearchIndex.all().filter('active =', True)
+    for term in terms:
+      query = query.filter('terms =', term)
+    indexes = query.order('-lastOccurrence').fetch(MAX_SEARCH_RESULTS)
+    errors = [error for error in LoggedError.get([index.parent_key() for index in indexes]) if error]
+    if facetCounts is None:
+      facetCounts = search.facetCounts([[term for term in index.terms if ':' in term] for index in indexes])
 
+  return errors, dict((facet, sorted(values.items(), key = lambda x: x[1], reverse = True))
+                      for facet, values in facetCounts.items())
 
-def getInstances(filters, parent = None, limit = None, offset = None):
-  """Gets a list of instances of the given parent error, filtered by the given filters."""
 
-  query = LoggedErrorInstance.all()
-  if parent:
-    query = query.filter('error =', parent)
+# Errors or instances shown on each page of the list page.
+LIST_PAGE_SIZE = 50
+
+# Instances shown on each page of the view page.
+VIEW_PAGE_SIZE = 100
 
-  if filters:
-    for key, value in filters.items():
-      if key in INSTANCE_FILTERS:
-        query = filterInstances(query, key, value)
-      elif key == 'project' and not parent:
-        query = query.filter('project =', getProject(value))
+DATE_PARAMETER_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
 
-  return query.order('-date').fetch(limit or 51, offset or 0)
+
+def getErrorInstances(error, filters, before):
+  """Gets a page of instances of the given error from before the given date (or any date), newest first, continuing
+  in to the archive when there are too few recent ones."""
+  instances = getInstances(filters, parent = error, limit = VIEW_PAGE_SIZE, before = before)
+  if len(instances) < VIEW_PAGE_SIZE and not instances.truncated:
+    instances.extend(archive.getArchivedInstances(
+        error, filters, instances[-1].date if instances else before, VIEW_PAGE_SIZE - len(instances)))
+  return instances
+
+
+def getBefore(request):
+  """Gets the date the requested page starts before, or None for the newest page."""
+  before = request.get('before')
+  return datetime.strptime(before, DATE_PARAMETER_FORMAT) if before else None
+
+
+def getOlderUrl(path, filters, before):
+  """Gets the url of the page at the given path with the given filters from before the given date, or None if there
+  is no date."""
+  if before is None:
+    return None
+  return '%s?%s' % (path, urllib.urlencode(dict([(name, value.encode('utf-8')) for name, value in filters.items()],
+                                                before = before.strftime(DATE_PARAMETER_FORMAT))))
+
+
+def getBreakdown(serialized):
+  """Gets (value, count, overestimate) triples, most common first, and the count of other occurrences from serialized
+  top value counts."""
+  top = topk.TopK(serialized)
+  return top.items(), top.other()
+
+
+def getHistograms(error):
+  """Gets the occurrence graphs of an error as (resolution, [(bucket start, count, height percent)]) pairs."""
+  counts = histogram.Histogram(error.histogram)
+  now = time.time()
+  graphs = []
+  for resolution, _, _ in histogram.RESOLUTIONS:
+    series = counts.series(resolution, now)
+    peak = max(count for _, count in series) or 1
+    graphs.append((resolution, [(datetime.fromtimestamp(start), count, count * 100 // peak) for start, count in series]))
+  return graphs
 
 
 ####### Pages #######
@@ -163,15 +277,37 @@ class ReportPage(webapp.RequestHandler):
   """Page handler for reporting a new exception."""
 
   def post(self):
-    """Handles a new error report via POST."""
+    """Handles a new error report, or a compact batch of them, via POST."""
     key = self.request.get('key')
 
     if key != SECRET_KEY:
       self.error(403)
       return
 
-    # Add the task to the instances queue.
-    queue.queueException(self.request.body)
+    # Clients send reports in the compact format once they see the server accepts it.
+    self.response.headers['X-Gec-Formats'] = wireformat.CONTENT_TYPE
+    if self.request.headers.get('Content-Type', '').split(';')[0].strip() != wireformat.CONTENT_TYPE:
+      # Add the task to the instances queue.
+      queue.queueException(self.request.body)
+      return
+
+    try:
+      reports = wireformat.decode(self.request.body)
+    except ValueError as e:
+      self.error(400)
+      self.response.out.write(str(e))
+      return
+
+    # A client resends a batch with the backtraces we don't have in full.
+    missing = queue.resolveBacktraces(reports)
+    if missing:
+      self.error(409)
+      self.response.headers['Content-Type'] = 'text/plain'
+      self.response.out.write('\n'.join(missing))
+      return
+
+    if reports:
+      queue.queueExceptions([jsoncodec.dumps(report) for report in reports])
 
 
 
@@ -202,6 +338,29 @@ class StatPage(webapp.RequestHandler):
 
 
 
+class AggregationStatPage(webapp.RequestHandler):
+  """Page handler for aggregation lag and backlog metrics."""
+
+  def get(self):
+    """Writes the requested metrics separated by spaces, or every metric with its name, one per line."""
+    key = self.request.get('key')
+
+    if key != SECRET_KEY:
+      self.error(403)
+      return
+
+    stats = queue.getAggregationStats()
+    self.response.headers['Content-Type'] = 'text/plain'
+    formatValue = lambda value: '%.1f' % value if isinstance(value, float) else str(value)
+    names = self.request.get('metrics').split()
+    if names:
+      self.response.out.write(' '.join(formatValue(stats.get(name, 0)) for name in names))
+    else:
+      self.response.out.write('\n'.join('%s %s' % (name, formatValue(stats[name]))
+                                         for name in queue.AGGREGATION_METRICS))
+
+
+
 class AggregateViewPage(webapp.RequestHandler):
   """Page handler for collecting error instance stats."""
 
@@ -212,7 +371,7 @@ class AggregateViewPage(webapp.RequestHandler):
       viewLength = 'day'
 
     data = AggregatedStats.all().order('-date').get()
-    data = json.loads(data.json)[:25]
+    data = jsoncodec.loads(data.json)[:25]
 
     for _, row in data:
       logging.info(row)
@@ -239,30 +398,63 @@ class ListPage(AuthPage):
 
     filters = getFilters(self.request)
 
-    page = int(self.request.get('page', 0))
-    errors, instances = getErrors(filters, limit = 51, offset = page * 50)
-
-    if errors is not None:
-      hasMore = len(errors) == 51
-      errors = errors[:50]
-    else:
-      hasMore = len(instances) == 51
-      instances = instances[:50]
+    errors, instances = getErrors(filters, limit = LIST_PAGE_SIZE + 1, before = getBefore(self.request))
+    page = errors if errors is not None else instances
 
     context = {
       'title': NAME,
       'extraScripts': ['list'],
       'user': user,
       'filters': filters.items(),
-      'errors': errors,
-      'instances': instances,
-      'hasMore': hasMore,
-      'nextPage': page + 1
+      'errors': errors and errors[:LIST_PAGE_SIZE],
+      'instances': instances and instances[:LIST_PAGE_SIZE],
+      'truncated': page.truncated,
+      'scanned': queryplan.MAX_SCAN,
+      'olderUrl': getOlderUrl('/', filters, page.nextBefore(LIST_PAGE_SIZE))
     }
     self.response.out.write(template.render(getTemplatePath('list.html'), context))
 
 
 
+class SearchPage(AuthPage):
+  """Page searching errors by type, message and backtrace words, and by facet."""
+
+  def doAuthenticatedGet(self, user, *args):
+    extension, = args
+    query = self.request.get('q', '')
+    terms = search.parseQuery(query)
+    errors, facets = searchErrors(terms)
+
+    if extension == '.json':
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.out.write(jsoncodec.dumps({
+        'terms': terms,
+        'errors': [{
+          'key': str(error.key()),
+          'project': LoggedError.project.get_value_for_datastore(error).name(),
+          'type': error.type,
+          'lastMessage': error.lastMessage,
+          'count': error.count,
+          'lastOccurrence': error.lastOccurrence.isoformat(),
+          'active': error.active
+        } for error in errors],
+        'facets': facets
+      }))
+    else:
+      self.response.headers['Content-Type'] = 'text/html'
+      context = {
+        'title': 'Search - %s' % NAME,
+        'user': user,
+        'query': query,
+        'terms': terms,
+        'errors': errors,
+        'facets': [(facet, facets[facet][:25]) for facet in search.FACETS if facets[facet]],
+        'truncated': len(errors) == MAX_SEARCH_RESULTS
+      }
+      self.response.out.write(template.render(getTemplatePath('search.html'), context))
+
+
+
 class ViewPage(AuthPage):
   """Page displaying a single exception."""
 
@@ -271,13 +463,23 @@ class ViewPage(AuthPage):
     self.response.headers['Content-Type'] = 'text/html'
     error = LoggedError.get(key)
     filters = getFilters(self.request)
+    instances = getErrorInstances(error, filters, getBefore(self.request))
     context = {
       'title': '%s - %s' % (error.lastMessage, NAME),
       'extraScripts': ['view'],
       'user': user,
       'error': error,
+      'backtrace': error.getBacktrace(),
+      'histograms': getHistograms(error),
+      'environmentCounts': getBreakdown(error.environmentCounts),
+      'serverCounts': getBreakdown(error.serverCounts),
+      'recentUsers': error.recentAffectedUserCounts(),
       'filters': filters.items(),
-      'instances': getInstances(filters, parent=error)[:100]
+      'instances': instances,
+      'truncated': instances.truncated,
+      'scanned': queryplan.MAX_SCAN,
+      'olderUrl': getOlderUrl('/view/%s' % key, filters, instances[-1].date if len(instances) == VIEW_PAGE_SIZE
+                              else instances.resumeBefore)
     }
     self.response.out.write(template.render(getTemplatePath('view.html'), context))
 
@@ -290,25 +492,108 @@ class ResolvePage(AuthPage):
     key, = args
     self.response.headers['Content-Type'] = 'text/plain'
     error = LoggedError.get(key)
+    wasActive = error.active
     error.active = False
-    error.put()
+    index = SearchIndex.get_by_key_name('search', parent = error)
+    if index:
+      index.active = False
+    db.put([entity for entity in (error, LoggedErrorSummary.fromError(error), index) if entity])
+    if wasActive and index:
+      queue.uncountFacets([index])
 
     self.response.out.write('ok')
 
 
 
+# Oldest age the clear form accepts, a hundred years, so the dates it gives are always valid.
+MAX_CLEAR_AGE_HOURS = 100 * 365 * 24
+
+
+
 class ClearDatabasePage(AuthPage):
-  """Page for clearing the database."""
-
-  def doAuthenticatedGet(self, _):
-    if users.is_current_user_admin():
-      for error in LoggedError.all():
-        error.delete()
-      for instance in LoggedErrorInstance.all():
-        instance.delete()
-      self.response.out.write('Done')
-    else:
+  """Page for clearing the database, or part of it, in the background."""
+
+  def doAuthenticatedGet(self, user):
+    if not users.is_current_user_admin():
       self.redirect(users.create_login_url(self.request.uri))
+      return
+
+    self.__render(user)
+
+
+  def __render(self, user, formError = None):
+    """Writes the form, with the submitted values and what was wrong with them if given, and the recent jobs."""
+    self.response.headers['Content-Type'] = 'text/html'
+    context = {
+      'title': 'Clear - %s' % NAME,
+      'user': user,
+      'jobs': DeletionJob.all().order('-created').fetch(20),
+      'formError': formError,
+      'project': self.request.get('project') if formError else '',
+      'minAgeHours': self.request.get('minAgeHours') if formError else '',
+      'maxAgeHours': self.request.get('maxAgeHours') if formError else ''
+    }
+    self.response.out.write(template.render(getTemplatePath('clear.html'), context))
+
+
+  @staticmethod
+  def __parseHours(value):
+    """Returns a submitted number of hours, None if it is blank, or raises ValueError."""
+    value = value.strip()
+    if not value:
+      return None
+    hours = float(value)
+    if not 0 <= hours <= MAX_CLEAR_AGE_HOURS:
+      raise ValueError(value)
+    return hours
+
+
+  def doAuthenticatedPost(self, user):
+    if not users.is_current_user_admin():
+      self.redirect(users.create_login_url(self.request.uri))
+      return
+
+    try:
+      minAgeHours = self.__parseHours(self.request.get('minAgeHours'))
+      maxAgeHours = self.__parseHours(self.request.get('maxAgeHours'))
+    except ValueError:
+      self.response.set_status(400)
+      self.__render(user, 'Ages must be numbers of hours from 0 to %d.' % MAX_CLEAR_AGE_HOURS)
+      return
+    if minAgeHours is not None and maxAgeHours is not None and minAgeHours >= maxAgeHours:
+      self.response.set_status(400)
+      self.__render(user, 'The newer than age must be more hours than the older than age.')
+      return
+
+    now = datetime.now()
+    deletion.startJob(project = self.request.get('project').strip(),
+                      before = now - timedelta(hours = minAgeHours) if minAgeHours is not None else None,
+                      after = now - timedelta(hours = maxAgeHours) if maxAgeHours is not None else None)
+    self.redirect('/clear')
+
+
+
+class PerfPage(AuthPage):
+  """Page showing datastore, memcache and taskqueue usage by handler and call site."""
+
+  def doAuthenticatedGet(self, user, *args):
+    if not users.is_current_user_admin():
+      self.redirect(users.create_login_url(self.request.uri))
+      return
+
+    extension, = args
+    report = perf.report(int(self.request.get('minutes', perf.WINDOW_MINUTES)))
+    if extension == '.json':
+      self.response.headers['Content-Type'] = 'application/json'
+      self.response.out.write(jsoncodec.dumps(report))
+    else:
+      self.response.headers['Content-Type'] = 'text/html'
+      context = {
+        'title': 'Performance - %s' % NAME,
+        'user': user,
+        'report': report
+      }
+      self.response.out.write(template.render(getTemplatePath('perf.html'), context))
 
 
 
@@ -327,7 +612,7 @@ class ErrorPage(webapp.RequestHandler):
           x = 10 / 0
         elif error == 1:
           errorLevel = 'warning'
-          json.loads('{"abc", [1, 2')
+          jsoncodec.loads('{"abc", [1, 2')
         elif error == 2:
           x = {}
           x = x['y']
@@ -351,15 +636,15 @@ class ErrorPage(webapp.RequestHandler):
           'backtrace': stack,
           'context':{'userId':random.choice(range(20))}
         }
-        queue.queueException(json.dumps(exception))
+        queue.queueException(jsoncodec.dumps(exception))
 
     self.response.out.write('Done!')
 
 
 ####### Application. #######
 
-def main():
-  """Runs the server."""
+def getApplication():
+  """Creates the WSGI application."""
   endpoints = [
     ('/', ListPage),
 
@@ -367,17 +652,25 @@ def main():
 
     ('/report', ReportPage),
 
+    ('/search(\.json)?', SearchPage),
     ('/view/(.*)', ViewPage),
     ('/resolve/(.*)', ResolvePage),
 
     ('/stats', StatPage),
+    ('/aggregationStats', AggregationStatPage),
     ('/review/(.*)', AggregateViewPage),
-  ] + queue.getEndpoints()
+
+    ('/debug/perf(\.json)?', PerfPage),
+  ] + (queue.getEndpoints() + alerts.getEndpoints() + retention.getEndpoints() + deletion.getEndpoints() +
+       archive.getEndpoints())
   if config.get('demo'):
     endpoints.append(('/error', ErrorPage))
-  application = webapp.WSGIApplication(endpoints, debug=True)
+  return perf.instrument(webapp.WSGIApplication(endpoints, debug=True), endpoints)
+
 
-  run_wsgi_app(application)
+def main():
+  """Runs the server."""
+  run_wsgi_app(getApplication())
 
 
 if __name__ == "__main__":
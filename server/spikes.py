@@ -0,0 +1,106 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Spike detection over per minute occurrence counts.
+
+The state of each error or project is packed in to a short string: the current minute, its count so far, an
+exponentially weighted moving mean and variance of the counts of the minutes before it, the first minute seen, and the
+last spike found.  Counts are checked against the baseline as they arrive, so a spike is found while its minute is
+still in progress rather than after it ends.  Nothing fires until the baseline has warmed up, since a new error's
+baseline starts at zero.
+"""
+
+import math
+import struct
+
+
+_STATE = struct.Struct('>qIdddqqId')
+
+# States packed before the first minute and last spike were kept.
+_OLD_STATE = struct.Struct('>qIddd')
+
+# Longest run of empty minutes folded in to the baseline one by one.  After this many the baseline is all but zero.
+MAX_GAP = 240
+
+
+
+class SpikeDetector(object):
+  """Finds minutes whose count is far above the moving baseline."""
+
+  def __init__(self, alpha=0.1, threshold=4.0, minCount=10, cooldown=3600, warmup=30):
+    self.__alpha = alpha
+    self.__threshold = threshold
+    self.__minCount = minCount
+    self.__cooldown = cooldown
+    self.__warmup = warmup
+
+
+  def __fold(self, mean, variance, count):
+    """Folds a completed minute's count in to the baseline."""
+    diff = count - mean
+    increment = self.__alpha * diff
+    return mean + increment, (1 - self.__alpha) * (variance + diff * increment)
+
+
+  def observe(self, packed, occurrences, now):
+    """Adds a map from minute start timestamp to count to the packed state.
+
+    Returns (new packed state, spike), where spike is None or a (minute start timestamp, count, baseline mean) tuple
+    for a minute that crossed the threshold outside the cooldown, at least warmup minutes after the first minute seen.
+    Counts for minutes before the current one are too late to matter and are ignored.
+    """
+    minute, count, mean, variance, lastAlert, firstMinute, spikeStart, spikeCount, spikeMean = _unpack(packed)
+
+    spike = None
+    for start, added in sorted((int(start), added) for start, added in occurrences.items()):
+      current = start // 60
+      if current < minute:
+        continue
+      if not firstMinute:
+        firstMinute = current
+      if current > minute:
+        if minute:
+          mean, variance = self.__fold(mean, variance, count)
+          for _ in range(min(current - minute - 1, MAX_GAP)):
+            mean, variance = self.__fold(mean, variance, 0)
+        minute, count = current, 0
+      count += added
+
+      # A steady rate has almost no variance, so count noise is floored at that of a Poisson process.
+      limit = mean + self.__threshold * math.sqrt(max(variance, mean, 1.0))
+      if (count >= self.__minCount and count > limit and now - lastAlert >= self.__cooldown and
+          minute - firstMinute >= self.__warmup):
+        lastAlert = now
+        spike = (minute * 60, count, mean)
+        spikeStart, spikeCount, spikeMean = spike
+
+    count = min(count, 2 ** 32 - 1)
+    packed = _STATE.pack(minute, count, mean, variance, lastAlert, firstMinute, spikeStart, spikeCount, spikeMean)
+    return packed, spike
+
+
+
+def lastSpike(packed):
+  """Returns the (minute start timestamp, count, baseline mean) of the last spike in the packed state, or None."""
+  spike = _unpack(packed)[-3:]
+  return spike if spike[0] else None
+
+
+def _unpack(packed):
+  """Unpacks a state.  States from before warm-up was tracked count as warmed up."""
+  if not packed:
+    return 0, 0, 0.0, 0.0, 0.0, 0, 0, 0, 0.0
+  if len(packed) == _OLD_STATE.size:
+    return _OLD_STATE.unpack(packed) + (1, 0, 0, 0.0)
+  return _STATE.unpack(packed)
@@ -0,0 +1,99 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for spike detection."""
+
+import unittest
+
+import spikes
+
+START = 1300000020
+
+
+
+class SpikeDetectorTestCase(unittest.TestCase):
+  """Tests for spike detection."""
+
+  def setUp(self):
+    self.detector = spikes.SpikeDetector(alpha=0.1, threshold=4.0, minCount=10, cooldown=3600)
+    self.state = None
+    self.now = START
+    for minute in range(60):
+      self.state, spike = self.observe(minute, 5)
+      self.assertEqual(None, spike)
+
+
+  def observe(self, minute, count):
+    """Observes count occurrences in the given minute after START."""
+    self.now = START + minute * 60
+    return self.detector.observe(self.state, {START + minute * 60: count}, self.now)
+
+
+  def testSteadyRateIsQuiet(self):
+    """Test that a rate near the baseline never fires."""
+    self.state, spike = self.observe(60, 7)
+    self.assertEqual(None, spike)
+
+
+  def testSpikeFiresDuringItsMinute(self):
+    """Test that a spike fires as soon as the running count crosses the threshold."""
+    self.state, spike = self.observe(60, 10)
+    self.assertEqual(None, spike)
+    self.state, spike = self.observe(60, 40)
+    self.assertEqual(START + 3600 - START % 60, spike[0])
+    self.assertEqual(50, spike[1])
+    self.assertTrue(4 < spike[2] < 6)
+
+
+  def testCooldown(self):
+    """Test that a storm only fires once per cooldown."""
+    self.state, spike = self.observe(60, 100)
+    self.assertTrue(spike)
+    for minute in range(61, 100):
+      self.state, spike = self.observe(minute, 1000)
+      self.assertEqual(None, spike)
+    self.state, spike = self.observe(121, 100000)
+    self.assertTrue(spike)
+
+
+  def testLateCountsIgnored(self):
+    """Test that counts for minutes before the current one are ignored."""
+    self.state, _ = self.observe(61, 5)
+    self.state, spike = self.observe(60, 1000)
+    self.assertEqual(None, spike)
+
+
+  def testNewErrorWarmsUp(self):
+    """Test that a new error's first busy minutes don't fire, however far they are above its empty baseline."""
+    state = None
+    for minute in range(30):
+      state, spike = self.detector.observe(state, {START + minute * 60: 1000}, START + minute * 60)
+      self.assertEqual(None, spike)
+    state, spike = self.detector.observe(state, {START + 30 * 60: 100000}, START + 30 * 60)
+    self.assertTrue(spike)
+
+
+  def testLastSpike(self):
+    """Test that the last spike is kept in the state, so an alert can be built from it."""
+    self.assertEqual(None, spikes.lastSpike(self.state))
+    self.state, spike = self.observe(60, 100)
+    self.state, _ = self.observe(61, 5)
+    self.assertEqual(spike, spikes.lastSpike(self.state))
+
+
+  def testOldStateIsWarm(self):
+    """Test that states packed before warm-up was tracked can still fire."""
+    old = spikes._OLD_STATE.pack(*spikes._STATE.unpack(self.state)[:5]) # pylint: disable=W0212
+    _, spike = self.detector.observe(old, {START + 3600: 100}, START + 3600)
+    self.assertTrue(spike)
@@ -39,35 +39,30 @@ $(document).ready(function() {
   $('.filter').click(function() {
     var parts = this.innerHTML.split(':', 1);
     delete urlParams[parts[0]];
-    delete urlParams.page;
+    delete urlParams.before;
     updateRequest();
   });
   $('a.environment').click(function() {
     urlParams.environment = this.innerHTML;
-    delete urlParams.page;
+    delete urlParams.before;
     updateRequest();
     return false;
   });
   $('a.errorLevel').click(function() {
     urlParams.errorLevel = this.innerHTML;
-    delete urlParams.page;
+    delete urlParams.before;
     updateRequest();
     return false;
   });
   $('a.project').click(function() {
     urlParams.project = this.innerHTML;
-    delete urlParams.page;
+    delete urlParams.before;
     updateRequest();
     return false;
   });
   $('a.server').click(function() {
     urlParams.server = this.innerHTML;
-    delete urlParams.page;
-    updateRequest();
-    return false;
-  });
-  $('a.next').click(function() {
-    urlParams.page = (parseInt(urlParams.page) || 0) + 1;
+    delete urlParams.before;
     updateRequest();
     return false;
   });
@@ -0,0 +1,26 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Mapper that writes the summary of each error, for the error list.  Run it over the LoggedError kind after upgrading
+from a version without summaries."""
+
+from mapreduce import operation as op
+
+from datamodel import LoggedErrorSummary
+
+
+def process(entity):
+  """Process an error by putting its summary."""
+  yield op.db.Put(LoggedErrorSummary.fromError(entity))
@@ -0,0 +1,89 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Bounded counts of the most common values, using the Space-Saving algorithm.
+
+At most a fixed number of values are tracked.  When a new value arrives and every slot is taken, it replaces the least
+common value and inherits its count, remembering that count as its possible overestimate.  Any value that is more
+than 1 / size of the total is always tracked, and the size and cost of an update never grow.
+"""
+
+import jsoncodec
+
+
+DEFAULT_SIZE = 20
+
+
+
+class TopK(object):
+  """Counts of the most common values seen."""
+
+  def __init__(self, serialized=None, size=DEFAULT_SIZE):
+    self.__size = size
+    self.__counts = {}
+    self.__errors = {}
+    self.total = 0
+    if serialized:
+      data = jsoncodec.loads(serialized)
+      self.total = data['total']
+      for value, count, error in data['items']:
+        self.__counts[value] = count
+        self.__errors[value] = error
+
+
+  def add(self, value, count=1):
+    """Adds count occurrences of the given value.  Returns self."""
+    self.total += count
+    if value in self.__counts:
+      self.__counts[value] += count
+    elif len(self.__counts) < self.__size:
+      self.__counts[value] = count
+      self.__errors[value] = 0
+    else:
+      smallest = min(self.__counts, key = self.__counts.get)
+      floor = self.__counts.pop(smallest)
+      del self.__errors[smallest]
+      self.__counts[value] = floor + count
+      self.__errors[value] = floor
+    return self
+
+
+  def update(self, counts):
+    """Adds a map from value to count.  Returns self."""
+    # Largest first, so a batch's own rare values are the ones evicted.
+    for value, count in sorted(counts.items(), key = lambda item: item[1], reverse = True):
+      self.add(value, count)
+    return self
+
+
+  def items(self):
+    """Returns (value, count, overestimate) triples, most common first.  The true count of each value is between
+    count - overestimate and count."""
+    return sorted(((value, count, self.__errors[value]) for value, count in self.__counts.items()),
+                  key = lambda item: (-item[1], item[0]))
+
+
+  def values(self):
+    """Returns the tracked values, most common first."""
+    return [value for value, _, _ in self.items()]
+
+
+  def other(self):
+    """Returns the number of occurrences not known to belong to a tracked value."""
+    return self.total - sum(count - error for _, count, error in self.items())
+
+
+  def serialize(self):
+    """Returns the counts as a string."""
+    return jsoncodec.dumps({'total': self.total, 'items': self.items()})
@@ -0,0 +1,53 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for top value counts."""
+
+import unittest
+
+import topk
+
+
+
+class TopKTestCase(unittest.TestCase):
+  """Tests for top value counts."""
+
+  def testExactWhileRoomRemains(self):
+    """Test that counts are exact until there are more values than slots."""
+    top = topk.TopK(size = 3).update({'a': 5, 'b': 2}).add('c').add('a')
+    self.assertEqual([('a', 6, 0), ('b', 2, 0), ('c', 1, 0)], top.items())
+    self.assertEqual(0, top.other())
+    self.assertEqual(9, top.total)
+
+
+  def testHeavyHittersSurvive(self):
+    """Test that values above total / size are kept however many rare values arrive."""
+    top = topk.TopK(size = 5)
+    for i in range(1000):
+      top.add('common')
+      top.add('server-%d' % i)
+    self.assertEqual(5, len(top.items()))
+    value, count, error = top.items()[0]
+    self.assertEqual('common', value)
+    self.assertTrue(count - error <= 1000 <= count)
+    self.assertEqual(2000, top.total)
+    self.assertTrue(top.other() >= 1000 - 4)
+
+
+  def testSerializeRoundTrip(self):
+    """Test that serializing keeps counts, overestimates and the total."""
+    top = topk.TopK(size = 2).update({'a': 3, 'b': 2, 'c': 1})
+    copy = topk.TopK(top.serialize(), size = 2)
+    self.assertEqual(top.items(), copy.items())
+    self.assertEqual(top.total, copy.total)
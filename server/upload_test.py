@@ -0,0 +1,228 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for sending reports with bin/upload.py to the server, which runs on the local backend."""
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+# upload.py, like the server, runs on Python 2.
+PYTHON_2 = sys.version_info[0] == 2
+
+if PYTHON_2:
+  import localConfig
+  localConfig.useLocalConfig('test', 'secret')
+
+  # pylint: disable=C0413
+  import imp
+  from wsgiref import simple_server
+
+  import config
+  import queue
+  import server
+  import wireformat
+  from backend import taskqueue
+  from datamodel import Backtrace
+
+  upload = imp.load_source('upload', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'bin',
+                                                  'upload.py'))
+
+
+
+  class QuietHandler(simple_server.WSGIRequestHandler):
+    """Request handler that doesn't log requests."""
+
+    def log_message(self, *_):
+      """Logs nothing."""
+
+
+
+@unittest.skipUnless(PYTHON_2, 'upload.py runs on Python 2')
+class UploadTestCase(unittest.TestCase):
+  """Tests for sending reports with bin/upload.py to the server."""
+
+  @classmethod
+  def setUpClass(cls):
+    cls.httpd = simple_server.make_server('127.0.0.1', 0, server.getApplication(), handler_class=QuietHandler)
+    cls.thread = threading.Thread(target=cls.httpd.serve_forever)
+    cls.thread.start()
+
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.httpd.shutdown()
+    cls.thread.join()
+    cls.httpd.server_close()
+
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    upload.SETTINGS.clear()
+    # upload.py takes the key from its command line as a byte string.
+    upload.SETTINGS.update(server='http://127.0.0.1:%d' % self.httpd.server_port,
+                           secretKey=config.get('secretKey').encode('utf-8'))
+    self.requests = []
+    self.failures = set()
+    self.postReports = upload.postReports
+    upload.postReports = self.post
+
+
+  def tearDown(self):
+    upload.postReports = self.postReports
+    upload.BATCH_SIZE = 100
+    taskqueue.runPending(server.getApplication())
+    shutil.rmtree(self.directory)
+
+
+  def post(self, body, contentType, filename, expected=()):
+    """Sends a request, recording it, or fails as if the server couldn't be reached for the requests numbered in
+    self.failures."""
+    if len(self.requests) in self.failures:
+      self.requests.append((contentType, body, None))
+      return None
+    response = self.postReports(body, contentType, filename, expected)
+    self.requests.append((contentType, body, response and response.getcode()))
+    return response
+
+
+  def delivered(self):
+    """Returns the messages of the reports the server accepted, in the order sent."""
+    messages = []
+    for contentType, body, status in self.requests:
+      if status == 200:
+        reports = wireformat.decode(body) if contentType == upload.COMPACT_TYPE else [json.loads(body)]
+        messages.extend(report['message'] for report in reports)
+    return messages
+
+
+  def report(self, i, backtrace):
+    """Returns a report like a handler writes."""
+    return {'project': 'frontend', 'environment': 'prod', 'serverName': 'web%d' % (i % 3), 'message': 'm%d' % i,
+            'type': 'ValueError', 'backtrace': backtrace, 'timestamp': 1300000000.0 + i, 'context': {'userId': i}}
+
+
+  def writeFiles(self, reports):
+    """Writes each report to its own file, returning the file names."""
+    filenames = []
+    for i, report in enumerate(reports):
+      filename = os.path.join(self.directory, '%03d.gec.json' % i)
+      with open(filename, 'w') as f:
+        json.dump(report, f)
+      filenames.append(filename)
+    return filenames
+
+
+  def writeSegment(self, reports):
+    """Writes the reports to a segment, returning its file name and the offset after each record."""
+    filename = os.path.join(self.directory, 'test' + upload.spool.SEGMENT_SUFFIX)
+    ends = []
+    with open(filename, 'wb') as f:
+      for report in reports:
+        record = json.dumps(report)
+        f.write(upload.spool.RECORD_HEADER.pack(len(record)) + record)
+        ends.append(f.tell())
+    return filename, ends
+
+
+  def testCompactRoundTrip(self):
+    """Test that the client's copy of the encoder, which can't import the server's, encodes exactly what the server
+    does, and the server decodes it with backtraces by digest when referenced."""
+    reports = [{'project': 'frontend', 'message': u'caf\xe9 %d' % i, 'timestamp': 1300000000.25 + i,
+                'backtrace': 'bt %d' % (i % 2), 'errorLevel': None,
+                'context': {'userId': i - 2, 'big': 2 ** 70, 'flags': [True, False], 'nested': {'depth': [1.5]}}}
+               for i in range(4)]
+    referenced = set([upload.backtraceDigest('bt 1')])
+    self.assertEqual(wireformat.digest(u'bt 1'), upload.backtraceDigest('bt 1'))
+    self.assertEqual(wireformat.encode(reports, referenced), upload.encodeCompact(reports, referenced))
+    self.assertEqual(wireformat.CONTENT_TYPE, upload.COMPACT_TYPE)
+    decoded = wireformat.decode(upload.encodeCompact(reports, referenced))
+    self.assertEqual([dict(report, backtrace = wireformat.digest(report['backtrace']) if i % 2 else report['backtrace'])
+                      for i, report in enumerate(reports)], decoded)
+    self.assertEqual([False, True, False, True], [isinstance(report['backtrace'], wireformat.Digest)
+                                                  for report in decoded])
+
+
+  def testResolveBacktraces(self):
+    """Test that backtraces sent by digest are replaced only when every one of them is stored."""
+    Backtrace(key_name = wireformat.digest(u'stored'), text = u'stored').put()
+    stored = wireformat.Digest(wireformat.digest(u'stored'))
+    missing = wireformat.Digest(wireformat.digest(u'missing'))
+
+    reports = [{'backtrace': stored}, {'backtrace': u'inline'}, {'backtrace': stored}]
+    self.assertEqual([], queue.resolveBacktraces(reports))
+    self.assertEqual([u'stored', u'inline', u'stored'], [report['backtrace'] for report in reports])
+
+    reports = [{'backtrace': stored}, {'backtrace': missing}]
+    self.assertEqual([missing], queue.resolveBacktraces(reports))
+    self.assertEqual([stored, missing], [report['backtrace'] for report in reports])
+
+
+  def testFilesBatched(self):
+    """Test that files are sent one at a time as JSON until the server accepts batches, then in batches."""
+    upload.BATCH_SIZE = 3
+    filenames = self.writeFiles([self.report(i, 'files bt') for i in range(7)])
+    upload.processFiles(filenames)
+    # The server stores backtraces as it processes its queue, so each batch's backtrace is missing at first.
+    self.assertEqual([('application/json', 200), (upload.COMPACT_TYPE, 409), (upload.COMPACT_TYPE, 200),
+                      (upload.COMPACT_TYPE, 409), (upload.COMPACT_TYPE, 200)],
+                     [(contentType, status) for contentType, _, status in self.requests])
+    self.assertEqual([3, 3], [len(wireformat.decode(body)) for _, body, status in self.requests[1:] if status == 200])
+    self.assertEqual(['m%d' % i for i in range(7)], self.delivered())
+    self.assertEqual([], os.listdir(self.directory))
+
+
+  def testMissingBacktracesResent(self):
+    """Test that a batch the server answers 409 is sent again with only the missing backtraces in full."""
+    upload.SETTINGS['compact'] = True
+    self.assertTrue(upload.sendReports([self.report(0, 'known bt')], 'test'))
+    taskqueue.runPending(server.getApplication())
+    del self.requests[:]
+
+    self.assertTrue(upload.sendReports([self.report(1, 'known bt'), self.report(2, 'new bt')], 'test'))
+    self.assertEqual([409, 200], [status for _, _, status in self.requests])
+    first, second = [wireformat.decode(body) for _, body, _ in self.requests]
+    self.assertEqual([wireformat.digest(u'known bt'), wireformat.digest(u'new bt')],
+                     [report['backtrace'] for report in first])
+    self.assertEqual([True, False], [isinstance(report['backtrace'], wireformat.Digest) for report in second])
+    self.assertEqual(u'new bt', second[1]['backtrace'])
+    taskqueue.runPending(server.getApplication())
+
+    del self.requests[:]
+    self.assertTrue(upload.sendReports([self.report(3, 'new bt')], 'test'))
+    self.assertEqual([200], [status for _, _, status in self.requests])
+
+
+  def testSegmentOffsetsCommitted(self):
+    """Test that the offset of a segment is committed after each batch sent, so a failed send resumes after the last
+    batch the server accepted, and that a fully sent segment is deleted."""
+    upload.SETTINGS['compact'] = True
+    upload.BATCH_SIZE = 2
+    filename, ends = self.writeSegment([self.report(i, 'segment bt') for i in range(5)])
+
+    # The first batch is sent after a 409, and the second fails.
+    self.failures.add(2)
+    upload.processSegment(filename, time.time() + 30)
+    self.assertEqual([409, 200, None], [status for _, _, status in self.requests])
+    with open(filename + upload.spool.OFFSET_SUFFIX) as offsetFile:
+      self.assertEqual(ends[1], upload.readOffset(offsetFile))
+
+    upload.processSegment(filename, time.time() + 30)
+    self.assertEqual(['m%d' % i for i in range(5)], self.delivered())
+    self.assertEqual([], os.listdir(self.directory))
@@ -0,0 +1,88 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""
+Benchmark of the compact report format against JSON.
+
+Reports come from the ingest benchmark's corpus and are sent in batches as upload.py sends them: as one JSON request
+per report, or as compact batches with backtraces in full, or by digest once the server has stored them.  Prints the
+bytes sent per report, and the time the /report handler takes per report to decode a batch and encode each report
+for the instances queue, against decoding a JSON report.
+
+Usage: wireBenchmark.py [REPORTS] [BATCH]
+"""
+
+try:
+  from django.utils import simplejson as json
+except ImportError:
+  import json
+import sys
+import time
+
+import localConfig
+localConfig.useLocalConfig('benchmark', 'benchmark')
+
+# pylint: disable=C0413
+import ingestBenchmark
+import jsoncodec
+import wireformat
+
+
+def _batches(count, size):
+  """Returns lists of decoded reports from the ingest benchmark's corpus."""
+  corpus = ingestBenchmark.Corpus(50, 1.1, 20, 3)
+  reports = [json.loads(corpus.report()) for _ in range(count)]
+  return [reports[offset:offset + size] for offset in range(0, count, size)]
+
+
+def _handle(encoded):
+  """Does what the /report handler does with a compact batch whose backtraces are all sent in full."""
+  return [jsoncodec.dumps(report) for report in wireformat.decode(encoded)]
+
+
+def main():
+  """Runs the benchmark."""
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+  size = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+  batches = _batches(count, size)
+
+  serialized = [json.dumps(report) for batch in batches for report in batch]
+  inline = [wireformat.encode(batch) for batch in batches]
+  referenced = [wireformat.encode(batch, set(wireformat.digest(report['backtrace']) for report in batch))
+                for batch in batches]
+
+  start = time.time()
+  for report in serialized:
+    jsoncodec.loads(report)
+  jsonDecode = time.time() - start
+
+  start = time.time()
+  for encoded in inline:
+    _handle(encoded)
+  compactHandle = time.time() - start
+
+  print 'Reports: %d in batches of %d, JSON by %s' % (count, size, jsoncodec.NAME)
+  print
+  print '%-28s %14s %14s %14s' % ('Format', 'Bytes/report', 'Requests', 'Handler us')
+  print '%-28s %14.1f %14d %14.1f' % ('JSON', sum(len(report) for report in serialized) / float(count), count,
+                                      jsonDecode * 1e6 / count)
+  print '%-28s %14.1f %14d %14.1f' % ('Compact, backtraces in full', sum(len(b) for b in inline) / float(count),
+                                      len(batches), compactHandle * 1e6 / count)
+  print '%-28s %14.1f %14d %14s' % ('Compact, backtraces by digest', sum(len(b) for b in referenced) / float(count),
+                                    len(batches), '')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,257 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact binary encoding of a batch of reports.
+
+A batch is the magic bytes, a string table, and the reports:
+
+  batch  := MAGIC count(strings) string* count(reports) value*
+  string := count(bytes) utf8-bytes
+  value  := NULL | TRUE | FALSE | INT zigzag-varint | FLOAT 8-byte-double | STRING index
+          | LIST count value* | MAP count (index value)* | DIGEST index
+
+Tags, counts and indexes are unsigned varints.  Every string, key or value, is stored once in the table and referred
+to by index, so the project, environment and server names repeated in every report cost a byte or two each.
+
+A report's backtrace may be sent as the hex SHA-1 digest of its text instead, for the server to look up in its stored
+backtraces.  Decoding gives a Digest for those, which the server resolves before queueing the report.
+
+bin/upload.py has its own copy of the encoder, which must be kept in step with this one.
+"""
+
+import hashlib
+import struct
+
+
+CONTENT_TYPE = 'application/x-gec-reports'
+
+MAGIC = b'GEC\x01'
+
+# Deepest nesting of lists and maps decoded, so malformed input can't exhaust the stack.
+MAX_DEPTH = 32
+
+NULL, TRUE, FALSE, INT, FLOAT, STRING, LIST, MAP, DIGEST = range(9)
+
+_DOUBLE = struct.Struct('>d')
+
+_TEXT = type(u'')
+
+# int, and long on Python 2.
+_INTEGERS = (int, type(2 ** 64))
+
+
+
+class Digest(str):
+  """The hex SHA-1 digest of a backtrace sent by reference."""
+
+
+
+def digest(text):
+  """Returns the hex digest identifying the given backtrace, the same as the key of its stored Backtrace."""
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _varint(out, value):
+  """Appends an unsigned varint."""
+  while value > 0x7f:
+    out.append((value & 0x7f) | 0x80)
+    value >>= 7
+  out.append(value)
+
+
+
+class _Encoder(object):
+  """Encodes values, collecting the string table."""
+
+  def __init__(self):
+    self.out = bytearray()
+    self.strings = {}
+
+
+  def string(self, value):
+    """Appends the table index of a string."""
+    if isinstance(value, bytes):
+      value = value.decode('utf-8')
+    index = self.strings.get(value)
+    if index is None:
+      index = self.strings[value] = len(self.strings)
+    _varint(self.out, index)
+
+
+  def value(self, value):
+    """Appends a value."""
+    out = self.out
+    if value is None:
+      out.append(NULL)
+    elif value is True:
+      out.append(TRUE)
+    elif value is False:
+      out.append(FALSE)
+    elif isinstance(value, (_TEXT, bytes)):
+      out.append(STRING)
+      self.string(value)
+    elif isinstance(value, float):
+      out.append(FLOAT)
+      out += _DOUBLE.pack(value)
+    elif isinstance(value, _INTEGERS):
+      out.append(INT)
+      _varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, dict):
+      out.append(MAP)
+      _varint(out, len(value))
+      for key, item in value.items():
+        self.string(key)
+        self.value(item)
+    elif isinstance(value, (list, tuple)):
+      out.append(LIST)
+      _varint(out, len(value))
+      for item in value:
+        self.value(item)
+    else:
+      raise TypeError('Cannot encode %r' % (value,))
+
+
+  def report(self, report, referenced):
+    """Appends a report, sending its backtrace by digest if that digest is referenced."""
+    self.out.append(MAP)
+    _varint(self.out, len(report))
+    for key, item in report.items():
+      self.string(key)
+      hexDigest = digest(item) if key == 'backtrace' and item and referenced else None
+      if hexDigest in referenced:
+        self.out.append(DIGEST)
+        self.string(hexDigest)
+      else:
+        self.value(item)
+
+
+
+def encode(reports, referenced = ()):
+  """Encodes a list of report dicts.  Backtraces whose digest is in referenced are sent by digest."""
+  encoder = _Encoder()
+  for report in reports:
+    encoder.report(report, referenced)
+
+  out = bytearray(MAGIC)
+  _varint(out, len(encoder.strings))
+  for value, _ in sorted(encoder.strings.items(), key = lambda item: item[1]):
+    encoded = value.encode('utf-8')
+    _varint(out, len(encoded))
+    out += encoded
+  _varint(out, len(reports))
+  return bytes(out + encoder.out)
+
+
+
+class _Decoder(object):
+  """Decodes values from a batch."""
+
+  def __init__(self, data):
+    self.data = bytearray(data)
+    self.pos = 0
+    self.strings = []
+
+
+  def varint(self):
+    """Reads an unsigned varint."""
+    data = self.data
+    pos = self.pos
+    result = shift = 0
+    try:
+      byte = data[pos]
+      while byte > 0x7f:
+        result |= (byte & 0x7f) << shift
+        shift += 7
+        pos += 1
+        byte = data[pos]
+    except IndexError:
+      raise ValueError('Truncated batch')
+    self.pos = pos + 1
+    return result | (byte << shift)
+
+
+  def count(self):
+    """Reads a count, which can't be more than the bytes left since every item takes at least one."""
+    value = self.varint()
+    if value > len(self.data) - self.pos:
+      raise ValueError('Count of %d is more than the batch holds' % value)
+    return value
+
+
+  def take(self, size):
+    """Reads the given number of bytes."""
+    end = self.pos + size
+    if end > len(self.data):
+      raise ValueError('Truncated batch')
+    result = self.data[self.pos:end]
+    self.pos = end
+    return result
+
+
+  def string(self):
+    """Reads a string table index."""
+    try:
+      return self.strings[self.varint()]
+    except IndexError:
+      raise ValueError('String index is out of range')
+
+
+  def value(self, depth = 0):
+    """Reads a value."""
+    tag = self.varint()
+    if tag == STRING:
+      return self.string()
+    elif tag == INT:
+      value = self.varint()
+      return value >> 1 if not value & 1 else -(value >> 1) - 1
+    elif tag == FLOAT:
+      return _DOUBLE.unpack(bytes(self.take(_DOUBLE.size)))[0]
+    elif tag == NULL:
+      return None
+    elif tag == TRUE:
+      return True
+    elif tag == FALSE:
+      return False
+    elif tag == DIGEST:
+      return Digest(self.string())
+    elif depth >= MAX_DEPTH:
+      raise ValueError('Values are nested more than %d deep' % MAX_DEPTH)
+    elif tag == MAP:
+      return dict((self.string(), self.value(depth + 1)) for _ in range(self.count()))
+    elif tag == LIST:
+      return [self.value(depth + 1) for _ in range(self.count())]
+    raise ValueError('Unknown tag %d' % tag)
+
+
+
+def decode(data):
+  """Decodes a batch in to a list of report dicts.  Backtraces sent by digest are Digests.  Raises ValueError if the
+  data is not a valid batch."""
+  if data[:len(MAGIC)] != MAGIC:
+    raise ValueError('Not a batch of reports')
+  decoder = _Decoder(data)
+  decoder.pos = len(MAGIC)
+  try:
+    for _ in range(decoder.count()):
+      decoder.strings.append(decoder.take(decoder.varint()).decode('utf-8'))
+  except UnicodeDecodeError:
+    raise ValueError('String table is not UTF-8')
+
+  reports = [decoder.value() for _ in range(decoder.count())]
+  if decoder.pos != len(decoder.data):
+    raise ValueError('Trailing bytes after %d reports' % len(reports))
+  for report in reports:
+    if not isinstance(report, dict):
+      raise ValueError('Report is not a map')
+  return reports
@@ -0,0 +1,64 @@
+# Copyright 2011 The greplin-exception-catcher Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for the compact report encoding."""
+
+import json
+import unittest
+
+import wireformat
+
+BACKTRACE = u'Traceback (most recent call last):\n  File "app.py", line 3, in <module>\nValueError: caf\xe9'
+
+
+
+class WireFormatTestCase(unittest.TestCase):
+  """Tests for the compact report encoding."""
+
+  def report(self, i):
+    """Returns a report like a client sends."""
+    return {
+      u'project': u'frontend', u'environment': u'prod', u'serverName': u'web%d' % (i % 3),
+      u'message': u'Bad value %d' % i, u'timestamp': 1300000000.25 + i, u'backtrace': BACKTRACE,
+      u'errorLevel': u'error', u'context': {u'userId': i - 5, u'big': 2 ** 70, u'tags': [True, False, None, 1.5]}
+    }
+
+
+  def testRoundTrip(self):
+    """Test that reports decode to what was encoded, with repeated strings stored once."""
+    reports = [self.report(i) for i in range(50)]
+    encoded = wireformat.encode(reports)
+    self.assertEqual(reports, wireformat.decode(encoded))
+    self.assertEqual(1, encoded.count(BACKTRACE.encode('utf-8')))
+    self.assertTrue(len(encoded) < len(json.dumps(reports)) / 3)
+
+
+  def testBacktraceByDigest(self):
+    """Test that referenced backtraces are sent as digests."""
+    other = dict(self.report(1), backtrace = u'other')
+    digest = wireformat.digest(BACKTRACE)
+    encoded = wireformat.encode([self.report(0), other], referenced = set([digest]))
+    self.assertFalse(BACKTRACE.encode('utf-8') in encoded)
+    first, second = wireformat.decode(encoded)
+    self.assertTrue(isinstance(first['backtrace'], wireformat.Digest))
+    self.assertEqual(digest, first['backtrace'])
+    self.assertEqual(u'other', second['backtrace'])
+
+
+  def testMalformed(self):
+    """Test that malformed batches raise ValueError."""
+    encoded = wireformat.encode([self.report(0)])
+    for data in (b'', b'{"project": "x"}', encoded[:-1], encoded + b'\x00', wireformat.MAGIC + b'\x00\x01\x05\x00',
+                 wireformat.MAGIC + b'\x00\x01' + b'\x07\x01' * 40 + b'\x00', wireformat.MAGIC + b'\x00\xff\xff\x7f'):
+      self.assertRaises(ValueError, wireformat.decode, data)